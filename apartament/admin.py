@@ -1,7 +1,30 @@
 from django.contrib import admin
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.urls import reverse
 from django.utils.html import format_html
-from .models import Category, Post, Comment,PostImage, Profile,User
+from .models import Category, Post, Comment,PostImage, Profile,User, ModerationJob, set_main_images
 from django.contrib.admin import DateFieldListFilter
+from . import moderation
+from .renditions import rendition_url
+from .facets import ROOM_OPTIONS
+from .filters import rooms_q
+from .pagination import EstimatedCountPaginator
+from .search import search_posts
+
+
+def start_moderation(model_admin, request, action, queryset):
+    """Запускает массовое действие фоновой задачей и показывает ссылку на ее прогресс"""
+    job = moderation.start_job(action, queryset, request.user)
+    url = reverse('admin:apartament_moderationjob_change', args=[job.pk])
+    model_admin.message_user(request, format_html(
+        'Запущена фоновая задача <a href="{}">№{}</a>: объектов - {}', url, job.pk, job.total
+    ))
+
+
+def preview_url(fieldfile, ready):
+    """Копия для предпросмотра в админке, пока ее нет - оригинал"""
+    return rendition_url(fieldfile, 'admin') if ready else fieldfile.url
 
 
 @admin.register(Category)
@@ -20,7 +43,7 @@ class PostImageInline(admin.TabularInline):
         if obj.image and hasattr(obj.image, 'url'):
             return format_html(
                 '<img src="{}" style="max-height: 100px; max-width: 100px;" />', 
-                obj.image.url
+                preview_url(obj.image, obj.renditions_ready)
             )
         return "Нет изображения"
     image_preview.short_description = 'Предпросмотр'
@@ -74,7 +97,7 @@ class PostImageAdmin(admin.ModelAdmin):
         if obj.image and hasattr(obj.image, 'url'):
             return format_html(
                 '<img src="{}" style="max-height: 50px; max-width: 50px;" />', 
-                obj.image.url
+                preview_url(obj.image, obj.renditions_ready)
             )
         return "Нет изображения"
     image_preview.short_description = 'Изображение'
@@ -83,11 +106,45 @@ class PostImageAdmin(admin.ModelAdmin):
         if obj.image and hasattr(obj.image, 'url'):
             return format_html(
                 '<img src="{}" style="max-height: 300px; max-width: 300px;" />', 
-                obj.image.url
+                preview_url(obj.image, obj.renditions_ready)
             )
         return "Нет изображения"
     image_preview_admin.short_description = 'Большой предпросмотр'
 
+    def changelist_view(self, request, extra_context=None):
+        # Изменения флага "основное" из списка копятся в save_model и
+        # применяются после сохранения формы одной пачкой
+        request._main_image_changes = {}
+        response = super().changelist_view(request, extra_context)
+        if request._main_image_changes:
+            set_main_images(request._main_image_changes)
+        return response
+
+    def save_model(self, request, obj, form, change):
+        changes = getattr(request, '_main_image_changes', None)
+        if changes is None or not change or form.changed_data != ['is_main']:
+            super().save_model(request, obj, form, change)
+            return
+        if obj.is_main:
+            changes[obj.post_id] = obj.pk
+        else:
+            # Флаг сняли - объявление остается без основного изображения,
+            # если в той же форме не отмечено другое
+            changes.setdefault(obj.post_id, None)
+
+class RoomsListFilter(admin.SimpleListFilter):
+    """Фиксированные варианты вместо SELECT DISTINCT rooms по всей таблице"""
+    title = 'Комнаты'
+    parameter_name = 'rooms'
+
+    def lookups(self, request, model_admin):
+        return [(str(value), label) for value, label in ROOM_OPTIONS]
+
+    def queryset(self, request, queryset):
+        if not self.value() or not self.value().isdigit():
+            return queryset
+        return queryset.filter(rooms_q(self.value()))
+
 @admin.register(Post)
 class PostAdmin(admin.ModelAdmin):
     list_display = (
@@ -107,8 +164,9 @@ class PostAdmin(admin.ModelAdmin):
         'category', 
         'created', 
         'updated',
-        'rooms'
+        RoomsListFilter
     )
+    # Сам поиск выполняет get_search_results через поисковый индекс
     search_fields = (
         'title', 
         'description', 
@@ -157,46 +215,64 @@ class PostAdmin(admin.ModelAdmin):
     )
     inlines = [PostImageInline]
     actions = ['approve_posts', 'reject_posts']
+    # Большая таблица: без точного COUNT(*) и с колонками из одного запроса
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_select_related = ('owner', 'category', 'cover')
+
+    def get_queryset(self, request):
+        comments = Comment.objects.filter(post=OuterRef('pk')).order_by().values('post')
+        return super().get_queryset(request).annotate(
+            comments_total=Coalesce(Subquery(comments.annotate(total=Count('pk')).values('total')), 0),
+        )
+
+    def get_search_results(self, request, queryset, search_term):
+        # Поиск через индекс (FTS5 или GIN), а не icontains по описанию
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        found = search_posts(Post.objects.all(), search_term, ranked=False).values('pk')
+        # Пользователей на порядки меньше, чем объявлений - частичное совпадение логина оставляем
+        condition = Q(pk__in=found) | Q(owner__username__icontains=search_term)
+        if search_term.isdigit():
+            condition |= Q(pk=int(search_term))
+        return queryset.filter(condition), False
     
     def approve_posts(self, request, queryset):
-        queryset.update(status='active')
+        start_moderation(self, request, 'approve_posts', queryset)
     approve_posts.short_description = "✅ Одобрить выбранные объявления"
     
     def reject_posts(self, request, queryset):
-        queryset.update(status='rejected') 
+        start_moderation(self, request, 'reject_posts', queryset)
     reject_posts.short_description = "❌ Отклонить выбранные объявления"
     
     def comments_count(self, obj):
-        return obj.comments.count()
+        return obj.comments_total
     comments_count.short_description = 'Комментарии'
+    comments_count.admin_order_field = 'comments_total'
     
     def images_count(self, obj):
-        return obj.images.count()
+        return obj.images_count
     images_count.short_description = 'Изображения'
+    images_count.admin_order_field = 'images_count'
     
     def main_image_preview(self, obj):
-        main_image = obj.images.filter(is_main=True).first()
-        if main_image and main_image.image:
+        # Обложка - основное изображение, а если его нет, первое (см. refresh_post_covers)
+        cover = obj.cover
+        if cover and cover.image:
             return format_html(
                 '<img src="{}" style="max-height: 50px; max-width: 50px;" />', 
-                main_image.image.url
-            )
-        # Если нет главного, показываем первое изображение
-        first_image = obj.images.first()
-        if first_image and first_image.image:
-            return format_html(
-                '<img src="{}" style="max-height: 50px; max-width: 50px;" />', 
-                first_image.image.url
+                preview_url(cover.image, cover.renditions_ready)
             )
         return "Нет изображения"
     main_image_preview.short_description = 'Главное фото'
     
     def main_image_display(self, obj):
-        main_image = obj.images.filter(is_main=True).first()
-        if main_image and main_image.image:
+        cover = obj.cover
+        if cover and cover.is_main and cover.image:
             return format_html(
                 '<img src="{}" style="max-height: 300px; max-width: 300px;" />', 
-                main_image.image.url
+                preview_url(cover.image, cover.renditions_ready)
             )
         return "Главное изображение не установлено"
     main_image_display.short_description = 'Главное изображение'
@@ -260,7 +336,7 @@ class ProfileAdmin(admin.ModelAdmin):
         if obj.avatar and hasattr(obj.avatar, 'url'):
             return format_html(
                 '<img src="{}" style="max-height: 50px; max-width: 50px; border-radius: 50%;" />', 
-                obj.avatar.url
+                preview_url(obj.avatar, obj.avatar_renditions_ready)
             )
         return "Нет аватара"
     avatar_preview.short_description = 'Аватар'
@@ -269,7 +345,7 @@ class ProfileAdmin(admin.ModelAdmin):
         if obj.avatar and hasattr(obj.avatar, 'url'):
             return format_html(
                 '<img src="{}" style="max-height: 200px; max-width: 200px; border-radius: 10px;" />', 
-                obj.avatar.url
+                preview_url(obj.avatar, obj.avatar_renditions_ready)
             )
         return "Аватар не установлен"
     avatar_display.short_description = 'Предпросмотр аватара'
@@ -285,10 +361,47 @@ class CommentAdmin(admin.ModelAdmin):
     actions = ['activate_comments', 'deactivate_comments']
     
     def activate_comments(self, request, queryset):
-        queryset.update(active=True)
+        start_moderation(self, request, 'activate_comments', queryset)
     activate_comments.short_description = "Активировать комментарии"
     
     def deactivate_comments(self, request, queryset):
-        queryset.update(active=False)
+        start_moderation(self, request, 'deactivate_comments', queryset)
     deactivate_comments.short_description = "Деактивировать комментарии"
 
+
+
+@admin.register(ModerationJob)
+class ModerationJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'action', 'status', 'progress_display', 'created_by', 'created', 'heartbeat')
+    list_filter = ('status', 'action')
+    list_select_related = ('created_by',)
+    # Список id может быть огромным - в форме его не показываем
+    fields = ('action', 'status', 'progress_display', 'error', 'created_by', 'created', 'heartbeat')
+    readonly_fields = fields
+    actions = ['resume_jobs']
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('object_ids')
+
+    def progress_display(self, obj):
+        return format_html(
+            '<div style="width: 120px; background: #e9ecef; border-radius: 4px;">'
+            '<div style="width: {}%; background: #28a745; color: white; text-align: center; border-radius: 4px;">{}%</div>'
+            '</div><small>{} / {}</small>',
+            obj.progress, obj.progress, obj.processed, obj.total
+        )
+    progress_display.short_description = 'Прогресс'
+
+    def resume_jobs(self, request, queryset):
+        # Задачи с ошибкой и те, что взял бы исполнитель; выполняющиеся сейчас не трогаем
+        job_ids = list(
+            queryset.filter(Q(status='failed') | moderation.claimable_q()).values_list('pk', flat=True)
+        )
+        ModerationJob.objects.filter(pk__in=job_ids, status='failed').update(status='pending', error='')
+        for job_id in job_ids:
+            moderation.schedule(job_id)
+        self.message_user(request, f'Задач поставлено в очередь: {len(job_ids)}')
+    resume_jobs.short_description = "Продолжить выбранные задачи"
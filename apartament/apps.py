@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ApartamentConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apartament'
+
+    def ready(self):
+        from . import checks  # noqa: F401 - регистрирует проверки
@@ -0,0 +1,347 @@
+# cache.py
+"""Кэш страниц для анонимных посетителей.
+
+Ключ страницы объявлений строится из нормализованных параметров фильтра,
+сортировки и курсора, ключ страницы объявления - из его id. В оба ключа
+входит "поколение": метка времени, которая меняется при сохранении или
+удалении ``Post``, ``PostImage`` и ``Comment`` (см. сигналы в models.py),
+поэтому старые записи просто перестают читаться.
+
+Вместе со страницей объявления под тем же поколением запоминается его
+статус: по нему ответ 304 решает, засчитывать ли просмотр, без запроса к БД.
+
+Те же поколения служат валидаторами ``ETag``/``Last-Modified`` для
+условных GET-запросов (``ConditionalGetMixin``): проверка стоит одного
+чтения из кэша, а ``304 Not Modified`` отдается до рендеринга.
+
+Защита от лавины запросов: запись живет ``PAGE_CACHE_STALE`` секунд, но
+считается свежей только ``PAGE_CACHE_TIMEOUT``. Устаревшую страницу
+перестраивает один воркер (под блокировкой ``cache.add``), остальные
+в это время отдают устаревшую копию или коротко ждут первую.
+
+Все это работает только с общим для воркеров кэшем: в продакшене это
+Redis (``REDIS_URL``). С кэшем в памяти процесса у каждого воркера свои
+поколения и блокировки (см. проверку в checks.py).
+
+Миксины работают и с асинхронными представлениями: проверки, которым
+нужны сессия и пользователь, выполняются через ``sync_to_async``, а кэш
+читается асинхронными методами (``cached_page_async``).
+"""
+import asyncio
+import hashlib
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from .filters import FILTER_PARAMS, get_sort
+
+LISTING_GENERATION_KEY = 'pagecache:listing:gen'
+
+# Сколько ждать, пока другой воркер построит страницу, которой еще нет в кэше
+LOCK_WAIT = 2.0
+LOCK_POLL = 0.05
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def post_generation_key(post_id):
+    return f'pagecache:post:{post_id}:gen'
+
+
+def get_generation(key):
+    """Текущее поколение (метка времени последнего изменения)"""
+    generation = cache.get(key)
+    if generation is None:
+        generation = time.time()
+        if not cache.add(key, generation, None):
+            generation = cache.get(key, generation)
+    return generation
+
+
+def bump_generation(key):
+    cache.set(key, time.time(), None)
+
+
+def invalidate_listing():
+    bump_generation(LISTING_GENERATION_KEY)
+
+
+def invalidate_post(post_id):
+    bump_generation(post_generation_key(post_id))
+
+
+def invalidate_posts(post_ids):
+    """Сбрасывает кэш страницы объявлений и страниц переданных объявлений"""
+    now = time.time()
+    cache.set_many({post_generation_key(post_id): now for post_id in post_ids}, None)
+    invalidate_listing()
+
+
+def listing_cache_key(params):
+    """Ключ страницы объявлений по нормализованным параметрам запроса"""
+    normalized = [(name, params.get(name, '').strip()) for name in FILTER_PARAMS]
+    normalized.append(('sort', get_sort(params)))
+    normalized.append(('cursor', params.get('cursor', '')))
+    raw = '&'.join(f'{name}={value}' for name, value in normalized if value)
+    digest = hashlib.md5(raw.encode()).hexdigest()
+    return f'pagecache:listing:{get_generation(LISTING_GENERATION_KEY)}:{digest}'
+
+
+def detail_cache_key(post_id):
+    return f'pagecache:post:{post_id}:{get_generation(post_generation_key(post_id))}'
+
+
+def post_status_key(post_id):
+    return f'{detail_cache_key(post_id)}:status'
+
+
+def remember_post_status(post):
+    """Запоминает статус объявления до смены поколения его страницы"""
+    cache.set(post_status_key(post.pk), post.status, _setting('PAGE_CACHE_STALE', 600))
+
+
+def cached_post_status(post_id):
+    """Статус из кэша или ``None``, если страницу после изменения еще не строили"""
+    return cache.get(post_status_key(post_id))
+
+
+def _build_response(entry, state):
+    response = HttpResponse(entry['content'], content_type=entry['content_type'], status=entry['status'])
+    response['X-Page-Cache'] = state
+    return response
+
+
+def _is_fresh(entry):
+    return entry is not None and entry['fresh_until'] > time.time()
+
+
+def _make_entry(response, cacheable):
+    """Запись для кэша или None, если ответ сохранять нельзя"""
+    if not cacheable or response.status_code != 200:
+        return None
+    return {
+        'content': response.content,
+        'content_type': response['Content-Type'],
+        'status': response.status_code,
+        'fresh_until': time.time() + _setting('PAGE_CACHE_TIMEOUT', 60),
+    }
+
+
+def cached_page(key, render):
+    """Отдает страницу из кэша или строит ее через ``render()``.
+
+    ``render`` возвращает пару (отрендеренный ответ, можно ли его кэшировать).
+    """
+    entry = cache.get(key)
+    if _is_fresh(entry):
+        return _build_response(entry, 'hit')
+
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, 1, int(LOCK_WAIT * 5)):
+        try:
+            response, cacheable = render()
+            new_entry = _make_entry(response, cacheable)
+            if new_entry is not None:
+                cache.set(key, new_entry, _setting('PAGE_CACHE_STALE', 600))
+            response['X-Page-Cache'] = 'miss'
+            return response
+        finally:
+            cache.delete(lock_key)
+
+    if entry is not None:
+        # Страницу уже перестраивает другой воркер - отдаем устаревшую копию
+        return _build_response(entry, 'stale')
+
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL)
+        entry = cache.get(key)
+        if entry is not None:
+            return _build_response(entry, 'hit')
+    response, _ = render()
+    return response
+
+
+async def cached_page_async(key, render):
+    """``cached_page`` для асинхронных представлений: ``render`` - корутина"""
+    entry = await cache.aget(key)
+    if _is_fresh(entry):
+        return _build_response(entry, 'hit')
+
+    lock_key = f'{key}:lock'
+    if await cache.aadd(lock_key, 1, int(LOCK_WAIT * 5)):
+        try:
+            response, cacheable = await render()
+            new_entry = _make_entry(response, cacheable)
+            if new_entry is not None:
+                await cache.aset(key, new_entry, _setting('PAGE_CACHE_STALE', 600))
+            response['X-Page-Cache'] = 'miss'
+            return response
+        finally:
+            await cache.adelete(lock_key)
+
+    if entry is not None:
+        return _build_response(entry, 'stale')
+
+    # Ожидание не занимает поток: корутина просто спит в цикле событий
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(LOCK_POLL)
+        entry = await cache.aget(key)
+        if entry is not None:
+            return _build_response(entry, 'hit')
+    response, _ = await render()
+    return response
+
+
+class AnonymousPageCacheMixin:
+    """Кэширует GET-ответы представления для анонимных посетителей.
+
+    Наследник определяет ``get_page_cache_key``; ``page_cache_hit`` вызывается,
+    когда ответ отдан из кэша, а ``is_response_cacheable`` решает, можно ли
+    сохранить свежеотрендеренный ответ.
+    """
+
+    def is_request_cacheable(self, request):
+        if not _setting('PAGE_CACHE_ENABLED', True):
+            return False
+        if request.method not in ('GET', 'HEAD') or request.user.is_authenticated:
+            return False
+        # Одноразовые сообщения должны показаться именно этому посетителю
+        return not len(messages.get_messages(request))
+
+    def get_page_cache_key(self, request, *args, **kwargs):
+        raise NotImplementedError
+
+    def page_cache_hit(self, request, *args, **kwargs):
+        pass
+
+    def is_response_cacheable(self, response):
+        return True
+
+    def dispatch(self, request, *args, **kwargs):
+        if self.view_is_async:
+            return self._page_cache_dispatch_async(request, *args, **kwargs)
+        if not self.is_request_cacheable(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        rendered = {}
+
+        def render():
+            response = super(AnonymousPageCacheMixin, self).dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+            rendered['done'] = True
+            return response, self.is_response_cacheable(response)
+
+        key = self.get_page_cache_key(request, *args, **kwargs)
+        response = cached_page(key, render)
+        if not rendered:
+            self.page_cache_hit(request, *args, **kwargs)
+        return response
+
+    async def _page_cache_dispatch_async(self, request, *args, **kwargs):
+        # Сессия и пользователь загружаются синхронно
+        if not await sync_to_async(self.is_request_cacheable)(request):
+            return await super().dispatch(request, *args, **kwargs)
+
+        rendered = {}
+
+        async def render():
+            response = await super(AnonymousPageCacheMixin, self).dispatch(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                await sync_to_async(response.render)()
+            rendered['done'] = True
+            return response, self.is_response_cacheable(response)
+
+        key = await sync_to_async(self.get_page_cache_key)(request, *args, **kwargs)
+        response = await cached_page_async(key, render)
+        if not rendered:
+            await sync_to_async(self.page_cache_hit)(request, *args, **kwargs)
+        return response
+
+
+def validators(generation_key, *parts):
+    """ETag и Last-Modified по поколению ``generation_key``.
+
+    Просмотры пишутся в БД без смены поколения, поэтому в валидаторы входит
+    еще номер интервала ``PAGE_CACHE_TIMEOUT``: ответ не устаревает дольше,
+    чем страница в кэше.
+    """
+    generation = get_generation(generation_key)
+    timeout = _setting('PAGE_CACHE_TIMEOUT', 60)
+    interval = int(time.time() // timeout)
+    raw = ':'.join(str(part) for part in (generation, interval) + parts)
+    etag = quote_etag(hashlib.md5(raw.encode()).hexdigest())
+    return etag, int(max(generation, interval * timeout))
+
+
+class ConditionalGetMixin:
+    """Отвечает ``304 Not Modified`` на условные GET-запросы до рендеринга.
+
+    Наследник определяет ``get_generation_key``; в валидаторы также входят
+    пользователь (страницы разные для гостей и авторизованных) и параметры
+    запроса. ``not_modified`` вызывается, когда отдан ответ 304.
+    """
+
+    def get_generation_key(self, request, *args, **kwargs):
+        raise NotImplementedError
+
+    def not_modified(self, request, *args, **kwargs):
+        pass
+
+    def check_validators(self, request, *args, **kwargs):
+        """(etag, last_modified, ответ 304 или None); None - запрос не проверяется"""
+        # Одноразовые сообщения нельзя подменить закэшированной в браузере страницей
+        if request.method not in ('GET', 'HEAD') or len(messages.get_messages(request)):
+            return None
+
+        etag, last_modified = validators(
+            self.get_generation_key(request, *args, **kwargs),
+            request.user.pk or 0,
+            request.GET.urlencode(),
+        )
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            self.not_modified(request, *args, **kwargs)
+        return etag, last_modified, response
+
+    def add_validators(self, response, etag, last_modified):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        # Браузер хранит страницу, но каждый раз сверяет валидаторы
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ('Cookie',))
+        return response
+
+    def dispatch(self, request, *args, **kwargs):
+        if self.view_is_async:
+            return self._conditional_dispatch_async(request, *args, **kwargs)
+        checked = self.check_validators(request, *args, **kwargs)
+        if checked is None:
+            return super().dispatch(request, *args, **kwargs)
+        etag, last_modified, response = checked
+        if response is None:
+            response = super().dispatch(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        return self.add_validators(response, etag, last_modified)
+
+    async def _conditional_dispatch_async(self, request, *args, **kwargs):
+        checked = await sync_to_async(self.check_validators)(request, *args, **kwargs)
+        if checked is None:
+            return await super().dispatch(request, *args, **kwargs)
+        etag, last_modified, response = checked
+        if response is None:
+            response = await super().dispatch(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        return self.add_validators(response, etag, last_modified)
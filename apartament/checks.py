@@ -0,0 +1,39 @@
+# checks.py
+"""Проверки конфигурации (``manage.py check``).
+
+Кэш страниц, его блокировки от лавины запросов, поколения и счетчики
+рассчитаны на общий для всех воркеров кэш (Redis). Кэш в памяти процесса
+у каждого воркера свой: поколения расходятся, и страница после изменения
+объявления отдается устаревшей, пока не истечет ее срок.
+"""
+import os
+
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def worker_count():
+    """Число воркеров сервера: WEB_CONCURRENCY, как у gunicorn и uvicorn"""
+    try:
+        return int(os.environ.get('WEB_CONCURRENCY') or 1)
+    except ValueError:
+        return 1
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    workers = worker_count()
+    if backend not in LOCAL_CACHES or workers <= 1:
+        return []
+    return [Warning(
+        f'Кэш {backend} не общий для {workers} воркеров (WEB_CONCURRENCY)',
+        hint='Задайте REDIS_URL: кэш страниц и блокировки от лавины запросов '
+             'должны быть общими для всех воркеров.',
+        id='apartament.W001',
+    )]
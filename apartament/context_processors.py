@@ -0,0 +1,7 @@
+# context_processors.py
+from django.conf import settings
+
+
+def fragment_cache(request):
+    """Срок жизни фрагментов {% cache %} для шаблонов"""
+    return {'fragment_cache_timeout': getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 600)}
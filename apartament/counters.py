@@ -0,0 +1,148 @@
+# counters.py
+"""Отложенный (write-behind) счетчик просмотров объявлений.
+
+Просмотры копятся в памяти процесса и записываются в ``Post.views``
+одним пакетным ``UPDATE``, когда накопилось ``VIEW_COUNTER_FLUSH_THRESHOLD``
+просмотров или прошло ``VIEW_COUNTER_FLUSH_INTERVAL`` секунд. По времени
+буфер сбрасывает фоновый поток, даже если новых просмотров нет, поэтому
+при падении воркера (SIGKILL, OOM) теряется не больше
+``VIEW_COUNTER_FLUSH_INTERVAL`` секунд просмотров. При штатной остановке
+буфер сбрасывается через ``atexit``.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models import Case, F, Value, When
+
+logger = logging.getLogger(__name__)
+
+SESSION_KEY = 'viewed_posts'
+# Сколько последних просмотренных объявлений помнить в сессии
+SESSION_LIMIT = 100
+
+
+class ViewCounter:
+    def __init__(self, flush_interval=None, flush_threshold=None):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        self._last_flush = time.monotonic()
+        self._flusher_pid = None
+
+    def _settings(self):
+        interval = self.flush_interval
+        if interval is None:
+            interval = getattr(settings, 'VIEW_COUNTER_FLUSH_INTERVAL', 10)
+        threshold = self.flush_threshold
+        if threshold is None:
+            threshold = getattr(settings, 'VIEW_COUNTER_FLUSH_THRESHOLD', 100)
+        return interval, threshold
+
+    def add(self, post_id, count=1):
+        """Учитывает просмотр; при необходимости сбрасывает буфер в БД"""
+        interval, threshold = self._settings()
+        self._start_flusher()
+        with self._lock:
+            self._pending[post_id] += count
+            due = (
+                sum(self._pending.values()) >= threshold or
+                time.monotonic() - self._last_flush >= interval
+            )
+        if due:
+            self.flush()
+
+    def _start_flusher(self):
+        # Поток запускается в каждом процессе отдельно: после fork потоков родителя нет
+        if not getattr(settings, 'VIEW_COUNTER_BACKGROUND_FLUSH', True):
+            return
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._run_flusher, name='view-counter', daemon=True).start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self._settings()[0])
+            with self._lock:
+                if not self._pending:
+                    continue
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                # Поток не должен останавливаться: следующий сброс будет через интервал
+                logger.exception('Ошибка фонового сброса просмотров')
+            finally:
+                close_old_connections()
+
+    def flush(self):
+        """Записывает накопленные просмотры одним UPDATE"""
+        with self._lock:
+            batch, self._pending = self._pending, Counter()
+            self._last_flush = time.monotonic()
+        if not batch:
+            return 0
+        try:
+            write_views(batch)
+        except DatabaseError:
+            # Возвращаем просмотры в буфер, чтобы записать их при следующем сбросе
+            logger.exception('Не удалось записать просмотры объявлений')
+            with self._lock:
+                self._pending.update(batch)
+            return 0
+        return sum(batch.values())
+
+
+def write_views(batch):
+    """Прибавляет просмотры из словаря {post_id: число} одним запросом"""
+    from .models import Post
+    from .stats import record_owner_views, record_views
+
+    increment = Case(
+        *[When(pk=post_id, then=Value(count)) for post_id, count in batch.items()],
+        default=Value(0),
+    )
+    # Одна транзакция: после ошибки пакет возвращается в буфер целиком,
+    # и повторная запись не учитывает его часть дважды
+    with transaction.atomic():
+        Post.objects.filter(pk__in=list(batch)).update(views=F('views') + increment)
+        rows = Post.objects.filter(pk__in=list(batch)).values_list('pk', 'owner_id', 'status')
+        views_by_owner = {}
+        active_views = 0
+        for post_id, owner_id, status in rows:
+            views_by_owner[owner_id] = views_by_owner.get(owner_id, 0) + batch[post_id]
+            # В статистику главной страницы идут только просмотры активных объявлений
+            if status == 'active':
+                active_views += batch[post_id]
+        record_views(active_views)
+        record_owner_views(views_by_owner)
+
+
+view_counter = ViewCounter()
+atexit.register(view_counter.flush)
+
+
+def record_view(request, post):
+    """Учитывает просмотр страницы объявления. Возвращает True, если он засчитан.
+
+    При ``VIEW_COUNTER_DEDUPE_SESSION`` повторные просмотры в рамках уже
+    существующей сессии не считаются (новые сессии ради этого не создаются).
+    """
+    session = getattr(request, 'session', None)
+    if getattr(settings, 'VIEW_COUNTER_DEDUPE_SESSION', False) and session and session.session_key:
+        viewed = session.get(SESSION_KEY, [])
+        if post.pk in viewed:
+            return False
+        session[SESSION_KEY] = (viewed + [post.pk])[-SESSION_LIMIT:]
+    view_counter.add(post.pk)
+    return True
@@ -0,0 +1,116 @@
+# facets.py
+"""Фасеты для фильтров страницы объявлений.
+
+Все счетчики (комнаты, ценовые диапазоны, категории) считаются одним
+сгруппированным запросом и раскладываются по фасетам уже в Python.
+Каждый фасет считается по всем фильтрам, кроме своего: запрос идет без
+фильтров по комнатам и цене, а их условия попадают в группировку
+флагами ``rooms_match`` и ``price_match``. Так после выбора "2 комнаты"
+остальные варианты показывают, сколько объявлений будет при их выборе.
+"""
+from django.db.models import Case, Count, F, IntegerField, Value, When
+
+from .filters import MAX_ROOMS, filter_posts, max_price_q, rooms_q
+
+# Фильтры, которые фасеты учитывают флагами, а не условием запроса
+FACETED_PARAMS = ('rooms', 'max_price')
+
+# Варианты фильтра по комнатам, как в форме поиска
+ROOM_OPTIONS = [
+    (1, '1 комната'),
+    (2, '2 комнаты'),
+    (3, '3 комнаты'),
+    (4, '4 комнаты'),
+    (MAX_ROOMS, f'{MAX_ROOMS}+ комнат'),
+]
+
+# Ценовые диапазоны: (подпись, нижняя граница, верхняя граница)
+PRICE_BUCKETS = [
+    ('до 20 000 ₽', None, 20000),
+    ('20 000 – 40 000 ₽', 20000, 40000),
+    ('40 000 – 70 000 ₽', 40000, 70000),
+    ('70 000 – 120 000 ₽', 70000, 120000),
+    ('от 120 000 ₽', 120000, None),
+]
+
+
+def _price_bucket():
+    whens = [
+        When(price__lt=upper, then=Value(index))
+        for index, (_, _, upper) in enumerate(PRICE_BUCKETS) if upper is not None
+    ]
+    return Case(*whens, default=Value(len(PRICE_BUCKETS) - 1), output_field=IntegerField())
+
+
+def _rooms_bucket():
+    return Case(
+        When(rooms__gte=MAX_ROOMS, then=Value(MAX_ROOMS)),
+        default=F('rooms'), output_field=IntegerField(),
+    )
+
+
+def _match(condition):
+    """1, если строка проходит фильтр (без фильтра - всегда 1)"""
+    if condition is None:
+        return Value(1, output_field=IntegerField())
+    return Case(When(condition, then=Value(1)), default=Value(0), output_field=IntegerField())
+
+
+def facet_queryset(queryset, params=None):
+    """Сгруппированный запрос: число объявлений на каждую комбинацию значений фасетов.
+
+    ``queryset`` - объявления без фильтров из FACETED_PARAMS, их условия
+    из ``params`` становятся колонками группировки.
+    """
+    params = params or {}
+    rooms = params.get('rooms')
+    max_price = params.get('max_price')
+    return (
+        queryset.order_by()
+        .annotate(
+            rooms_bucket=_rooms_bucket(),
+            price_bucket=_price_bucket(),
+            rooms_match=_match(rooms_q(rooms) if rooms and rooms.isdigit() else None),
+            price_match=_match(max_price_q(max_price) if max_price else None),
+        )
+        .values('rooms_bucket', 'price_bucket', 'rooms_match', 'price_match', 'category_id', 'category__name')
+        .annotate(total=Count('pk'))
+    )
+
+
+def facet_counts(params, queryset=None):
+    """Считает фасеты по фильтрам из ``params`` одним запросом"""
+    rows = facet_queryset(filter_posts(params, queryset, exclude=FACETED_PARAMS), params)
+
+    rooms = {}
+    prices = {}
+    categories = {}
+    total = 0
+    for row in rows:
+        count = row['total']
+        # Фасет комнат - по всем фильтрам, кроме комнат; цен - кроме цены
+        if row['price_match']:
+            rooms[row['rooms_bucket']] = rooms.get(row['rooms_bucket'], 0) + count
+        if row['rooms_match']:
+            prices[row['price_bucket']] = prices.get(row['price_bucket'], 0) + count
+        if not (row['rooms_match'] and row['price_match']):
+            continue
+        total += count
+        category = categories.setdefault(
+            row['category_id'],
+            {'id': row['category_id'], 'name': row['category__name'], 'count': 0},
+        )
+        category['count'] += count
+
+    return {
+        'total': total,
+        'rooms': [
+            {'value': value, 'label': label, 'count': rooms.get(value, 0)}
+            for value, label in ROOM_OPTIONS
+        ],
+        'price': [
+            {'label': label, 'min': lower, 'max': upper, 'count': prices.get(index, 0)}
+            for index, (label, lower, upper) in enumerate(PRICE_BUCKETS)
+        ],
+        'categories': sorted(categories.values(), key=lambda c: (-c['count'], c['name'])),
+    }
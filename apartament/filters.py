@@ -0,0 +1,63 @@
+# filters.py
+"""Фильтры страницы объявлений, общие для HTML-страницы и API"""
+from .models import Post
+from .pagination import DEFAULT_SORT, LISTING_SORTS
+from .search import rank_sort, search_posts
+
+from django.db.models import Q
+
+# Параметры запроса, которые влияют на выборку объявлений
+FILTER_PARAMS = ('q', 'max_price', 'rooms', 'min_area')
+
+# Последний вариант фильтра по комнатам - "5+ комнат"
+MAX_ROOMS = 5
+
+
+def rooms_q(rooms):
+    """Условие фильтра по комнатам; MAX_ROOMS и больше - один вариант"""
+    if int(rooms) >= MAX_ROOMS:
+        return Q(rooms__gte=MAX_ROOMS)
+    return Q(rooms=rooms)
+
+
+def max_price_q(max_price):
+    return Q(price__lte=max_price)
+
+
+def filter_posts(params, queryset=None, exclude=()):
+    """Применяет к активным объявлениям фильтры из параметров запроса.
+
+    Параметры из ``exclude`` пропускаются (фасет считается без своего фильтра).
+    """
+    if queryset is None:
+        queryset = Post.objects.filter(status='active')
+
+    # Поиск по тексту (через полнотекстовый индекс, с ранжированием)
+    search_query = params.get('q')
+    if search_query:
+        queryset = search_posts(queryset, search_query)
+
+    # Фильтр по цене
+    max_price = params.get('max_price')
+    if max_price and 'max_price' not in exclude:
+        queryset = queryset.filter(max_price_q(max_price))
+
+    # Фильтр по комнатам
+    rooms = params.get('rooms')
+    if rooms and rooms.isdigit() and 'rooms' not in exclude:
+        queryset = queryset.filter(rooms_q(rooms))
+
+    # Фильтр по площади
+    min_area = params.get('min_area')
+    if min_area:
+        queryset = queryset.filter(area__gte=min_area)
+
+    return queryset
+
+
+def get_sort(params):
+    """Сортировка из параметров (при поиске без явной сортировки - по релевантности)"""
+    sort = params.get('sort')
+    if sort in LISTING_SORTS:
+        return sort
+    return rank_sort() if params.get('q') else DEFAULT_SORT
@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from apartament import renditions
+from apartament.models import PostImage, Profile
+
+
+def _build(task, pk):
+    try:
+        return task(pk)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Строит недостающие уменьшенные копии фотографий объявлений и аватаров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        jobs = [
+            (renditions.build_post_image,
+             PostImage.objects.filter(renditions_ready=False).exclude(image='')),
+            (renditions.build_avatar,
+             Profile.objects.filter(avatar_renditions_ready=False).exclude(avatar='').exclude(avatar=None)),
+        ]
+        built = failed = 0
+        batch_size = options['batch_size']
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for task, queryset in jobs:
+                ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+                for start in range(0, len(ids), batch_size):
+                    futures = [executor.submit(_build, task, pk) for pk in ids[start:start + batch_size]]
+                    for future in futures:
+                        try:
+                            if future.result():
+                                built += 1
+                        except Exception as exc:
+                            failed += 1
+                            self.stderr.write(str(exc))
+        self.stdout.write(self.style.SUCCESS(f'Построено: {built}, ошибок: {failed}'))
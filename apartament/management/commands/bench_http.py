@@ -0,0 +1,75 @@
+import asyncio
+from statistics import median, quantiles
+from time import perf_counter
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный тест запущенного сервера: --concurrency клиентов одновременно '
+            'запрашивают страницу. --slow-client задерживает конец заголовков запроса, '
+            'как медленная мобильная сеть. Для сравнения WSGI и ASGI команда запускается '
+            'против gunicorn arenda.wsgi и uvicorn arenda.asgi:application')
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='Например, http://127.0.0.1:8000/1/')
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--slow-client', type=float, default=0.0,
+                            help='Секунд между началом и концом заголовков запроса')
+        parser.add_argument('--header', action='append', default=[],
+                            help='Дополнительный заголовок, например "Range: bytes=0-1023"')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        if url.scheme != 'http' or not url.hostname:
+            raise CommandError('Нужен адрес вида http://host:port/path')
+        started = perf_counter()
+        results = asyncio.run(self.run(url, options))
+        elapsed = perf_counter() - started
+
+        timings = sorted(duration for status, duration in results if status in (200, 206, 304))
+        errors = len(results) - len(timings)
+        self.stdout.write(f'Запросов: {len(results)}, ошибок: {errors}, за {elapsed:.2f} с')
+        if len(timings) > 1:
+            p95 = quantiles(timings, n=20)[-1]
+            self.stdout.write(
+                f'Задержка: медиана {median(timings) * 1000:.1f} мс, p95 {p95 * 1000:.1f} мс'
+            )
+        self.stdout.write(self.style.SUCCESS(f'Пропускная способность: {len(timings) / elapsed:.1f} запр/с'))
+
+    async def run(self, url, options):
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        path = url.path or '/'
+        if url.query:
+            path = f'{path}?{url.query}'
+
+        async def one():
+            async with semaphore:
+                try:
+                    return await self.fetch(url.hostname, url.port or 80, path, options['slow_client'],
+                                            options['header'])
+                except OSError:
+                    return 0, 0.0
+
+        return await asyncio.gather(*(one() for _ in range(options['requests'])))
+
+    async def fetch(self, host, port, path, delay, headers=()):
+        started = perf_counter()
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            extra = ''.join(f'{header}\r\n' for header in headers)
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: {host}\r\n{extra}'.encode())
+            await writer.drain()
+            if delay:
+                await asyncio.sleep(delay)
+            writer.write(b'Connection: close\r\n\r\n')
+            await writer.drain()
+            status_line = await reader.readline()
+            await reader.read()
+        finally:
+            writer.close()
+        parts = status_line.split()
+        status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+        return status, perf_counter() - started
@@ -0,0 +1,80 @@
+from datetime import timedelta
+from time import perf_counter
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+from django.urls import reverse
+from django.utils import timezone
+
+from apartament.models import Category, Post
+from apartament.pagination import CursorPage
+
+CARDS = 9  # объявлений на странице списка
+
+
+class Command(BaseCommand):
+    help = ('Замеряет время рендеринга main/index.html с 9 карточками: без кэша '
+            'фрагментов (новые ключи на каждом проходе) и из теплого кэша')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--user', help='Рендерить для пользователя с этим именем вместо гостя')
+
+    def handle(self, *args, **options):
+        request = RequestFactory().get(reverse('post-list'))
+        request.user = (
+            User.objects.get(username=options['user']) if options['user'] else AnonymousUser()
+        )
+        posts = self.sample_posts()
+        page = CursorPage(posts)
+        page.total = CARDS
+        context = {
+            'posts': page,
+            'facets': {'rooms': [], 'total': CARDS},
+            'active_posts': 1200,
+            'total_views': 345678,
+            'active_users': 420,
+            'new_today': 17,
+        }
+        iterations = options['iterations']
+
+        # Первый рендер компилирует шаблоны в кэширующем загрузчике
+        render_to_string('main/index.html', context, request=request)
+
+        # Холодный кэш фрагментов: сдвиг updated дает карточкам новые ключи
+        start = perf_counter()
+        for _ in range(iterations):
+            for post in posts:
+                post.updated += timedelta(microseconds=1)
+            render_to_string('main/index.html', context, request=request)
+        cold = (perf_counter() - start) / iterations * 1000
+
+        start = perf_counter()
+        for _ in range(iterations):
+            render_to_string('main/index.html', context, request=request)
+        warm = (perf_counter() - start) / iterations * 1000
+
+        self.stdout.write(f'Без кэша фрагментов: {cold:.2f} мс на страницу')
+        self.stdout.write(f'Из кэша фрагментов: {warm:.2f} мс на страницу')
+        self.stdout.write(self.style.SUCCESS(f'Ускорение: {cold / warm:.1f}x'))
+
+    def sample_posts(self):
+        """Объявления в памяти, без запросов к БД"""
+        now = timezone.now()
+        owner = User(pk=1, username='owner')
+        category = Category(pk=1, name='Квартира')
+        posts = []
+        for number in range(1, CARDS + 1):
+            post = Post(
+                pk=number, title=f'Светлая квартира рядом с метро номер {number}',
+                description='Просторная квартира после ремонта, вся мебель и техника. ' * 3,
+                price=30000 + number * 1000, rooms=number % 4 + 1, area=35 + number,
+                address=f'Москва, улица Примерная, дом {number}', status='active',
+                views=number * 10, owner=owner, category=category,
+                created=now - timedelta(days=number), updated=now,
+            )
+            post.images_count = number % 3
+            posts.append(post)
+        return posts
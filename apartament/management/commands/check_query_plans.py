@@ -0,0 +1,71 @@
+import re
+from itertools import combinations
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.http import QueryDict
+
+from apartament.facets import FACETED_PARAMS, facet_queryset
+from apartament.filters import filter_posts
+from apartament.pagination import LISTING_SORTS
+
+# Пример значений для фильтров страницы объявлений
+SAMPLE_FILTERS = {
+    'max_price': '50000',
+    'rooms': '2',
+    'min_area': '40',
+}
+
+# Признаки полного сканирования таблицы объявлений в плане запроса
+FULL_SCAN_PATTERNS = {
+    'sqlite': re.compile(r'SCAN apartament_post\b(?! USING (COVERING )?INDEX)'),
+    'postgresql': re.compile(r'Seq Scan on apartament_post\b'),
+}
+
+
+class Command(BaseCommand):
+    help = ('Проверяет через EXPLAIN, что все комбинации фильтров и сортировок '
+            'страницы объявлений используют индексы')
+
+    def handle(self, *args, **options):
+        pattern = FULL_SCAN_PATTERNS.get(connection.vendor)
+        if pattern is None:
+            raise CommandError(f'Проверка планов не поддерживается для {connection.vendor}')
+
+        failures = []
+        checked = 0
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                # На маленьких таблицах Postgres предпочитает seq scan даже при наличии индекса
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+            for name, queryset in self.listing_queries():
+                plan = queryset.explain()
+                checked += 1
+                if pattern.search(plan):
+                    failures.append((name, plan))
+            transaction.set_rollback(True)
+
+        for name, plan in failures:
+            self.stderr.write(f'Полное сканирование: {name}\n{plan}\n')
+        if failures:
+            raise CommandError(f'Запросов без индекса: {len(failures)} из {checked}')
+        self.stdout.write(self.style.SUCCESS(f'Все {checked} запросов используют индексы'))
+
+    def listing_queries(self):
+        names = list(SAMPLE_FILTERS)
+        for size in range(len(names) + 1):
+            for combo in combinations(names, size):
+                params = QueryDict(mutable=True)
+                for name in combo:
+                    params[name] = SAMPLE_FILTERS[name]
+                queryset = filter_posts(params)
+                label = ', '.join(combo) or 'без фильтров'
+                for sort in LISTING_SORTS:
+                    prefix = '-' if sort.startswith('-') else ''
+                    page = queryset.order_by(sort, f'{prefix}pk')[:10]
+                    yield f'{label}; sort={sort}', page
+                # Сгруппированный запрос фасетов (и надписи "Найдено")
+                yield f'{label}; facets', facet_queryset(
+                    filter_posts(params, exclude=FACETED_PARAMS), params
+                )
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apartament.models import ImageUpload
+from apartament.uploads import discard_upload
+
+
+class Command(BaseCommand):
+    help = 'Удаляет незавершенные загрузки изображений и их временные файлы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        uploads = ImageUpload.objects.filter(created__lt=cutoff)
+        count = 0
+        for upload in uploads.iterator():
+            discard_upload(upload)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'Удалено загрузок: {count}'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from apartament import search
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает полнотекстовый индекс объявлений'
+
+    def handle(self, *args, **options):
+        if not search.ensure_search_index():
+            self.stderr.write('Поисковый индекс не поддерживается этой базой данных')
+            return
+        count = search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'Проиндексировано объявлений: {count}'))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from apartament.models import OwnerStats
+from apartament.stats import reconcile_owner_stats, reconcile_site_stats
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счетчики главной страницы и владельцев (запускать периодически, например из cron)'
+
+    def handle(self, *args, **options):
+        stats = reconcile_site_stats()
+        self.stdout.write(self.style.SUCCESS(
+            f'Просмотры: {stats.total_views}, пользователи: {stats.active_users}, '
+            f'новых за {stats.today}: {stats.new_today}'
+        ))
+
+        # Пересчитываются только уже созданные строки владельцев, остальные создаются при чтении
+        owner_ids = list(OwnerStats.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(owner_ids), BATCH_SIZE):
+            reconcile_owner_stats(owner_ids[start:start + BATCH_SIZE])
+        self.stdout.write(self.style.SUCCESS(f'Владельцев пересчитано: {len(owner_ids)}'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from apartament.models import Post, refresh_post_covers
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает обложки и число фотографий у объявлений'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        ids = list(Post.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(ids), batch_size):
+            refresh_post_covers(ids[start:start + batch_size])
+        self.stdout.write(self.style.SUCCESS(f'Обновлено объявлений: {len(ids)}'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from apartament.moderation import resume_jobs
+
+
+class Command(BaseCommand):
+    help = 'Выполняет задачи модерации в очереди и продолжает брошенные после сбоя (например, из cron)'
+
+    def handle(self, *args, **options):
+        done = resume_jobs()
+        self.stdout.write(self.style.SUCCESS(f'Выполнено задач: {done}'))
@@ -0,0 +1,159 @@
+# media.py
+"""Отдача загруженных файлов (/media/).
+
+``MEDIA_SERVE_MODE`` выбирает способ:
+
+* ``'x-accel'`` - ответ без тела с заголовком ``X-Accel-Redirect``,
+  файл отдает nginx из internal-location ``MEDIA_ACCEL_PREFIX``;
+* ``'x-sendfile'`` - то же для Apache/lighttpd через ``X-Sendfile``;
+* ``'python'`` - файл отдает сам Django через ``FileResponse`` (на gunicorn
+  это ``sendfile``) с ETag, условными запросами и диапазонами байтов.
+
+При передаче прокси заголовок ``Range`` Django не разбирает: диапазоны
+отдает сам прокси. Путь в заголовках кодируется (``%D0%BA...``) - в HTTP
+заголовке допустим только latin-1, а имена файлов бывают кириллическими.
+
+Загруженные файлы никогда не перезаписываются (хранилище дает новому
+файлу новое имя), поэтому для ``MEDIA_IMMUTABLE_PREFIXES`` отдается
+долгий ``Cache-Control: immutable``.
+"""
+import mimetypes
+import os
+import re
+import stat
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _cache_control(path):
+    if path.startswith(tuple(_setting('MEDIA_IMMUTABLE_PREFIXES', ()))):
+        return IMMUTABLE_CACHE
+    return 'public, max-age=%d' % _setting('MEDIA_MAX_AGE', 86400)
+
+
+def _parse_range(header, size):
+    """Разбирает один диапазон байтов. None - диапазон не задан или не поддерживается"""
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # bytes=-500: последние 500 байт
+        length = int(end)
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    return start, end
+
+
+class _FileRange:
+    """Часть файла для FileResponse: чтение не выходит за конец диапазона.
+
+    ``fileno()`` оставлен ради sendfile: gunicorn отправляет Content-Length
+    байт с текущей позиции файла, то есть ровно диапазон.
+    """
+
+    def __init__(self, path, start, length):
+        self.file = open(path, 'rb')
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        chunk = self.file.read(size)
+        self.remaining -= len(chunk)
+        return chunk
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def serve_media(request, path):
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('Файл не найден')
+    try:
+        st = os.stat(fullpath)
+    except OSError:
+        raise Http404('Файл не найден')
+    if not stat.S_ISREG(st.st_mode):
+        raise Http404('Файл не найден')
+
+    etag = '"%x-%x-%x"' % (st.st_ino, st.st_mtime_ns, st.st_size)
+    mtime = int(st.st_mtime)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(mtime),
+        'Cache-Control': _cache_control(path),
+        'Accept-Ranges': 'bytes',
+    }
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=mtime)
+    if not_modified is not None:
+        for name, value in headers.items():
+            not_modified[name] = value
+        return not_modified
+
+    content_type, encoding = mimetypes.guess_type(fullpath)
+    content_type = content_type or 'application/octet-stream'
+
+    mode = _setting('MEDIA_SERVE_MODE', 'python')
+    if mode in ('x-accel', 'x-sendfile'):
+        response = HttpResponse(content_type=content_type)
+        if mode == 'x-accel':
+            response['X-Accel-Redirect'] = quote(_setting('MEDIA_ACCEL_PREFIX', '/protected-media/') + path)
+        else:
+            response['X-Sendfile'] = quote(fullpath)
+    else:
+        response = _python_response(request, fullpath, st.st_size, content_type, etag, mtime)
+
+    for name, value in headers.items():
+        response[name] = value
+    if encoding:
+        response['Content-Encoding'] = encoding
+    return response
+
+
+def _python_response(request, fullpath, size, content_type, etag, mtime):
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and if_range and if_range != etag and parse_http_date_safe(if_range) != mtime:
+        # Файл изменился с момента первой части - отдаем целиком
+        range_header = None
+
+    byte_range = _parse_range(range_header, size) if range_header else None
+    if byte_range is None:
+        response = FileResponse(open(fullpath, 'rb'), content_type=content_type)
+        response['Content-Length'] = size
+        return response
+
+    start, end = byte_range
+    if start >= size or start > end:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+    length = end - start + 1
+    response = FileResponse(_FileRange(fullpath, start, length), status=206, content_type=content_type)
+    response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = length
+    return response
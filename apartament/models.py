@@ -1,8 +1,118 @@
 # models.py
-from django.db import models
+import uuid
+
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.urls import reverse
-from django.core.validators import FileExtensionValidator
+from django.core.validators import FileExtensionValidator, RegexValidator
+from django.db.models.functions import Coalesce
+
+class ChangeTrackingModel(models.Model):
+    """Модель, которая записывает в БД только изменившиеся поля.
+
+    Значения полей запоминаются при загрузке из БД, после ``refresh_from_db()``
+    (в том числе при догрузке отложенного поля) и после каждого сохранения.
+    ``save()`` без ``update_fields`` у существующей строки сам подставляет
+    в ``update_fields`` измененные поля (и поля ``auto_now``), а если ничего
+    не изменилось - не выполняет запрос и не посылает сигналы.
+    Во время сохранения ``changed_fields`` содержит имена записываемых полей,
+    а ``loaded_value()`` - значение поля до сохранения.
+
+    Прежние значения полей из ``tracked_fields`` нужны сигналам. Если такое
+    поле не загружалось (``only()``/``defer()``), а теперь записывается,
+    его прежнее значение перечитывается из БД перед сохранением.
+    """
+    changed_fields = frozenset()
+    tracked_fields = ()
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        # Иначе значение, возвращенное к прежнему, сочтется неизменным и не запишется
+        self._snapshot(None if fields is None else set(fields))
+
+    def _snapshot(self, names=None):
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None or names is None:
+            loaded = self._loaded_values = {}
+        for field in self._meta.concrete_fields:
+            if field.attname not in self.__dict__:
+                continue
+            if names is not None and field.name not in names and field.attname not in names:
+                continue
+            value = getattr(self, field.attname)
+            # Для файлов храним имя, а не сам FieldFile
+            loaded[field.attname] = getattr(value, 'name', value)
+
+    def _load_tracked(self):
+        if self.pk is None:
+            return
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None:
+            loaded = self._loaded_values = {}
+        missing = [
+            field.attname for field in map(self._meta.get_field, self.tracked_fields)
+            if field.name in self.changed_fields and field.attname not in loaded
+        ]
+        if missing:
+            row = type(self)._base_manager.filter(pk=self.pk).values(*missing).first()
+            if row is not None:
+                loaded.update(row)
+
+    def loaded_value(self, name):
+        """Значение поля, загруженное из БД (None у новой записи)"""
+        field = self._meta.get_field(name)
+        return getattr(self, '_loaded_values', {}).get(field.attname)
+
+    def get_changed_fields(self):
+        """Имена полей, изменившихся с загрузки; None - запись еще не сохранялась"""
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None or self._state.adding:
+            return None
+        changed = set()
+        for field in self._meta.concrete_fields:
+            if field.primary_key or field.attname not in self.__dict__:
+                continue
+            value = getattr(self, field.attname)
+            if field.attname not in loaded or getattr(value, 'name', value) != loaded[field.attname]:
+                changed.add(field.name)
+        return changed
+
+    def has_changed(self, name):
+        changed = self.get_changed_fields()
+        return changed is None or name in changed
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        changed = None
+        if not args and update_fields is None and not kwargs.get('force_insert'):
+            changed = self.get_changed_fields()
+        if changed is not None:
+            if not changed:
+                return
+            auto_now = {
+                field.name for field in self._meta.concrete_fields
+                if getattr(field, 'auto_now', False)
+            }
+            kwargs['update_fields'] = update_fields = changed | auto_now
+        if update_fields is not None:
+            self.changed_fields = frozenset(update_fields)
+        else:
+            self.changed_fields = frozenset(field.name for field in self._meta.concrete_fields)
+        self._load_tracked()
+        try:
+            super().save(*args, **kwargs)
+        finally:
+            self.changed_fields = frozenset()
+        self._snapshot(None if update_fields is None else set(update_fields))
 
 class Category(models.Model):
     name = models.CharField(max_length=100, verbose_name='Название категории')
@@ -16,7 +126,9 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
-class Post(models.Model):
+class Post(ChangeTrackingModel):
+    tracked_fields = ('status', 'owner')
+
     STATUS_CHOICES = [
         ('draft', 'Черновик'),
         ('moderation', 'На модерации'),
@@ -41,6 +153,28 @@ class Post(models.Model):
         verbose_name='Статус'
     )
     views = models.PositiveIntegerField(default=0, verbose_name='Просмотры')
+    # Денормализованные данные об изображениях, см. refresh_post_covers
+    cover = models.ForeignKey(
+        'PostImage',
+        related_name='+',
+        null=True,
+        blank=True,
+        editable=False,
+        on_delete=models.SET_NULL,
+        verbose_name='Обложка'
+    )
+    images_count = models.PositiveIntegerField(default=0, editable=False, verbose_name='Количество фото')
+    # Аренда объявления модератором в очереди модерации (см. moderation.py)
+    claimed_by = models.ForeignKey(
+        User,
+        related_name='+',
+        null=True,
+        blank=True,
+        editable=False,
+        on_delete=models.SET_NULL,
+        verbose_name='Взято модератором'
+    )
+    claim_expires = models.DateTimeField(null=True, blank=True, editable=False, verbose_name='Аренда до')
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
@@ -48,19 +182,76 @@ class Post(models.Model):
         app_label = 'apartament'
         verbose_name = 'Объявление'
         verbose_name_plural = "Объявления"
+        # Все публичные выборки начинаются с status='active', поэтому статус идет первым
+        indexes = [
+            models.Index(fields=['status', 'created'], name='post_status_created_idx'),
+            models.Index(fields=['status', 'price'], name='post_status_price_idx'),
+            models.Index(fields=['status', 'rooms', 'area'], name='post_status_rooms_area_idx'),
+            models.Index(fields=['status', 'views'], name='post_status_views_idx'),
+            models.Index(fields=['owner', 'status'], name='post_owner_status_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
     def increment_views(self):
-        """Увеличивает счетчик просмотров"""
+        """Увеличивает счетчик просмотров (запись в БД идет пакетами)"""
+        from .counters import view_counter
+
+        view_counter.add(self.pk)
         self.views += 1
-        self.save(update_fields=['views'])
 
     def get_absolute_url(self):
         return reverse('post-detail', kwargs={'pk': self.pk})
 
-class Comment(models.Model):
+class SiteStats(models.Model):
+    """Счетчики главной страницы, которые обновляются инкрементально"""
+    active_posts = models.IntegerField(default=0, verbose_name='Активные объявления')
+    total_views = models.BigIntegerField(default=0, verbose_name='Просмотры активных объявлений')
+    active_users = models.IntegerField(default=0, verbose_name='Активные пользователи')
+    new_today = models.IntegerField(default=0, verbose_name='Новых за день')
+    today = models.DateField(null=True, verbose_name='День для счетчика новых')
+    reconciled = models.DateTimeField(null=True, verbose_name='Последняя сверка')
+
+    class Meta:
+        app_label = 'apartament'
+        verbose_name = 'Статистика сайта'
+        verbose_name_plural = "Статистика сайта"
+
+    def __str__(self):
+        return f'Статистика на {self.today}'
+
+class OwnerStats(models.Model):
+    """Счетчики владельца объявлений для панели управления и профиля (см. stats.py)"""
+    user = models.OneToOneField(
+        User,
+        primary_key=True,
+        related_name='owner_stats',
+        on_delete=models.CASCADE,
+        verbose_name='Пользователь'
+    )
+    total_posts = models.IntegerField(default=0, verbose_name='Всего объявлений')
+    active_posts = models.IntegerField(default=0, verbose_name='Активные')
+    moderation_posts = models.IntegerField(default=0, verbose_name='На модерации')
+    draft_posts = models.IntegerField(default=0, verbose_name='Черновики')
+    rejected_posts = models.IntegerField(default=0, verbose_name='Отклоненные')
+    archived_posts = models.IntegerField(default=0, verbose_name='Архивные')
+    total_views = models.BigIntegerField(default=0, verbose_name='Просмотры объявлений')
+    comments_received = models.IntegerField(default=0, verbose_name='Активные комментарии к объявлениям')
+    comments_written = models.IntegerField(default=0, verbose_name='Написано комментариев')
+    reconciled = models.DateTimeField(null=True, verbose_name='Последняя сверка')
+
+    class Meta:
+        app_label = 'apartament'
+        verbose_name = 'Статистика владельца'
+        verbose_name_plural = "Статистика владельцев"
+
+    def __str__(self):
+        return f'Статистика {self.user_id}'
+
+class Comment(ChangeTrackingModel):
+    tracked_fields = ('active',)
+
     post = models.ForeignKey(Post, related_name='comments', on_delete=models.CASCADE)
     owner = models.ForeignKey(User, related_name='comments', on_delete=models.CASCADE)
     content = models.TextField(default='', verbose_name='Текст комментария')
@@ -72,11 +263,18 @@ class Comment(models.Model):
         app_label = 'apartament'
         verbose_name = 'Комментарий'
         verbose_name_plural = "Комментарии"
+        # Частичный индекс: на SQLite active=True компилируется в "WHERE active" без
+        # сравнения, и колонка active в обычном индексе не использовалась бы
+        indexes = [
+            models.Index(
+                fields=['post', 'created'], condition=models.Q(active=True), name='comment_post_active_idx'
+            ),
+        ]
 
     def __str__(self):
         return f'Комментарий от {self.owner}'
     
-class Profile(models.Model):
+class Profile(ChangeTrackingModel):
     user = models.OneToOneField(
         User, 
         on_delete=models.CASCADE,
@@ -107,6 +305,11 @@ class Profile(models.Model):
         blank=True,
         verbose_name='Дата рождения'
     )
+    avatar_renditions_ready = models.BooleanField(
+        default=False,
+        editable=False,
+        verbose_name='Копии аватара готовы'
+    )
     created = models.DateTimeField(
         auto_now_add=True,
         verbose_name='Дата создания'
@@ -123,8 +326,14 @@ class Profile(models.Model):
 
     def __str__(self):
         return f'Профиль {self.user.username}'
+
+    def save(self, *args, **kwargs):
+        # Новый аватар - копии нужно построить заново
+        if self.has_changed('avatar'):
+            self.avatar_renditions_ready = False
+        super().save(*args, **kwargs)
     
-class PostImage(models.Model):
+class PostImage(ChangeTrackingModel):
     post = models.ForeignKey(
         Post, 
         related_name='images', 
@@ -139,6 +348,7 @@ class PostImage(models.Model):
         ]
     )
     is_main = models.BooleanField(default=False, verbose_name='Основное изображение')
+    renditions_ready = models.BooleanField(default=False, editable=False, verbose_name='Копии готовы')
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
@@ -147,19 +357,153 @@ class PostImage(models.Model):
         verbose_name = 'Изображение объявления'
         verbose_name_plural = "Изображения объявлений"
         ordering = ['-is_main', 'created']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['post'],
+                condition=models.Q(is_main=True),
+                name='one_main_image_per_post',
+            ),
+        ]
 
     def __str__(self):
         return f"Изображение для {self.post.title}"
 
+    def get_constraints(self):
+        # Флаг с прежнего основного изображения снимает save(), поэтому
+        # ограничение "одно основное" проверяет только база, а не формы
+        return [
+            (model, [c for c in constraints if c.name != 'one_main_image_per_post'])
+            for model, constraints in super().get_constraints()
+        ]
+
     def save(self, *args, **kwargs):
-        # Если это основное изображение, снимаем флаг с других изображений этого поста
-        if self.is_main:
-            PostImage.objects.filter(post=self.post, is_main=True).update(is_main=False)
-        super().save(*args, **kwargs)
+        # Новый файл - копии нужно построить заново
+        if self.has_changed('image'):
+            self.renditions_ready = False
+        with transaction.atomic():
+            # Если это основное изображение, снимаем флаг с других изображений этого поста
+            if self.is_main and self.has_changed('is_main'):
+                PostImage.objects.filter(
+                    post_id=self.post_id, is_main=True
+                ).exclude(pk=self.pk).update(is_main=False)
+            super().save(*args, **kwargs)
+
+class ImageUpload(models.Model):
+    """Незавершенная загрузка фотографии по частям (см. uploads.py)"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    post = models.ForeignKey(Post, related_name='uploads', on_delete=models.CASCADE)
+    owner = models.ForeignKey(User, related_name='image_uploads', on_delete=models.CASCADE)
+    # FileExtensionValidator ждет файл, а здесь только имя
+    filename = models.CharField(
+        max_length=255,
+        validators=[
+            RegexValidator(
+                r'(?i)\.(jpg|jpeg|png|gif|webp)$',
+                message='Допустимы файлы jpg, jpeg, png, gif и webp',
+            )
+        ]
+    )
+    size = models.PositiveBigIntegerField(verbose_name='Размер файла')
+    received = models.PositiveBigIntegerField(default=0, verbose_name='Получено байт')
+    is_main = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        app_label = 'apartament'
+        verbose_name = 'Загрузка изображения'
+        verbose_name_plural = "Загрузки изображений"
+
+    def __str__(self):
+        return f'{self.filename} ({self.received}/{self.size})'
+
+    @property
+    def is_complete(self):
+        return self.received == self.size
+
+class ModerationJob(models.Model):
+    """Массовое действие модерации, которое выполняется в фоне частями (см. moderation.py)"""
+    ACTION_CHOICES = [
+        ('approve_posts', 'Одобрить объявления'),
+        ('reject_posts', 'Отклонить объявления'),
+        ('activate_comments', 'Активировать комментарии'),
+        ('deactivate_comments', 'Деактивировать комментарии'),
+    ]
+    STATUS_CHOICES = [
+        ('pending', 'В очереди'),
+        ('running', 'Выполняется'),
+        ('done', 'Завершено'),
+        ('failed', 'Ошибка'),
+    ]
+
+    action = models.CharField(max_length=30, choices=ACTION_CHOICES, verbose_name='Действие')
+    # id объектов по возрастанию; обработаны первые processed из них
+    object_ids = models.JSONField(default=list, verbose_name='Объекты')
+    total = models.PositiveIntegerField(default=0, verbose_name='Всего')
+    processed = models.PositiveIntegerField(default=0, verbose_name='Обработано')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name='Статус')
+    error = models.TextField(blank=True, default='', verbose_name='Ошибка')
+    created_by = models.ForeignKey(
+        User,
+        related_name='+',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        verbose_name='Запустил'
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    heartbeat = models.DateTimeField(null=True, blank=True, verbose_name='Последняя активность')
+
+    class Meta:
+        app_label = 'apartament'
+        verbose_name = 'Задача модерации'
+        verbose_name_plural = "Задачи модерации"
+        ordering = ['-created']
+        indexes = [
+            models.Index(fields=['status', 'heartbeat'], name='moderation_job_status_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.get_action_display()} ({self.processed}/{self.total})'
+
+    @property
+    def progress(self):
+        return round(100 * self.processed / self.total) if self.total else 100
+
+def set_main_images(choices):
+    """Переключает основные изображения: {post_id: image_id или None}.
+
+    Одна короткая транзакция из двух UPDATE на любое число объявлений:
+    сначала снимается флаг с прежних основных изображений, затем
+    ставится новым, так что ограничение one_main_image_per_post не нарушается.
+    """
+    new_main = models.Q(pk__in=[])
+    for post_id, image_id in choices.items():
+        if image_id is not None:
+            new_main |= models.Q(post_id=post_id, pk=image_id)
+    with transaction.atomic():
+        PostImage.objects.filter(post_id__in=list(choices), is_main=True).exclude(new_main).update(is_main=False)
+        PostImage.objects.filter(new_main, is_main=False).update(is_main=True)
+        refresh_post_covers(list(choices))
+    page_cache.invalidate_posts(list(choices))
+
+def refresh_post_covers(post_ids):
+    """Пересчитывает обложку и число фотографий для объявлений одним UPDATE"""
+    images = PostImage.objects.filter(post=models.OuterRef('pk'))
+    first_image = images.order_by('-is_main', 'created', 'pk').values('pk')[:1]
+    image_count = images.order_by().values('post').annotate(
+        total=models.Count('pk')
+    ).values('total')
+    Post.objects.filter(pk__in=post_ids).update(
+        cover=models.Subquery(first_image),
+        images_count=Coalesce(models.Subquery(image_count), 0),
+    )
 
 # Сигнал для автоматического создания профиля при создании пользователя
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_delete, post_delete, post_migrate
 from django.dispatch import receiver
+from . import search, stats
+from . import cache as page_cache
+from . import renditions
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -167,5 +511,137 @@ def create_user_profile(sender, instance, created, **kwargs):
         Profile.objects.create(user=instance)
 
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    instance.profile.save()
\ No newline at end of file
+def save_user_profile(sender, instance, update_fields=None, **kwargs):
+    # При входе сохраняется только last_login - профиль не менялся
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    # Профиль, который не загружали, не мог измениться
+    if not User.profile.is_cached(instance):
+        return
+    instance.profile.save()
+
+# Синхронизация поискового индекса с объявлениями
+@receiver(post_migrate)
+def create_search_index(sender, **kwargs):
+    if sender.name == 'apartament':
+        search.ensure_search_index()
+
+@receiver(post_save, sender=Post)
+def index_post(sender, instance, update_fields=None, **kwargs):
+    # Сохранения, которые не затрагивают текст (статус, просмотры), индекс не меняют
+    if update_fields and not set(update_fields) & {'title', 'description', 'address'}:
+        return
+    search.index_post(instance)
+
+@receiver(post_delete, sender=Post)
+def unindex_post(sender, instance, **kwargs):
+    search.unindex_post(instance.pk)
+
+# Инкрементальное обновление статистики главной страницы
+@receiver(post_save, sender=Post)
+def update_site_stats(sender, instance, created, **kwargs):
+    if created:
+        stats.post_status_changed(instance, None)
+        return
+    # Статус, который не записывался, не менялся (и мог быть не загружен)
+    if 'status' not in instance.changed_fields:
+        return
+    previous = instance.loaded_value('status')
+    if previous != instance.status:
+        stats.post_status_changed(instance, previous)
+
+@receiver(post_delete, sender=Post)
+def update_site_stats_on_delete(sender, instance, **kwargs):
+    if instance.status == 'active':
+        stats.post_status_changed(instance, 'active', deleted=True)
+
+# Инкрементальное обновление статистики владельцев
+@receiver(post_save, sender=Post)
+def update_owner_stats(sender, instance, created, **kwargs):
+    if created:
+        stats.owner_post_added(instance)
+        return
+    # Как и в update_site_stats: незаписанные поля не менялись
+    previous_owner = instance.loaded_value('owner')
+    if 'owner' in instance.changed_fields and previous_owner != instance.owner_id:
+        stats.reconcile_owner_stats([
+            owner_id for owner_id in (previous_owner, instance.owner_id) if owner_id is not None
+        ])
+        return
+    if 'status' not in instance.changed_fields:
+        return
+    previous_status = instance.loaded_value('status')
+    if previous_status != instance.status:
+        stats.owner_post_status_changed(instance, previous_status)
+
+@receiver(pre_delete, sender=Post)
+def count_comments_before_delete(sender, instance, **kwargs):
+    # После удаления комментарии объявления уже не посчитать, а просмотры
+    # в памяти могут отставать от записанных счетчиком через F()
+    row = Post.objects.filter(pk=instance.pk).annotate(
+        active_comments=models.Count('comments', filter=models.Q(comments__active=True))
+    ).values_list('views', 'active_comments').first()
+    if row is not None:
+        instance.views, instance._active_comments = row
+
+@receiver(post_delete, sender=Post)
+def update_owner_stats_on_delete(sender, instance, **kwargs):
+    stats.owner_post_deleted(instance, getattr(instance, '_active_comments', 0))
+
+@receiver(post_save, sender=Comment)
+def update_owner_stats_on_comment(sender, instance, created, **kwargs):
+    if not created and 'active' not in instance.changed_fields:
+        return
+    previous = None if created else instance.loaded_value('active')
+    if created or previous != instance.active:
+        stats.owner_comment_changed(instance, created=created, previous_active=previous)
+
+@receiver(post_delete, sender=Comment)
+def update_owner_stats_on_comment_delete(sender, instance, origin=None, **kwargs):
+    # Комментарии удаляемого объявления учитывает update_owner_stats_on_delete
+    stats.owner_comment_deleted(instance, with_post=isinstance(origin, Post))
+
+# Обложка и счетчик фотографий объявления
+@receiver(post_save, sender=PostImage)
+def refresh_cover_on_save(sender, instance, **kwargs):
+    refresh_post_covers([instance.post_id])
+
+@receiver(post_delete, sender=PostImage)
+def refresh_cover_on_delete(sender, instance, origin=None, **kwargs):
+    # При удалении самого объявления пересчитывать нечего
+    if isinstance(origin, Post):
+        return
+    refresh_post_covers([instance.post_id])
+
+# Сброс кэша страниц для анонимных посетителей
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def invalidate_post_pages(sender, instance, **kwargs):
+    page_cache.invalidate_posts([instance.pk])
+
+@receiver(post_save, sender=PostImage)
+@receiver(post_delete, sender=PostImage)
+def invalidate_image_pages(sender, instance, **kwargs):
+    page_cache.invalidate_posts([instance.post_id])
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_comment_pages(sender, instance, **kwargs):
+    # В списке объявлений выводится число комментариев
+    page_cache.invalidate_posts([instance.post_id])
+
+# Построение уменьшенных копий изображений в фоне
+@receiver(post_save, sender=PostImage)
+def build_post_image_renditions(sender, instance, **kwargs):
+    if instance.image and not instance.renditions_ready:
+        renditions.schedule(renditions.build_post_image, instance.pk)
+
+@receiver(post_delete, sender=PostImage)
+def delete_post_image_renditions(sender, instance, **kwargs):
+    if instance.image and instance.renditions_ready:
+        renditions.delete(instance.image, renditions.POST_IMAGE_SIZES)
+
+@receiver(post_save, sender=Profile)
+def build_avatar_renditions(sender, instance, **kwargs):
+    if instance.avatar and not instance.avatar_renditions_ready:
+        renditions.schedule(renditions.build_avatar, instance.pk)
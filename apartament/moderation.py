@@ -0,0 +1,216 @@
+# moderation.py
+"""Очередь модерации и массовые действия модерации в фоне.
+
+Очередь: модератор берет в аренду (``claim_batch``) партию самых старых
+объявлений на модерации. Пока аренда ``MODERATION_LEASE`` не истекла,
+другим модераторам эти объявления не выдаются; истекшая аренда просто
+перестает учитываться, отдельная очистка не нужна. На PostgreSQL партия
+выбирается через ``SELECT ... FOR UPDATE SKIP LOCKED``, поэтому модераторы
+не ждут друг друга; на SQLite запись и так идет под блокировкой базы, и
+партия берется одним ``UPDATE`` с подзапросом.
+
+Массовые действия:
+
+Действие админки не меняет строки в запросе, а создает ``ModerationJob``
+со списком id и ставит его в пул потоков. Задача обрабатывает id частями
+по ``MODERATION_CHUNK_SIZE``: каждая часть - отдельная короткая транзакция,
+в которой вместе с ``update()`` пересчитывается статистика владельцев
+и сдвигается счетчик ``processed``. После фиксации части сбрасывается кэш
+страниц затронутых объявлений - по одному разу на часть, а не сигналом
+на каждую строку.
+
+Если процесс упал, незафиксированная часть откатывается целиком, а
+задача с устаревшим ``heartbeat`` продолжается с ``processed`` командой
+``run_moderation_jobs`` или действием "Продолжить" в админке. Задачу,
+остановившуюся с ошибкой, продолжает только действие админки.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import cache as page_cache
+from .models import Comment, ModerationJob, Post
+from .stats import reconcile_owner_stats, reconcile_site_stats
+
+logger = logging.getLogger(__name__)
+
+# Действие -> (модель, значения для update())
+ACTIONS = {
+    'approve_posts': (Post, {'status': 'active'}),
+    'reject_posts': (Post, {'status': 'rejected'}),
+    'activate_comments': (Comment, {'active': True}),
+    'deactivate_comments': (Comment, {'active': False}),
+}
+
+_executor = None
+
+
+class JobConflict(Exception):
+    """Задачу продвинул другой исполнитель"""
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def claim_batch(user, size=None):
+    """Продлевает аренду модератора и добирает партию до ``size`` объявлений"""
+    size = size or _setting('MODERATION_BATCH_SIZE', 20)
+    now = timezone.now()
+    lease = now + timedelta(seconds=_setting('MODERATION_LEASE', 600))
+    queue = Post.objects.filter(status='moderation')
+    with transaction.atomic():
+        held = queue.filter(claimed_by=user, claim_expires__gt=now).update(claim_expires=lease)
+        if held < size:
+            free = queue.filter(
+                Q(claim_expires__isnull=True) | Q(claim_expires__lte=now)
+            ).order_by('created', 'pk')
+            if connections[DEFAULT_DB_ALIAS].vendor == 'postgresql':
+                ids = list(free.select_for_update(skip_locked=True).values_list('pk', flat=True)[:size - held])
+                Post.objects.filter(pk__in=ids).update(claimed_by=user, claim_expires=lease)
+            else:
+                Post.objects.filter(pk__in=free.values('pk')[:size - held]).update(
+                    claimed_by=user, claim_expires=lease
+                )
+    return claimed_posts(user)
+
+
+def claimed_posts(user):
+    """Объявления, которые модератор держит в аренде, от старых к новым"""
+    return Post.objects.filter(
+        status='moderation', claimed_by=user, claim_expires__gt=timezone.now()
+    ).select_related('owner', 'category', 'cover').order_by('created', 'pk')
+
+
+def decide(user, post_id, status):
+    """Решение по взятому объявлению. False - аренда истекла или решение уже принято"""
+    with transaction.atomic():
+        post = Post.objects.select_for_update().filter(
+            pk=post_id, status='moderation', claimed_by=user, claim_expires__gt=timezone.now()
+        ).first()
+        if post is None:
+            return False
+        post.status = status
+        post.claimed_by = None
+        post.claim_expires = None
+        # Обычное сохранение: сигналы обновят статистику, поиск и кэш страниц
+        post.save()
+    return True
+
+
+def release(user):
+    """Возвращает в очередь все объявления, взятые модератором"""
+    return Post.objects.filter(status='moderation', claimed_by=user).update(
+        claimed_by=None, claim_expires=None
+    )
+
+
+def start_job(action, queryset, user=None):
+    """Создает задачу для объектов queryset и ставит ее в очередь"""
+    ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+    job = ModerationJob.objects.create(
+        action=action, object_ids=ids, total=len(ids), created_by=user
+    )
+    schedule(job.pk)
+    return job
+
+
+def _affected(model, ids):
+    """id объявлений и владельцев, которых касается часть задачи"""
+    if model is Post:
+        rows = Post.objects.filter(pk__in=ids).values_list('pk', 'owner_id')
+    else:
+        rows = Comment.objects.filter(pk__in=ids).values_list('post_id', 'post__owner_id')
+    rows = list(rows)
+    return {post_id for post_id, _ in rows}, {owner_id for _, owner_id in rows}
+
+
+def _process_chunk(job, ids):
+    model, values = ACTIONS[job.action]
+    with transaction.atomic():
+        # Владельцы читаются в той же транзакции, что и меняются строки
+        post_ids, owner_ids = _affected(model, ids)
+        model.objects.filter(pk__in=ids).update(updated=timezone.now(), **values)
+        # Пакетные хуки вместо сигналов post_save на каждую строку
+        reconcile_owner_stats(owner_ids)
+        moved = ModerationJob.objects.filter(pk=job.pk, processed=job.processed).update(
+            processed=F('processed') + len(ids), heartbeat=timezone.now()
+        )
+        if not moved:
+            raise JobConflict
+    page_cache.invalidate_posts(post_ids)
+    job.processed += len(ids)
+
+
+def claimable_q(now=None):
+    """Условие на задачи, которые можно взять: новые и брошенные упавшим исполнителем"""
+    stale = (now or timezone.now()) - timedelta(seconds=_setting('MODERATION_STALE_AFTER', 300))
+    return Q(status='pending') | Q(status='running', heartbeat__lt=stale)
+
+
+def _claim(job_id):
+    """Берет задачу в работу, если ее никто не выполняет"""
+    now = timezone.now()
+    return ModerationJob.objects.filter(claimable_q(now), pk=job_id).update(
+        status='running', heartbeat=now, error=''
+    )
+
+
+def run_job(job_id):
+    """Выполняет задачу с места, где она остановилась. False - задача не выполнялась"""
+    if not _claim(job_id):
+        return False
+    job = ModerationJob.objects.get(pk=job_id)
+    size = _setting('MODERATION_CHUNK_SIZE', 500)
+    started_at = job.processed
+    try:
+        try:
+            while job.processed < job.total:
+                _process_chunk(job, job.object_ids[job.processed:job.processed + size])
+        finally:
+            # Число активных пользователей инкрементально не посчитать - сверяем
+            # один раз, в том числе после части задачи, зафиксированной до ошибки
+            if ACTIONS[job.action][0] is Post and job.processed > started_at:
+                reconcile_site_stats()
+    except JobConflict:
+        return False
+    except Exception as error:
+        logger.exception('Задача модерации %s остановилась с ошибкой', job_id)
+        ModerationJob.objects.filter(pk=job_id).update(status='failed', error=str(error))
+        return False
+    ModerationJob.objects.filter(pk=job_id).update(status='done', heartbeat=timezone.now())
+    return True
+
+
+def resume_jobs():
+    """Выполняет задачи в очереди и брошенные задачи. Возвращает число выполненных"""
+    job_ids = ModerationJob.objects.filter(claimable_q()).order_by('created').values_list('pk', flat=True)
+    return sum(run_job(job_id) for job_id in list(job_ids))
+
+
+def _run(job_id):
+    close_old_connections()
+    try:
+        run_job(job_id)
+    finally:
+        close_old_connections()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='moderation')
+    return _executor
+
+
+def schedule(job_id):
+    """Ставит задачу в фоновый поток после фиксации транзакции"""
+    if not _setting('MODERATION_ASYNC', True):
+        transaction.on_commit(lambda: run_job(job_id))
+        return
+    transaction.on_commit(lambda: _get_executor().submit(_run, job_id))
@@ -0,0 +1,210 @@
+# pagination.py
+"""Постраничный вывод по курсору (keyset-пагинация).
+
+Вместо ``COUNT(*)`` и растущего ``OFFSET`` следующая страница выбирается
+условием ``(поле, id) < (значение, id)`` по последней записи текущей
+страницы, поэтому стоимость запроса не зависит от глубины.
+"""
+import base64
+import binascii
+import json
+import math
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination
+
+# Допустимые сортировки страницы объявлений
+LISTING_SORTS = ('-created', 'created', 'price', '-price', '-views')
+DEFAULT_SORT = '-created'
+
+
+def encode_cursor(payload):
+    data = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Разбирает курсор; для поврежденного курсора возвращает None"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, binascii.Error):
+        return None
+    if not isinstance(payload, dict) or not {'v', 'id', 'd'} <= payload.keys():
+        return None
+    return payload
+
+
+class CursorPage:
+    """Страница результатов с курсорами на соседние страницы"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.next_query = ''
+        self.previous_query = ''
+        self.total = None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def _split_sort(sort):
+    return (sort[1:], True) if sort.startswith('-') else (sort, False)
+
+
+def _dump_value(queryset, name, obj):
+    value = getattr(obj, name)
+    try:
+        field = queryset.model._meta.get_field(name)
+    except FieldDoesNotExist:
+        # Аннотация (например, ранг поиска) - число, сериализуется как есть
+        return value
+    return field.value_to_string(obj)
+
+
+def _load_value(queryset, name, raw):
+    """Значение из курсора в типе поля; для подделанного курсора - ValidationError"""
+    try:
+        field = queryset.model._meta.get_field(name)
+    except FieldDoesNotExist:
+        # Аннотация (ранг поиска) - только конечное число
+        if isinstance(raw, bool) or not isinstance(raw, (int, float)) or not math.isfinite(raw):
+            raise ValidationError('Неверное значение курсора')
+        return float(raw)
+    return _to_python(field, raw)
+
+
+def _to_python(field, raw):
+    try:
+        value = field.to_python(raw)
+    except (TypeError, ValueError):
+        raise ValidationError('Неверное значение курсора')
+    # Поля сортировки не бывают пустыми
+    if value is None:
+        raise ValidationError('Неверное значение курсора')
+    return value
+
+
+def paginate_by_cursor(queryset, sort, cursor=None, per_page=9, params=None):
+    """Возвращает CursorPage для queryset, упорядоченного по ``sort`` и id.
+
+    ``params`` - QueryDict запроса; если передан, у страницы заполняются
+    ``next_query``/``previous_query`` с сохранением остальных параметров.
+    """
+    name, descending = _split_sort(sort)
+    payload = decode_cursor(cursor)
+    if payload is not None:
+        # Поврежденный курсор - просто первая страница
+        try:
+            value = _load_value(queryset, name, payload['v'])
+            payload['id'] = _to_python(queryset.model._meta.pk, payload['id'])
+        except ValidationError:
+            payload = None
+    backward = payload is not None and payload['d'] == 'p'
+
+    if payload is not None:
+        # Назад по убывающей сортировке - это вперед по возрастающей
+        greater = descending == backward
+        op = 'gt' if greater else 'lt'
+        queryset = queryset.filter(
+            Q(**{f'{name}__{op}': value}) |
+            Q(**{name: value, f'pk__{op}': payload['id']})
+        )
+
+    reverse = descending != backward
+    prefix = '-' if reverse else ''
+    rows = list(queryset.order_by(f'{prefix}{name}', f'{prefix}pk')[:per_page + 1])
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backward:
+        rows.reverse()
+
+    def make(obj, direction):
+        return encode_cursor({'v': _dump_value(queryset, name, obj), 'id': obj.pk, 'd': direction})
+
+    next_cursor = previous_cursor = None
+    if rows:
+        if has_more or backward:
+            next_cursor = make(rows[-1], 'n')
+        if (has_more and backward) or (payload is not None and not backward):
+            previous_cursor = make(rows[0], 'p')
+
+    page = CursorPage(rows, next_cursor, previous_cursor)
+    if params is not None:
+        page.next_query = _query_with_cursor(params, next_cursor)
+        page.previous_query = _query_with_cursor(params, previous_cursor)
+    return page
+
+
+def _query_with_cursor(params, cursor):
+    if cursor is None:
+        return ''
+    query = params.copy()
+    query.pop('page', None)
+    query['cursor'] = cursor
+    return query.urlencode()
+
+
+class KeysetPagination(CursorPagination):
+    """Курсорная пагинация для списков REST API"""
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-created'
+
+
+class UserKeysetPagination(KeysetPagination):
+    ordering = '-date_joined'
+
+
+class EstimatedCountPaginator(Paginator):
+    """Пагинатор для больших таблиц (админка).
+
+    Точно считается не больше ``exact_limit`` строк: ``COUNT(*)`` по
+    подзапросу с ``LIMIT``. Если строк больше, на PostgreSQL берется
+    оценка планировщика из ``EXPLAIN``, на других базах - сам предел.
+    """
+    exact_limit = 10000
+
+    @cached_property
+    def count(self):
+        exact = self.object_list[:self.exact_limit + 1].count()
+        if exact <= self.exact_limit:
+            return exact
+        return max(self._estimate() or 0, exact)
+
+    def _estimate(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+        sql, params = queryset.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
@@ -0,0 +1,46 @@
+# parallel.py
+"""Одновременные запросы в асинхронных представлениях.
+
+ORM Django синхронный, поэтому ``gather_queries`` запускает каждую функцию
+через ``sync_to_async(thread_sensitive=False)`` - в своем потоке и со своим
+соединением - и ждет их вместе через ``asyncio.gather``. Под ASGI ожидание
+не держит поток на соединение клиента: медленные клиенты стоят в цикле
+событий, а потоки заняты только самими запросами к БД.
+
+Внутри транзакции (например, в тестах) другие соединения не видят
+незафиксированных строк, поэтому функции выполняются по очереди в потоке,
+к которому привязано соединение запроса. ``PARALLEL_QUERIES = False``
+тоже включает последовательное выполнение.
+
+Представления DRF (``APIView``) асинхронные обработчики не поддерживают
+и остаются синхронными.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+
+def _in_transaction():
+    return connection.in_atomic_block
+
+
+def _isolated(call):
+    # Поток из пула переиспользуется: соединение закрывается по CONN_MAX_AGE, как после запроса
+    def run():
+        close_old_connections()
+        try:
+            return call()
+        finally:
+            close_old_connections()
+    return run
+
+
+async def gather_queries(*calls):
+    """Выполняет независимые синхронные функции и возвращает их результаты по порядку"""
+    if not getattr(settings, 'PARALLEL_QUERIES', True) or await sync_to_async(_in_transaction)():
+        return [await sync_to_async(call)() for call in calls]
+    return await asyncio.gather(
+        *(sync_to_async(_isolated(call), thread_sensitive=False)() for call in calls)
+    )
@@ -8,3 +8,11 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
 
         return obj.owner == request.user
 
+
+
+class IsStaffOrReadOnly(permissions.BasePermission):
+    def has_permission(self, request, view):
+        if request.method in permissions.SAFE_METHODS:
+            return True
+
+        return request.user.is_staff
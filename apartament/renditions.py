@@ -0,0 +1,132 @@
+# renditions.py
+"""Уменьшенные копии (рендишены) фотографий объявлений и аватаров.
+
+После загрузки изображения в пуле потоков строятся копии фиксированных
+размеров в WebP и JPEG. Они лежат рядом с оригиналом в ``renditions/<размер>/``.
+Пока копии не готовы (флаг ``renditions_ready`` у ``PostImage`` и
+``avatar_renditions_ready`` у ``Profile``), шаблоны показывают оригинал.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Максимальная ширина каждого размера в пикселях
+SIZES = {
+    'admin': 300,
+    'avatar': 200,
+    'card': 480,
+    'gallery': 1280,
+}
+
+# Какие размеры строятся для каждого вида изображений
+POST_IMAGE_SIZES = ('card', 'gallery', 'admin')
+AVATAR_SIZES = ('avatar', 'admin')
+
+# Форматы: расширение файла -> (формат Pillow, параметры сохранения)
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+_executor = None
+
+
+def rendition_name(name, size, ext):
+    """Путь копии в хранилище: renditions/<размер>/<путь оригинала>.<ext>"""
+    stem, _ = os.path.splitext(name)
+    return f'renditions/{size}/{stem}.{ext}'
+
+
+def rendition_url(fieldfile, size, ext='jpg'):
+    return fieldfile.storage.url(rendition_name(fieldfile.name, size, ext))
+
+
+def _render(source, width, fmt, options):
+    image = source.copy()
+    image.thumbnail((width, width * 2), Image.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+
+def generate(fieldfile, sizes):
+    """Строит все копии изображения синхронно"""
+    storage = fieldfile.storage
+    with storage.open(fieldfile.name, 'rb') as handle:
+        source = ImageOps.exif_transpose(Image.open(handle))
+        source = source.convert('RGB')
+    for size in sizes:
+        for ext, (fmt, options) in FORMATS.items():
+            name = rendition_name(fieldfile.name, size, ext)
+            if storage.exists(name):
+                storage.delete(name)
+            storage.save(name, ContentFile(_render(source, SIZES[size], fmt, options)))
+
+
+def delete(fieldfile, sizes):
+    for size in sizes:
+        for ext in FORMATS:
+            name = rendition_name(fieldfile.name, size, ext)
+            if fieldfile.storage.exists(name):
+                fieldfile.storage.delete(name)
+
+
+def build_post_image(image_id):
+    """Строит копии фотографии объявления и отмечает их готовность"""
+    from .models import PostImage
+
+    image = PostImage.objects.filter(pk=image_id).only('image').first()
+    if image is None or not image.image:
+        return False
+    generate(image.image, POST_IMAGE_SIZES)
+    # update() не вызывает сигналы и не меняет поле updated
+    PostImage.objects.filter(pk=image_id, image=image.image.name).update(renditions_ready=True)
+    return True
+
+
+def build_avatar(profile_id):
+    """Строит копии аватара и отмечает их готовность"""
+    from .models import Profile
+
+    profile = Profile.objects.filter(pk=profile_id).only('avatar').first()
+    if profile is None or not profile.avatar:
+        return False
+    generate(profile.avatar, AVATAR_SIZES)
+    Profile.objects.filter(pk=profile_id, avatar=profile.avatar.name).update(avatar_renditions_ready=True)
+    return True
+
+
+def _run(task, *args):
+    try:
+        task(*args)
+    except Exception:
+        logger.exception('Не удалось построить копии изображения')
+    finally:
+        # Поток пула держит собственные соединения с БД
+        connections.close_all()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'RENDITION_WORKERS', 2),
+            thread_name_prefix='renditions',
+        )
+    return _executor
+
+
+def schedule(task, *args):
+    """Ставит построение копий в пул после фиксации транзакции"""
+    if not getattr(settings, 'RENDITIONS_ASYNC', True):
+        transaction.on_commit(lambda: task(*args))
+        return
+    transaction.on_commit(lambda: _get_executor().submit(_run, task, *args))
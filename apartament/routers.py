@@ -0,0 +1,128 @@
+# routers.py
+"""Чтение с реплик, запись в основную базу.
+
+Реплики перечислены в ``DATABASE_REPLICAS``. Читать с них разрешает только
+``ReplicaRoutingMiddleware`` и только для безопасных запросов (GET, HEAD)
+не-сотрудников; все остальное - фоновые потоки, команды, админка,
+транзакции - читает из основной базы.
+
+Сотрудника роутер определяет лениво, по уже загруженному пользователю, и
+сам пользователя не загружает: гость без cookie сессии и без заголовка
+``Authorization`` читает с реплики без единого запроса к основной базе.
+Пока пользователь запроса с учетными данными не загружен, чтения идут в
+основную базу (в том числе чтение сессии и пользователя). Пользователь,
+которого определила аутентификация DRF (сессия, Basic), попадает в
+``request.user`` и учитывается так же.
+
+Чтобы пользователь видел собственные изменения, после POST (создание
+объявления, комментарий, вход) браузер получает cookie, и следующие
+``REPLICA_STICKY_SECONDS`` секунд его запросы читают из основной базы,
+пока реплики догоняют.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.functional import LazyObject, empty
+
+STICKY_COOKIE = 'primary_until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Запрос, которому разрешено читать с реплик, или None
+_replica_reads = ContextVar('replica_reads', default=None)
+
+
+def _replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', ())
+
+
+def _loaded_user(request):
+    """Пользователь запроса, если его уже загрузили, иначе None"""
+    user = request.__dict__.get('user')
+    if isinstance(user, LazyObject):
+        user = None if user._wrapped is empty else user._wrapped
+    return user
+
+
+def _has_credentials(request):
+    return settings.SESSION_COOKIE_NAME in request.COOKIES or 'HTTP_AUTHORIZATION' in request.META
+
+
+def replicas_allowed(request):
+    """Можно ли сейчас читать с реплик для этого запроса"""
+    user = _loaded_user(request)
+    if user is None:
+        # Сотрудника еще не отличить от гостя - гостем считается только запрос без учетных данных
+        return not _has_credentials(request)
+    # Модерация и админка работают со свежими данными
+    return not user.is_staff
+
+
+@contextmanager
+def use_primary():
+    """Блок, в котором все чтения идут в основную базу"""
+    token = _replica_reads.set(None)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = _replicas()
+        request = _replica_reads.get()
+        if not replicas or request is None or not replicas_allowed(request):
+            return DEFAULT_DB_ALIAS
+        # Внутри транзакции читаем то же, что пишем
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaRoutingMiddleware:
+    """Разрешает чтение с реплик на время безопасного запроса"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def use_replicas(self, request):
+        if request.method not in SAFE_METHODS or not _replicas():
+            return False
+        try:
+            if float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time():
+                return False
+        except ValueError:
+            pass
+        # Сотрудники отсекаются позже, в роутере, когда пользователь уже известен
+        return True
+
+    def __call__(self, request):
+        token = _replica_reads.set(request if self.use_replicas(request) else None)
+        try:
+            response = self.get_response(request)
+        finally:
+            _replica_reads.reset(token)
+
+        if request.method not in SAFE_METHODS and _replicas():
+            sticky = getattr(settings, 'REPLICA_STICKY_SECONDS', 5)
+            response.set_cookie(
+                STICKY_COOKIE, str(time.time() + sticky),
+                max_age=sticky, httponly=True, samesite='Lax',
+            )
+        return response
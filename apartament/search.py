@@ -0,0 +1,238 @@
+# search.py
+"""Полнотекстовый поиск по объявлениям.
+
+На SQLite используется виртуальная таблица FTS5, которая синхронизируется
+с ``Post`` через сигналы. Таблица присоединяется к запросу объявлений,
+поэтому остальные фильтры и сортировка по ``bm25`` выполняются в том же
+запросе, без ограничения числа совпадений. На PostgreSQL используется
+GIN-индекс по ``to_tsvector('russian', ...)`` и ранжирование ``SearchRank``.
+Если ни один движок недоступен, поиск откатывается к ``icontains``.
+"""
+import re
+
+from django.db import connection, OperationalError, DatabaseError
+from django.db.models import FloatField, Q, IntegerField, Value
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'apartament_post_fts'
+PG_INDEX = 'apartament_post_search_idx'
+
+# Веса колонок для bm25: заголовок, описание, адрес
+FTS_WEIGHTS = (10.0, 1.0, 4.0)
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Окончания для упрощенного русского стемминга (от длинных к коротким)
+_RU_ENDINGS = sorted([
+    'ями', 'ами', 'ях', 'ах', 'ям', 'ам', 'ов', 'ев', 'ей', 'ий', 'ый', 'ой',
+    'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ую', 'юю', 'ого', 'его', 'ому', 'ему',
+    'ыми', 'ими', 'ых', 'их', 'ым', 'им', 'ом', 'ем', 'ью', 'ия', 'ие', 'ии',
+    'ость', 'ости', 'ать', 'ять', 'ить', 'еть', 'ешь', 'ет', 'ут', 'ют', 'ит',
+    'ат', 'ят', 'ал', 'ял', 'ил', 'ла', 'ли', 'ло', 'а', 'я', 'о', 'е', 'ы',
+    'и', 'у', 'ю', 'ь', 'й',
+], key=len, reverse=True)
+
+_MIN_STEM = 3
+
+# Базы данных, в которых таблица FTS5 уже найдена
+_fts_ready = set()
+
+
+def stem_word(word):
+    """Упрощенный стеммер: приводит слово к основе, отрезая окончание"""
+    word = word.lower().replace('ё', 'е')
+    if not re.search('[а-я]', word):
+        return word
+    for ending in _RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def normalize_text(text):
+    """Разбивает текст на слова и приводит каждое к основе"""
+    return ' '.join(stem_word(w) for w in _WORD_RE.findall(text or ''))
+
+
+def build_match_query(query):
+    """Строит выражение MATCH для FTS5: все основы слов как префиксы"""
+    stems = [stem_word(w) for w in _WORD_RE.findall(query or '')]
+    # Однобуквенные предлоги вроде "в" или "с" только размывают выдачу
+    return ' '.join('"%s"*' % s.replace('"', '') for s in stems if len(s) > 1)
+
+
+def _is_sqlite():
+    return connection.vendor == 'sqlite'
+
+
+def _is_postgres():
+    return connection.vendor == 'postgresql'
+
+
+def ensure_search_index():
+    """Создает поисковый индекс для текущей БД, если его еще нет"""
+    try:
+        with connection.cursor() as cursor:
+            if _is_sqlite():
+                cursor.execute(
+                    'CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5('
+                    'title, description, address, tokenize="unicode61")' % FTS_TABLE
+                )
+            elif _is_postgres():
+                _ensure_pg_index(cursor)
+    except (OperationalError, DatabaseError):
+        return False
+    return True
+
+
+def _search_vector():
+    from django.contrib.postgres.search import SearchVector
+
+    return SearchVector('title', 'description', 'address', config='russian')
+
+
+def _ensure_pg_index(cursor):
+    """Создает GIN-индекс по тому же выражению, что используется в фильтре"""
+    from django.contrib.postgres.indexes import GinIndex
+    from .models import Post
+
+    constraints = connection.introspection.get_constraints(cursor, Post._meta.db_table)
+    if PG_INDEX in constraints:
+        return
+    with connection.schema_editor() as editor:
+        editor.add_index(Post, GinIndex(_search_vector(), name=PG_INDEX))
+
+
+def _fts_available():
+    if not _is_sqlite():
+        return False
+    name = str(connection.settings_dict['NAME'])
+    if name in _fts_ready:
+        return True
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE]
+        )
+        if cursor.fetchone() is None:
+            return False
+    _fts_ready.add(name)
+    return True
+
+
+def index_post(post):
+    """Обновляет запись объявления в индексе FTS5"""
+    if not _fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s WHERE rowid = %%s' % FTS_TABLE, [post.pk])
+        cursor.execute(
+            'INSERT INTO %s (rowid, title, description, address) '
+            'VALUES (%%s, %%s, %%s, %%s)' % FTS_TABLE,
+            [post.pk, normalize_text(post.title),
+             normalize_text(post.description), normalize_text(post.address)],
+        )
+
+
+def unindex_post(post_id):
+    """Удаляет объявление из индекса FTS5"""
+    if not _fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s WHERE rowid = %%s' % FTS_TABLE, [post_id])
+
+
+def rebuild_index(batch_size=1000):
+    """Полностью пересобирает индекс FTS5. Возвращает число проиндексированных записей"""
+    from .models import Post
+
+    if not ensure_search_index() or not _is_sqlite():
+        return 0
+    count = 0
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM %s' % FTS_TABLE)
+        rows = Post.objects.values_list('pk', 'title', 'description', 'address')
+        for pk, title, description, address in rows.iterator(chunk_size=batch_size):
+            cursor.execute(
+                'INSERT INTO %s (rowid, title, description, address) '
+                'VALUES (%%s, %%s, %%s, %%s)' % FTS_TABLE,
+                [pk, normalize_text(title), normalize_text(description),
+                 normalize_text(address)],
+            )
+            count += 1
+    return count
+
+
+def _match_sqlite(queryset, match, ranked):
+    """Ограничивает queryset совпадениями FTS5; при ranked - соединением с рангом bm25"""
+    if not ranked:
+        # Подзапрос без ссылок на внешнюю таблицу - годится и внутри других подзапросов
+        return queryset.filter(pk__in=RawSQL(
+            'SELECT rowid FROM %s WHERE %s MATCH %%s' % (FTS_TABLE, FTS_TABLE), [match]
+        ))
+    qn = connection.ops.quote_name
+    queryset = queryset.extra(
+        tables=[FTS_TABLE],
+        where=[
+            '%s.rowid = %s.%s' % (
+                qn(FTS_TABLE), qn(queryset.model._meta.db_table), qn(queryset.model._meta.pk.column)
+            ),
+            '%s MATCH %%s' % qn(FTS_TABLE),
+        ],
+        params=[match],
+    )
+    weights = ', '.join(str(w) for w in FTS_WEIGHTS)
+    rank = RawSQL('bm25(%s, %s)' % (qn(FTS_TABLE), weights), (), output_field=FloatField())
+    return queryset.annotate(rank=rank).order_by('rank')
+
+
+def _icontains(queryset, query):
+    return queryset.filter(
+        Q(title__icontains=query) |
+        Q(description__icontains=query) |
+        Q(address__icontains=query)
+    )
+
+
+def search_posts(queryset, query, ranked=True):
+    """Фильтрует queryset объявлений по поисковому запросу.
+
+    При ``ranked=True`` результаты упорядочены по релевантности;
+    вызывающий код может переопределить порядок через ``order_by``.
+    """
+    query = (query or '').strip()
+    if not query:
+        return queryset
+
+    if _is_postgres():
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+
+        search_query = SearchQuery(query, config='russian', search_type='websearch')
+        # Фильтр идет по индексированному выражению, ранжирование - с весами колонок
+        queryset = queryset.annotate(search=_search_vector()).filter(search=search_query)
+        if ranked:
+            weighted = (
+                SearchVector('title', weight='A', config='russian') +
+                SearchVector('address', weight='B', config='russian') +
+                SearchVector('description', weight='C', config='russian')
+            )
+            queryset = queryset.annotate(
+                rank=SearchRank(weighted, search_query)
+            ).order_by('-rank', '-created')
+        return queryset
+
+    if _fts_available():
+        match = build_match_query(query)
+        if match:
+            return _match_sqlite(queryset, match, ranked)
+        # Запрос из одних предлогов ничего не находит
+        queryset = queryset.none()
+    else:
+        queryset = _icontains(queryset, query)
+    if ranked:
+        queryset = queryset.annotate(rank=Value(0, output_field=IntegerField()))
+    return queryset
+
+
+def rank_sort():
+    """Сортировка по релевантности для результатов search_posts"""
+    return '-rank' if _is_postgres() else 'rank'
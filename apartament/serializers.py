@@ -1,35 +1,127 @@
 
 from rest_framework import serializers
+from django.conf import settings
+from django.core.files.storage import default_storage
 from django.contrib.auth.models import User
-from .models import Post, Comment, Category
+from .models import Post, Comment, Category, ImageUpload
 
 
-class CategorySerializer(serializers.ModelSerializer):
-    owner = serializers.ReadOnlyField(source='owner.username')
+def query_param_set(request, name):
+    """Значения параметра вида ``?name=a,b``; None - параметр не передан"""
+    if request is None:
+        return None
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    return {item.strip() for item in value.split(',') if item.strip()}
+
+
+class DynamicFieldsMixin:
+    """Разреженные наборы полей ответа.
+
+    ``?fields=id,username`` оставляет только перечисленные поля, а
+    ``?expand=posts`` включает поля из ``Meta.expandable_fields``
+    (списки связанных id), которые по умолчанию не отдаются.
+    Представление может спросить ``get_serializer().fields``, чтобы
+    загружать только то, что войдет в ответ.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+        expand = query_param_set(request, 'expand') or set()
+        for name in getattr(self.Meta, 'expandable_fields', ()):
+            if name not in expand:
+                fields.pop(name, None)
+        only = query_param_set(request, 'fields')
+        if only:
+            for name in list(fields):
+                if name not in only and name not in expand:
+                    fields.pop(name)
+        return fields
+
+
+class CategorySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    post_count = serializers.IntegerField(read_only=True)
+    active_post_count = serializers.IntegerField(read_only=True)
     posts = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
 
     class Meta:
         model = Category
-        fields = ['id', 'name', 'owner', 'posts']
+        fields = ['id', 'name', 'created', 'post_count', 'active_post_count', 'posts']
+        expandable_fields = ('posts',)
+
+
+def image_url(name):
+    return default_storage.url(name) if name else None
 
 
 class PostSerializer(serializers.ModelSerializer):
     owner = serializers.ReadOnlyField(source='owner.username')
-    comments = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+    category_name = serializers.ReadOnlyField(source='category.name')
+    cover = serializers.SerializerMethodField()
+    comments_count = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Post
-        fields = ['id', 'title', 'body', 'owner', 'comments', 'categories']
+        fields = [
+            'id', 'title', 'description', 'owner', 'category', 'category_name',
+            'price', 'area', 'rooms', 'address', 'contact_phone', 'status', 'views',
+            'cover', 'images_count', 'comments_count', 'created', 'updated',
+        ]
+        read_only_fields = ['status', 'views', 'images_count']
+
+    def get_cover(self, obj):
+        return image_url(obj.cover.image.name) if obj.cover_id else None
+
 
+class PostListSerializer(serializers.Serializer):
+    """Список объявлений из словарей ``values(*VALUES)``, без создания моделей.
 
-class UserSerializer(serializers.ModelSerializer):
+    Поля и их представление совпадают с ``PostSerializer``, кроме
+    описания и телефона, которые в список не входят.
+    """
+    VALUES = (
+        'id', 'title', 'owner__username', 'category_id', 'category__name', 'price', 'area',
+        'rooms', 'address', 'status', 'views', 'cover__image', 'images_count',
+        'comments_count', 'created', 'updated',
+    )
+
+    id = serializers.IntegerField()
+    title = serializers.CharField()
+    owner = serializers.CharField(source='owner__username')
+    category = serializers.IntegerField(source='category_id')
+    category_name = serializers.CharField(source='category__name')
+    price = serializers.DecimalField(max_digits=10, decimal_places=2)
+    area = serializers.DecimalField(max_digits=6, decimal_places=2)
+    rooms = serializers.IntegerField()
+    address = serializers.CharField()
+    status = serializers.CharField()
+    views = serializers.IntegerField()
+    cover = serializers.SerializerMethodField()
+    images_count = serializers.IntegerField()
+    comments_count = serializers.IntegerField()
+    created = serializers.DateTimeField()
+    updated = serializers.DateTimeField()
+
+    def get_cover(self, row):
+        return image_url(row['cover__image'])
+
+
+class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    post_count = serializers.IntegerField(read_only=True)
+    active_post_count = serializers.IntegerField(read_only=True)
+    comment_count = serializers.IntegerField(read_only=True)
     posts = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
     comments = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
-    categories = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
 
     class Meta:
         model = User
-        fields = ['id', 'username', 'posts', 'comments', 'categories']
+        fields = [
+            'id', 'username', 'date_joined', 'post_count', 'active_post_count',
+            'comment_count', 'posts', 'comments',
+        ]
+        expandable_fields = ('posts', 'comments')
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -37,5 +129,34 @@ class CommentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Comment
-        fields = ['id', 'body', 'name', 'post', 'updated', 'active']
+        fields = ['id', 'content', 'name', 'post', 'created', 'updated', 'active']
+
+
+class CommentListSerializer(serializers.Serializer):
+    """Список комментариев из словарей ``values(*VALUES)``"""
+    VALUES = ('id', 'content', 'owner__username', 'post_id', 'created', 'updated', 'active')
+
+    id = serializers.IntegerField()
+    content = serializers.CharField()
+    name = serializers.CharField(source='owner__username')
+    post = serializers.IntegerField(source='post_id')
+    created = serializers.DateTimeField()
+    updated = serializers.DateTimeField()
+    active = serializers.BooleanField()
+
+
+class ImageUploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ImageUpload
+        fields = ['id', 'filename', 'size', 'received', 'is_main']
+        read_only_fields = ['id', 'received']
+
+    def validate_size(self, value):
+        limit = getattr(settings, 'UPLOAD_MAX_FILE_SIZE', 20 * 1024 * 1024)
+        if not 0 < value <= limit:
+            raise serializers.ValidationError(f'Размер файла должен быть от 1 байта до {limit} байт')
+        return value
+
 
+class UploadCommitSerializer(serializers.Serializer):
+    uploads = serializers.ListField(child=serializers.UUIDField(), allow_empty=False)
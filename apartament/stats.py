@@ -0,0 +1,235 @@
+# stats.py
+"""Счетчики главной страницы и владельцев объявлений.
+
+Значения главной страницы хранятся в единственной строке ``SiteStats`` и
+обновляются инкрементально через ``F()``-выражения при изменении статуса
+объявлений, их создании, удалении и росте просмотров. ``reconcile_site_stats``
+пересчитывает все заново и вызывается периодически (команда
+``reconcile_stats``) и после массовых ``queryset.update()``.
+
+Счетчики владельца (``OwnerStats``) ведутся так же. Строка создается
+пересчетом при первом чтении (``get_owner_stats``); пока ее нет,
+инкрементальные обновления просто ничего не меняют.
+
+Просмотры пишутся в БД счетчиком через ``F()`` (см. counters.py), поэтому
+``post.views`` в памяти может отставать: при смене статуса просмотры берутся
+подзапросом в том же ``UPDATE``, а перед удалением перечитываются.
+"""
+from datetime import datetime, time, timedelta
+
+from django.contrib.auth.models import User
+from django.db.models import Case, Count, F, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Comment, OwnerStats, Post, SiteStats
+
+STATS_PK = 1
+
+
+def _created_on(day):
+    """Фильтр по дню создания диапазоном, чтобы работал индекс (status, created)"""
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return {'created__gte': start, 'created__lt': start + timedelta(days=1)}
+
+
+def reconcile_site_stats():
+    """Полностью пересчитывает счетчики по таблице объявлений"""
+    today = timezone.localdate()
+    active = Post.objects.filter(status='active')
+    values = {
+        'active_posts': active.count(),
+        'total_views': active.aggregate(total=Sum('views'))['total'] or 0,
+        'active_users': User.objects.filter(posts__status='active').distinct().count(),
+        'new_today': active.filter(**_created_on(today)).count(),
+        'today': today,
+        'reconciled': timezone.now(),
+    }
+    stats, _ = SiteStats.objects.update_or_create(pk=STATS_PK, defaults=values)
+    return stats
+
+
+def get_site_stats():
+    """Возвращает счетчики главной страницы одним запросом"""
+    stats = SiteStats.objects.filter(pk=STATS_PK).first()
+    if stats is None:
+        return reconcile_site_stats()
+    today = timezone.localdate()
+    if stats.today != today:
+        # Наступил новый день - счетчик новых объявлений начинается заново
+        stats.new_today = Post.objects.filter(status='active', **_created_on(today)).count()
+        stats.today = today
+        SiteStats.objects.filter(pk=STATS_PK).update(new_today=stats.new_today, today=today)
+    return stats
+
+
+def _adjust(posts=0, views=0, users=0, new_on=None, new=0):
+    updates = {}
+    if posts:
+        updates['active_posts'] = F('active_posts') + posts
+    if views:
+        updates['total_views'] = F('total_views') + views
+    if users:
+        updates['active_users'] = F('active_users') + users
+    if new and new_on is not None:
+        # Новое объявление учитывается, только если счетчик ведется за его день
+        updates['new_today'] = Case(
+            When(today=new_on, then=F('new_today') + new),
+            default=F('new_today'),
+        )
+    if updates:
+        SiteStats.objects.filter(pk=STATS_PK).update(**updates)
+
+
+def _current_views(post, sign):
+    """Просмотры объявления из БД со знаком - выражение для UPDATE"""
+    views = Subquery(Post.objects.filter(pk=post.pk).values('views')[:1])
+    return Coalesce(views, 0) * sign
+
+
+def record_views(count):
+    """Учитывает просмотры активных объявлений"""
+    _adjust(views=count)
+
+
+def post_status_changed(post, previous, deleted=False):
+    """Учитывает переход объявления в статус 'active' или из него.
+
+    ``previous`` - статус до сохранения (``None`` для нового объявления).
+    """
+    was_active = previous == 'active'
+    is_active = post.status == 'active' and not deleted
+    if was_active == is_active:
+        return
+    sign = 1 if is_active else -1
+    has_other_active = Post.objects.filter(
+        owner_id=post.owner_id, status='active'
+    ).exclude(pk=post.pk).exists()
+    _adjust(
+        posts=sign,
+        # Строки удаленного объявления уже нет - его просмотры перечитаны до удаления
+        views=sign * post.views if deleted else _current_views(post, sign),
+        users=0 if has_other_active else sign,
+        new_on=timezone.localdate(post.created) if post.created else None,
+        new=sign,
+    )
+
+
+# Поле OwnerStats для каждого статуса объявления
+OWNER_STATUS_FIELDS = {
+    'active': 'active_posts',
+    'moderation': 'moderation_posts',
+    'draft': 'draft_posts',
+    'rejected': 'rejected_posts',
+    'archived': 'archived_posts',
+}
+OWNER_FIELDS = (
+    'total_posts', *OWNER_STATUS_FIELDS.values(), 'total_views',
+    'comments_received', 'comments_written', 'reconciled',
+)
+
+
+def reconcile_owner_stats(owner_ids):
+    """Пересчитывает счетчики переданных владельцев несколькими агрегатами"""
+    owner_ids = {owner_id for owner_id in owner_ids if owner_id is not None}
+    if not owner_ids:
+        return []
+    now = timezone.now()
+    rows = {owner_id: OwnerStats(user_id=owner_id, reconciled=now) for owner_id in owner_ids}
+
+    posts = Post.objects.filter(owner_id__in=owner_ids).order_by().values('owner_id', 'status')
+    for row in posts.annotate(total=Count('pk'), views=Sum('views')):
+        stats = rows[row['owner_id']]
+        stats.total_posts += row['total']
+        stats.total_views += row['views'] or 0
+        field = OWNER_STATUS_FIELDS.get(row['status'])
+        if field:
+            setattr(stats, field, getattr(stats, field) + row['total'])
+
+    received = Comment.objects.filter(active=True, post__owner_id__in=owner_ids).order_by()
+    for row in received.values('post__owner_id').annotate(total=Count('pk')):
+        rows[row['post__owner_id']].comments_received = row['total']
+    written = Comment.objects.filter(owner_id__in=owner_ids).order_by()
+    for row in written.values('owner_id').annotate(total=Count('pk')):
+        rows[row['owner_id']].comments_written = row['total']
+
+    return OwnerStats.objects.bulk_create(
+        list(rows.values()),
+        update_conflicts=True,
+        unique_fields=['user'],
+        update_fields=OWNER_FIELDS,
+    )
+
+
+def get_owner_stats(user):
+    """Счетчики владельца одним запросом (при первом обращении - пересчет)"""
+    stats = OwnerStats.objects.filter(pk=user.pk).first()
+    if stats is None:
+        stats = reconcile_owner_stats([user.pk])[0]
+    return stats
+
+
+def _adjust_owner(owner_id, **deltas):
+    updates = {name: F(name) + delta for name, delta in deltas.items() if delta}
+    if updates:
+        OwnerStats.objects.filter(pk=owner_id).update(**updates)
+
+
+def _post_deltas(post, status, sign):
+    deltas = {'total_posts': sign, 'total_views': sign * post.views}
+    field = OWNER_STATUS_FIELDS.get(status)
+    if field:
+        deltas[field] = sign
+    return deltas
+
+
+def owner_post_added(post):
+    _adjust_owner(post.owner_id, **_post_deltas(post, post.status, 1))
+
+
+def owner_post_status_changed(post, previous):
+    deltas = {}
+    if previous in OWNER_STATUS_FIELDS:
+        deltas[OWNER_STATUS_FIELDS[previous]] = -1
+    if post.status in OWNER_STATUS_FIELDS:
+        deltas[OWNER_STATUS_FIELDS[post.status]] = deltas.get(OWNER_STATUS_FIELDS[post.status], 0) + 1
+    _adjust_owner(post.owner_id, **deltas)
+
+
+def owner_post_deleted(post, active_comments=0):
+    deltas = _post_deltas(post, post.status, -1)
+    deltas['comments_received'] = -active_comments
+    _adjust_owner(post.owner_id, **deltas)
+
+
+def _post_owner(comment):
+    return Post.objects.filter(pk=comment.post_id).values_list('owner_id', flat=True).first()
+
+
+def owner_comment_changed(comment, created=False, previous_active=None):
+    """Учитывает новый комментарий или смену его активности"""
+    if created:
+        _adjust_owner(comment.owner_id, comments_written=1)
+        if comment.active:
+            _adjust_owner(_post_owner(comment), comments_received=1)
+    elif previous_active is not None:
+        _adjust_owner(_post_owner(comment), comments_received=1 if comment.active else -1)
+
+
+def owner_comment_deleted(comment, with_post=False):
+    _adjust_owner(comment.owner_id, comments_written=-1)
+    if comment.active and not with_post:
+        _adjust_owner(_post_owner(comment), comments_received=-1)
+
+
+def record_owner_views(views_by_owner):
+    """Прибавляет просмотры из словаря {owner_id: число} одним запросом"""
+    if not views_by_owner:
+        return
+    increment = Case(
+        *[When(pk=owner_id, then=Value(count)) for owner_id, count in views_by_owner.items()],
+        default=Value(0),
+    )
+    OwnerStats.objects.filter(pk__in=list(views_by_owner)).update(
+        total_views=F('total_views') + increment
+    )
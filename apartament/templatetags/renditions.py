@@ -0,0 +1,60 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from apartament import renditions
+
+register = template.Library()
+
+# Какие копии предлагаются браузеру в srcset для каждого места вывода
+SRCSETS = {
+    'card': ('card', 'gallery'),
+    'gallery': ('card', 'gallery'),
+    'admin': ('admin',),
+    'avatar': ('avatar', 'admin'),
+}
+
+
+def _source(obj):
+    """Файл изображения и готовность его копий для PostImage или Profile"""
+    if hasattr(obj, 'avatar'):
+        return obj.avatar, obj.avatar_renditions_ready
+    return obj.image, obj.renditions_ready
+
+
+def _srcset(fieldfile, sizes, ext):
+    return ', '.join(
+        f'{renditions.rendition_url(fieldfile, size, ext)} {renditions.SIZES[size]}w'
+        for size in sizes
+    )
+
+
+@register.simple_tag
+def rendition_url(obj, size):
+    """URL копии в JPEG, пока копий нет - URL оригинала"""
+    fieldfile, ready = _source(obj)
+    if not fieldfile:
+        return ''
+    if not ready:
+        return fieldfile.url
+    return renditions.rendition_url(fieldfile, size)
+
+
+@register.simple_tag
+def picture(obj, size, sizes='100vw', **attrs):
+    """Тег <picture> с WebP и JPEG копиями; пока копий нет - оригинал"""
+    fieldfile, ready = _source(obj)
+    if not fieldfile:
+        return ''
+    img_attrs = format_html_join(' ', '{}="{}"', attrs.items())
+    if not ready:
+        return format_html('<img src="{}" {}>', fieldfile.url, img_attrs)
+    variants = SRCSETS.get(size, (size,))
+    return format_html(
+        '<picture>'
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" loading="lazy" {}>'
+        '</picture>',
+        _srcset(fieldfile, variants, 'webp'), sizes,
+        renditions.rendition_url(fieldfile, size), _srcset(fieldfile, variants, 'jpg'), sizes,
+        img_attrs,
+    )
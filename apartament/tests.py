@@ -1,3 +1,1416 @@
-from django.test import TestCase
+import base64
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import threading
+from contextlib import closing
+from datetime import timedelta
+from io import BytesIO, StringIO
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, OperationalError, connection, connections, transaction
+from django.http import HttpResponse, QueryDict
+from django.template.loader import render_to_string
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from unittest import mock, skipUnless
+from asgiref.sync import sync_to_async
+from PIL import Image
+
+from . import moderation, parallel, renditions, routers
+from .admin import preview_url
+from .cache import cached_page
+from .checks import check_shared_cache
+from .counters import ViewCounter, view_counter
+from .facets import facet_counts
+from .filters import filter_posts
+from .models import Category, Comment, ImageUpload, ModerationJob, Post, PostImage, SiteStats, set_main_images
+from .pagination import encode_cursor, paginate_by_cursor
+from .search import rank_sort, rebuild_index, search_posts
+from .stats import get_owner_stats, get_site_stats, reconcile_site_stats
+from .uploads import UploadError, temp_path, write_chunk
+from .views import PostinDetailView
+
+
+def make_post(owner, category, **fields):
+    values = {
+        'title': 'Квартира', 'description': 'Описание', 'address': 'Москва',
+        'price': 30000, 'area': 40, 'rooms': 2, 'status': 'active',
+    }
+    values.update(fields)
+    return Post.objects.create(owner=owner, category=category, **values)
+
+
+def image_file(name='photo.png', size=(8, 8)):
+    buffer = BytesIO()
+    Image.new('RGB', size, 'red').save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class FixturesMixin:
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner', password='secret')
+        cls.category = Category.objects.create(name='Квартира')
+
+
+class MediaRootMixin:
+    """Загруженные в тестах файлы пишутся во временный каталог"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_override = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+
+class SearchTests(FixturesMixin, TestCase):
+    def test_filters_apply_before_ranking(self):
+        # Совпадений больше тысячи, но подходящие под фильтры - в самом конце рейтинга
+        Post.objects.bulk_create([
+            Post(
+                owner=self.owner, category=self.category, title='студия студия студия',
+                description='студия', status='rejected',
+            )
+            for _ in range(1100)
+        ])
+        wanted = make_post(self.owner, self.category, title='Просторная квартира',
+                           description='Рядом студия танцев')
+        rebuild_index()
+
+        found = filter_posts(QueryDict('q=студия'))
+        self.assertEqual(list(found.values_list('pk', flat=True)), [wanted.pk])
+        self.assertEqual(found.count(), 1)
+
+    def test_ranked_by_relevance(self):
+        weak = make_post(self.owner, self.category, title='Квартира', description='есть балкон')
+        strong = make_post(self.owner, self.category, title='Балкон с видом', description='большой балкон')
+        found = search_posts(Post.objects.filter(status='active'), 'балкон')
+        self.assertEqual([post.pk for post in found], [strong.pk, weak.pk])
+
+    def test_unranked_search_works_as_subquery(self):
+        post = make_post(self.owner, self.category, title='Лофт у парка')
+        make_post(self.owner, self.category, title='Квартира у вокзала')
+        found = search_posts(Post.objects.all(), 'лофт', ranked=False).values('pk')
+        self.assertEqual(list(Post.objects.filter(pk__in=found)), [post])
+
+
+class ChangeTrackingTests(FixturesMixin, TestCase):
+    def setUp(self):
+        self.post = make_post(self.owner, self.category)
+
+    def test_unchanged_save_skips_query(self):
+        post = Post.objects.get(pk=self.post.pk)
+        with self.assertNumQueries(0):
+            post.save()
+        profile = self.owner.profile
+        with self.assertNumQueries(0):
+            profile.save()
+
+    def test_only_changed_fields_are_written(self):
+        post = Post.objects.get(pk=self.post.pk)
+        post.title = 'Новый заголовок'
+        with CaptureQueriesContext(connection) as queries:
+            post.save()
+        update = next(query['sql'] for query in queries if query['sql'].startswith('UPDATE "apartament_post"'))
+        self.assertIn('"title"', update)
+        self.assertNotIn('"description"', update)
+
+    def test_revert_after_refresh_is_saved(self):
+        post = Post.objects.get(pk=self.post.pk)
+        Post.objects.filter(pk=post.pk).update(status='archived')
+        post.refresh_from_db()
+        post.status = 'active'
+        post.save()
+        self.assertEqual(Post.objects.get(pk=post.pk).status, 'active')
+
+    def test_revert_after_deferred_load_is_saved(self):
+        post = Post.objects.defer('title').get(pk=self.post.pk)
+        Post.objects.filter(pk=post.pk).update(title='Чужая правка')
+        self.assertEqual(post.title, 'Чужая правка')
+        post.title = 'Квартира'
+        post.save()
+        self.assertEqual(Post.objects.get(pk=post.pk).title, 'Квартира')
+
+    def test_login_writes_only_last_login(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.client.login(username='owner', password='secret'))
+        writes = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "auth_user"')]
+        self.assertEqual(len(writes), 1)
+        self.assertRegex(writes[0], r'SET "last_login" = [^,]+ WHERE')
+        self.assertNotIn('apartament_profile', ' '.join(query['sql'] for query in queries))
+
+
+class SiteStatsTests(FixturesMixin, TestCase):
+    def setUp(self):
+        self.post = make_post(self.owner, self.category, views=5)
+        reconcile_site_stats()
+
+    def assertStats(self, active_posts, total_views):
+        stats = SiteStats.objects.get()
+        self.assertEqual((stats.active_posts, stats.total_views), (active_posts, total_views))
+
+    def test_incremental_counters_match_reconcile(self):
+        make_post(self.owner, self.category, views=3)
+        draft = make_post(self.owner, self.category, status='draft', views=7)
+        draft.status = 'active'
+        draft.save()
+        self.post.delete()
+        self.assertStats(2, 10)
+        reconcile_site_stats()
+        self.assertStats(2, 10)
+
+    def test_save_with_deferred_status(self):
+        post = Post.objects.only('pk', 'title').get(pk=self.post.pk)
+        post.title = 'Новый заголовок'
+        post.save()
+        self.assertStats(1, 5)
+
+        post = Post.objects.defer('status').get(pk=self.post.pk)
+        post.status = 'active'
+        post.save()
+        self.assertStats(1, 5)
+
+        post = Post.objects.defer('status').get(pk=self.post.pk)
+        post.status = 'archived'
+        post.save()
+        self.assertStats(0, 0)
+        self.assertEqual(get_site_stats().active_users, 0)
+
+
+@override_settings(VIEW_COUNTER_BACKGROUND_FLUSH=False)
+class StaleViewsTests(FixturesMixin, TestCase):
+    """Просмотры приходят через F(), а объявление в памяти загружено раньше"""
+
+    def setUp(self):
+        self.post = make_post(self.owner, self.category)
+        reconcile_site_stats()
+        get_owner_stats(self.owner)
+        counter = ViewCounter(flush_interval=3600, flush_threshold=1000)
+        counter.add(self.post.pk, 7)
+        counter.flush()
+        self.assertEqual(self.post.views, 0)
+
+    def assertViews(self, site, owner):
+        self.assertEqual(SiteStats.objects.get().total_views, site)
+        self.assertEqual(get_owner_stats(self.owner).total_views, owner)
+
+    def test_status_change_uses_stored_views(self):
+        self.post.status = 'archived'
+        self.post.save()
+        self.assertViews(0, 7)
+        self.post.status = 'active'
+        self.post.save()
+        self.assertViews(7, 7)
+
+    def test_delete_uses_stored_views(self):
+        self.post.delete()
+        self.assertViews(0, 0)
+        reconcile_site_stats()
+        self.assertViews(0, 0)
+
+
+class OwnerStatsTests(FixturesMixin, TestCase):
+    def setUp(self):
+        self.post = make_post(self.owner, self.category, views=5)
+        self.other = User.objects.create_user('other', password='secret')
+        get_owner_stats(self.owner)
+        get_owner_stats(self.other)
+
+    def assertCounters(self, user, **expected):
+        stats = get_owner_stats(user)
+        self.assertEqual({name: getattr(stats, name) for name in expected}, expected)
+
+    def test_save_with_deferred_status(self):
+        post = Post.objects.only('pk', 'title').get(pk=self.post.pk)
+        post.title = 'Новый заголовок'
+        post.save()
+        self.assertCounters(self.owner, total_posts=1, active_posts=1)
+
+        post = Post.objects.defer('status').get(pk=self.post.pk)
+        post.status = 'archived'
+        post.save()
+        self.assertCounters(self.owner, total_posts=1, active_posts=0, archived_posts=1)
+
+    def test_save_with_deferred_owner(self):
+        post = Post.objects.only('pk', 'title').get(pk=self.post.pk)
+        post.owner = self.other
+        post.save()
+        self.assertCounters(self.owner, total_posts=0, active_posts=0, total_views=0)
+        self.assertCounters(self.other, total_posts=1, active_posts=1, total_views=5)
+
+    def test_comment_with_deferred_active(self):
+        comment = Comment.objects.create(post=self.post, owner=self.other, content='Хорошо')
+        self.assertCounters(self.owner, comments_received=1)
+        comment = Comment.objects.only('pk', 'content').get(pk=comment.pk)
+        comment.content = 'Исправлено'
+        comment.save()
+        self.assertCounters(self.owner, comments_received=1)
+        comment = Comment.objects.defer('active').get(pk=comment.pk)
+        comment.active = False
+        comment.save()
+        self.assertCounters(self.owner, comments_received=0)
+
+
+class CursorPaginationTests(FixturesMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for number in range(7):
+            make_post(cls.owner, cls.category, title=f'Балкон {number}',
+                      description='балкон ' * number, price=10000 + number % 3 * 1000)
+
+    def walk(self, queryset, sort):
+        seen = []
+        page = paginate_by_cursor(queryset, sort, per_page=3)
+        seen += [post.pk for post in page]
+        while page.has_next():
+            page = paginate_by_cursor(queryset, sort, page.next_cursor, per_page=3)
+            seen += [post.pk for post in page]
+        return seen
+
+    def test_pages_cover_every_row_once(self):
+        queryset = Post.objects.filter(status='active')
+        for sort in ('-created', 'price', '-price', '-views'):
+            with self.subTest(sort=sort):
+                seen = self.walk(queryset, sort)
+                self.assertEqual(sorted(seen), sorted(queryset.values_list('pk', flat=True)))
+
+    def test_pages_by_search_rank(self):
+        found = search_posts(Post.objects.filter(status='active'), 'балкон')
+        self.assertEqual(self.walk(found, rank_sort()), [post.pk for post in found])
+
+    def test_tampered_cursor_returns_first_page(self):
+        found = search_posts(Post.objects.filter(status='active'), 'балкон')
+        first = [post.pk for post in paginate_by_cursor(found, rank_sort(), per_page=3)]
+        for payload in (
+            {'v': 'abc', 'id': 1, 'd': 'n'},
+            {'v': float('nan'), 'id': 1, 'd': 'n'},
+            {'v': -1.5, 'id': 'abc', 'd': 'n'},
+            {'v': None, 'id': 1, 'd': 'n'},
+        ):
+            with self.subTest(payload=payload):
+                page = paginate_by_cursor(found, rank_sort(), encode_cursor(payload), per_page=3)
+                self.assertEqual([post.pk for post in page], first)
+        page = paginate_by_cursor(
+            Post.objects.all(), '-created', encode_cursor({'v': 12, 'id': [1], 'd': 'n'}), per_page=3
+        )
+        self.assertEqual(len(page), 3)
+
+    def test_tampered_cursor_in_listing(self):
+        cursor = encode_cursor({'v': 'abc', 'id': 'x', 'd': 'n'})
+        response = self.client.get('/', {'q': 'балкон', 'cursor': cursor})
+        self.assertEqual(response.status_code, 200)
+
+    def test_api_search_follows_cursor_ordering(self):
+        response = self.client.get('/posts/', {'q': 'балкон'})
+        self.assertEqual(response.status_code, 200)
+        ids = [row['id'] for row in response.json()['results']]
+        self.assertEqual(ids, list(
+            Post.objects.order_by('-created').values_list('pk', flat=True)[:len(ids)]
+        ))
+
+
+class CoverTests(MediaRootMixin, FixturesMixin, TestCase):
+    def setUp(self):
+        self.post = make_post(self.owner, self.category)
+
+    def add_image(self, **fields):
+        return PostImage.objects.create(post=self.post, image=image_file(), **fields)
+
+    def assertCover(self, cover, images_count):
+        self.post.refresh_from_db()
+        self.assertEqual((self.post.cover, self.post.images_count), (cover, images_count))
+
+    def test_add_and_delete(self):
+        self.assertCover(None, 0)
+        first = self.add_image()
+        self.assertCover(first, 1)
+        second = self.add_image()
+        self.assertCover(first, 2)
+        first.delete()
+        self.assertCover(second, 1)
+        second.delete()
+        self.assertCover(None, 0)
+
+    def test_main_image_becomes_cover(self):
+        first = self.add_image()
+        second = self.add_image(is_main=True)
+        self.assertCover(second, 2)
+
+        set_main_images({self.post.pk: first.pk})
+        self.assertCover(first, 2)
+        self.assertEqual(list(self.post.images.filter(is_main=True)), [first])
+
+        set_main_images({self.post.pk: None})
+        self.assertFalse(self.post.images.filter(is_main=True).exists())
+
+    def test_backfill(self):
+        image = self.add_image()
+        Post.objects.filter(pk=self.post.pk).update(cover=None, images_count=0)
+        call_command('refresh_covers', stdout=StringIO())
+        self.assertCover(image, 1)
+
+
+class RenditionTests(MediaRootMixin, TransactionTestCase):
+    """Копии строятся в других потоках, поэтому без тестовой транзакции"""
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', password='secret')
+        self.post = make_post(self.owner, Category.objects.create(name='Квартира'))
+
+    def wait_ready(self, image_id, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                if PostImage.objects.filter(pk=image_id, renditions_ready=True).exists():
+                    return
+            except OperationalError:
+                # Общая база SQLite в памяти не ждет блокировку записи потока пула
+                pass
+            self.assertLess(time.monotonic(), deadline, 'Копии не построены')
+            time.sleep(0.05)
+
+    def assertRenditions(self, fieldfile, sizes):
+        for size in sizes:
+            for ext, (fmt, _) in renditions.FORMATS.items():
+                with fieldfile.storage.open(renditions.rendition_name(fieldfile.name, size, ext)) as handle:
+                    image = Image.open(handle)
+                    self.assertEqual(image.format, fmt)
+                    self.assertEqual(image.width, min(renditions.SIZES[size], 2000))
+
+    def test_uploaded_image_built_in_pool(self):
+        self.client.force_login(self.owner)
+        content = image_file(size=(2000, 1000)).read()
+        upload = self.client.post(
+            f'/posts/{self.post.pk}/uploads/',
+            {'files': [{'filename': 'photo.png', 'size': len(content)}]},
+            content_type='application/json',
+        ).json()[0]
+        self.client.put(f'/uploads/{upload["id"]}/', content, content_type='application/octet-stream')
+        threads = set()
+        real_generate = renditions.generate
+
+        def generate(fieldfile, sizes):
+            threads.add(threading.current_thread().name)
+            return real_generate(fieldfile, sizes)
+
+        with mock.patch('apartament.renditions.generate', generate):
+            response = self.client.post(
+                f'/posts/{self.post.pk}/uploads/commit/', {'uploads': [upload['id']]},
+                content_type='application/json',
+            )
+            self.assertEqual(response.status_code, 201)
+            image_id = response.json()[0]['id']
+            self.wait_ready(image_id)
+        self.assertTrue(all(name.startswith('renditions') for name in threads))
+        self.assertRenditions(PostImage.objects.get(pk=image_id).image, renditions.POST_IMAGE_SIZES)
+
+    @override_settings(RENDITIONS_ASYNC=False)
+    def test_original_shown_until_ready(self):
+        with mock.patch('apartament.renditions.schedule'):
+            image = PostImage.objects.create(post=self.post, image=image_file())
+        self.assertEqual(preview_url(image.image, image.renditions_ready), image.image.url)
+        self.assertTrue(renditions.build_post_image(image.pk))
+        image.refresh_from_db()
+        self.assertTrue(image.renditions_ready)
+        self.assertIn('/renditions/admin/', preview_url(image.image, image.renditions_ready))
+
+    def test_replaced_image_not_marked_ready(self):
+        with mock.patch('apartament.renditions.schedule'):
+            image = PostImage.objects.create(post=self.post, image=image_file())
+        real_generate = renditions.generate
+
+        def generate(fieldfile, sizes):
+            real_generate(fieldfile, sizes)
+            # Пока строились копии, фотографию заменили
+            PostImage.objects.filter(pk=image.pk).update(image='posts/other.png')
+
+        with mock.patch('apartament.renditions.generate', generate):
+            renditions.build_post_image(image.pk)
+        self.assertFalse(PostImage.objects.get(pk=image.pk).renditions_ready)
+
+    def test_backfill(self):
+        with mock.patch('apartament.renditions.schedule'):
+            images = [PostImage.objects.create(post=self.post, image=image_file(size=(2000, 1000)))
+                      for _ in range(3)]
+            profile = self.owner.profile
+            profile.avatar = image_file('avatar.png')
+            profile.save()
+        out = StringIO()
+        call_command('backfill_renditions', workers=2, batch_size=2, stdout=out)
+        self.assertIn('Построено: 4, ошибок: 0', out.getvalue())
+        self.assertFalse(PostImage.objects.filter(renditions_ready=False).exists())
+        for image in images:
+            self.assertRenditions(image.image, renditions.POST_IMAGE_SIZES)
+        profile.refresh_from_db()
+        self.assertTrue(profile.avatar_renditions_ready)
+        out = StringIO()
+        call_command('backfill_renditions', stdout=out)
+        self.assertIn('Построено: 0, ошибок: 0', out.getvalue())
+
+
+class PostUpdateMainImageTests(MediaRootMixin, FixturesMixin, TestCase):
+    def setUp(self):
+        self.client.force_login(self.owner)
+        self.post = make_post(self.owner, self.category)
+        self.first, self.second = (PostImage.objects.create(post=self.post, image=image_file()) for _ in range(2))
+
+    def update(self, main_image):
+        return self.client.post(f'/{self.post.pk}/update', {
+            'title': 'Новый заголовок', 'description': 'Описание', 'category': self.category.pk,
+            'price': 30000, 'area': 40, 'rooms': 2, 'address': 'Москва', 'contact_phone': '+79990000000',
+            'main_image': main_image,
+        })
+
+    def test_sets_main_image(self):
+        self.assertRedirects(self.update(str(self.second.pk)), '/edit', fetch_redirect_response=False)
+        self.assertEqual(list(self.post.images.filter(is_main=True)), [self.second])
+
+    def test_invalid_main_image_is_form_error(self):
+        other = PostImage.objects.create(post=make_post(self.owner, self.category), image=image_file())
+        for value in ('abc', '-1', '1.5', str(other.pk)):
+            with self.subTest(value=value):
+                response = self.update(value)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('Выберите основное изображение', str(response.context['form'].non_field_errors()))
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.title, 'Квартира')
+        self.assertFalse(PostImage.objects.filter(is_main=True).exists())
+
+
+class ListingQueryTests(MediaRootMixin, FixturesMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for number in range(12):
+            post = make_post(cls.owner, cls.category, title=f'Квартира {number}')
+            for _ in range(2):
+                PostImage.objects.create(post=post, image=image_file())
+        reconcile_site_stats()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_listing_query_count(self):
+        # Страница, фасеты и статистика - независимо от числа объявлений и фото
+        with self.assertNumQueries(3):
+            response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['posts']), 9)
+        self.assertContains(response, 'fa-camera', count=9)
+
+
+class PostAdminTests(MediaRootMixin, FixturesMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.admin = User.objects.create_superuser('boss', password='secret')
+        for number in range(10):
+            post = make_post(cls.owner, cls.category, title=f'Квартира {number}')
+            PostImage.objects.create(post=post, image=image_file())
+            Comment.objects.create(post=post, owner=cls.owner, content='Комментарий')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def changelist(self, **params):
+        return self.client.get('/admin/apartament/post/', params)
+
+    def test_changelist_query_count(self):
+        self.changelist()
+        # Сессия, пользователь, категории для фильтра, число строк, страница
+        # со всеми колонками и права для меню - независимо от числа объявлений
+        with self.assertNumQueries(7):
+            response = self.changelist()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['cl'].result_list), 10)
+        make_post(self.owner, self.category)
+        with self.assertNumQueries(7):
+            self.changelist()
+
+    def test_search_by_partial_owner_username(self):
+        other = User.objects.create_user('ivanov')
+        post = make_post(other, self.category, title='Дача')
+        response = self.changelist(q='ivan')
+        self.assertEqual(list(response.context['cl'].result_list), [post])
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Планы проверяются в формате EXPLAIN QUERY PLAN SQLite')
+class QueryPlanTests(FixturesMixin, TestCase):
+    def assertUsesIndex(self, queryset, index, sorted_by_index=False):
+        plan = queryset.explain()
+        self.assertRegex(plan, rf'USING (COVERING )?INDEX {index}\b')
+        if sorted_by_index:
+            self.assertNotIn('TEMP B-TREE FOR ORDER BY', plan)
+
+    def listing(self, query, sort):
+        prefix = '-' if sort.startswith('-') else ''
+        return filter_posts(QueryDict(query)).order_by(sort, f'{prefix}pk')[:9]
+
+    def test_listing_sorts(self):
+        self.assertUsesIndex(self.listing('', '-created'), 'post_status_created_idx')
+        self.assertUsesIndex(self.listing('', 'price'), 'post_status_price_idx', sorted_by_index=True)
+        self.assertUsesIndex(self.listing('', '-views'), 'post_status_views_idx')
+
+    def test_listing_filters(self):
+        self.assertUsesIndex(self.listing('max_price=50000', 'price'), 'post_status_price_idx')
+        self.assertUsesIndex(self.listing('rooms=2&min_area=40', '-created'), 'post_status_rooms_area_idx')
+
+    def test_owner_posts_by_status(self):
+        queryset = Post.objects.filter(owner=self.owner, status='active')
+        self.assertUsesIndex(queryset, 'post_owner_status_idx')
+
+    def test_active_comments_of_post(self):
+        queryset = Comment.objects.filter(post_id=1, active=True).order_by('created')
+        self.assertUsesIndex(queryset, 'comment_post_active_idx', sorted_by_index=True)
+
+    def test_search_uses_fts_and_post_indexes(self):
+        for query in ('q=балкон', 'q=балкон&max_price=50000'):
+            with self.subTest(query=query):
+                plan = filter_posts(QueryDict(query)).order_by('rank', 'pk')[:9].explain()
+                # Совпадения берутся из индекса FTS5, строки объявлений - по ключу или индексу
+                self.assertRegex(plan, r'apartament_post_fts VIRTUAL TABLE INDEX \d+:=?M')
+                self.assertRegex(plan, r'SEARCH apartament_post USING (INTEGER PRIMARY KEY|INDEX)')
+                self.assertIsNone(re.search(r'SCAN apartament_post\b(?!_fts)', plan))
+
+    def test_no_full_scans_for_filter_combinations(self):
+        call_command('check_query_plans', stdout=StringIO())
+
+
+class FacetTests(FixturesMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = Category.objects.create(name='Студия')
+        for rooms, price, category in (
+            (1, 15000, cls.category), (2, 25000, cls.category), (2, 50000, cls.other),
+            (5, 80000, cls.category), (6, 150000, cls.other),
+        ):
+            make_post(cls.owner, category, rooms=rooms, price=price)
+        make_post(cls.owner, cls.category, rooms=2, price=25000, status='draft')
+
+    def facets(self, query):
+        return facet_counts(QueryDict(query))
+
+    def rooms(self, facets):
+        return {option['value']: option['count'] for option in facets['rooms']}
+
+    def test_without_filters(self):
+        facets = self.facets('')
+        self.assertEqual(facets['total'], 5)
+        self.assertEqual(self.rooms(facets), {1: 1, 2: 2, 3: 0, 4: 0, 5: 2})
+        self.assertEqual([option['count'] for option in facets['price']], [1, 1, 1, 1, 1])
+
+    def test_facet_ignores_its_own_filter(self):
+        facets = self.facets('rooms=2')
+        self.assertEqual(facets['total'], 2)
+        # Остальные варианты комнат считаются так, будто фильтра по комнатам нет
+        self.assertEqual(self.rooms(facets), {1: 1, 2: 2, 3: 0, 4: 0, 5: 2})
+        # Цены - с учетом выбранных комнат
+        self.assertEqual([option['count'] for option in facets['price']], [0, 1, 1, 0, 0])
+        self.assertEqual(
+            {category['name']: category['count'] for category in facets['categories']},
+            {'Квартира': 1, 'Студия': 1},
+        )
+
+    def test_facets_combine_other_filters(self):
+        facets = self.facets('rooms=2&max_price=30000')
+        self.assertEqual(facets['total'], 1)
+        self.assertEqual(self.rooms(facets), {1: 1, 2: 1, 3: 0, 4: 0, 5: 0})
+        self.assertEqual([option['count'] for option in facets['price']], [0, 1, 1, 0, 0])
+
+    def test_open_ended_rooms_option(self):
+        self.assertEqual(self.facets('rooms=5')['total'], 2)
+        self.assertEqual(filter_posts(QueryDict('rooms=5')).count(), 2)
+
+
+@override_settings(VIEW_COUNTER_BACKGROUND_FLUSH=False)
+class ViewCounterTests(FixturesMixin, TestCase):
+    def setUp(self):
+        self.post = make_post(self.owner, self.category)
+        reconcile_site_stats()
+        get_owner_stats(self.owner)
+        self.counter = ViewCounter(flush_interval=3600, flush_threshold=1000)
+
+    def assertViews(self, views):
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.views, views)
+        self.assertEqual(SiteStats.objects.get().total_views, views)
+        self.assertEqual(get_owner_stats(self.owner).total_views, views)
+
+    def test_buffered_until_flush(self):
+        self.counter.add(self.post.pk)
+        self.counter.add(self.post.pk)
+        self.assertViews(0)
+        self.assertEqual(self.counter.flush(), 2)
+        self.assertViews(2)
+
+    def test_threshold_triggers_flush(self):
+        counter = ViewCounter(flush_interval=3600, flush_threshold=3)
+        for _ in range(3):
+            counter.add(self.post.pk)
+        self.assertViews(3)
+
+    def test_failed_flush_is_retried_without_double_counting(self):
+        self.counter.add(self.post.pk, 2)
+        with mock.patch('apartament.stats.record_owner_views', side_effect=DatabaseError), \
+                self.assertLogs('apartament.counters', 'ERROR'):
+            self.assertEqual(self.counter.flush(), 0)
+        self.assertViews(0)
+        self.assertEqual(self.counter.flush(), 2)
+        self.assertViews(2)
+
+    @override_settings(VIEW_COUNTER_BACKGROUND_FLUSH=True)
+    def test_background_thread_flushes_idle_buffer(self):
+        counter = ViewCounter(flush_interval=0.05, flush_threshold=1000)
+        flushed = threading.Event()
+
+        def flush():
+            counter._pending.clear()
+            flushed.set()
+
+        with mock.patch.object(counter, 'flush', side_effect=flush):
+            counter.add(self.post.pk)
+            # Новых просмотров нет, но буфер все равно сбрасывается по времени
+            self.assertTrue(flushed.wait(2))
+
+    def test_interval_triggers_flush_on_next_view(self):
+        counter = ViewCounter(flush_interval=60, flush_threshold=1000)
+        counter.add(self.post.pk)
+        self.assertViews(0)
+        counter._last_flush -= 60
+        counter.add(self.post.pk)
+        self.assertViews(2)
+
+
+# Скрипт отдельного процесса: просмотры остаются в буфере до выхода
+SHUTDOWN_SCRIPT = '''
+import os, sys
+os.environ['DJANGO_SETTINGS_MODULE'] = 'arenda.settings'
+import django
+from django.conf import settings
+settings.DATABASES['default']['NAME'] = sys.argv[1]
+settings.VIEW_COUNTER_BACKGROUND_FLUSH = False
+django.setup()
+from apartament.counters import view_counter
+view_counter.add(int(sys.argv[2]), 3)
+'''
+
+
+@skipUnless(connection.vendor == 'sqlite', 'База для отдельного процесса - копия тестовой базы SQLite')
+class ViewCounterFlushTests(TransactionTestCase):
+    """Сброс из фонового потока и при выходе процесса - с зафиксированными данными"""
+
+    def setUp(self):
+        owner = User.objects.create_user('owner')
+        self.post = make_post(owner, Category.objects.create(name='Квартира'))
+        reconcile_site_stats()
+        get_owner_stats(owner)
+
+    @override_settings(VIEW_COUNTER_BACKGROUND_FLUSH=True)
+    def test_background_thread_writes_views(self):
+        counter = ViewCounter(flush_interval=0.05, flush_threshold=1000)
+        flushed = threading.Event()
+        real_flush = counter.flush
+
+        def flush():
+            written = real_flush()
+            if written:
+                flushed.set()
+            return written
+
+        # Ждем сам сброс, а не опрашиваем таблицу: общая база SQLite в памяти
+        # не ждет блокировку, а сразу отвечает "table is locked"
+        with mock.patch.object(counter, 'flush', flush):
+            counter.add(self.post.pk, 2)
+            self.assertTrue(flushed.wait(5), 'Просмотры не записаны')
+        self.assertEqual(Post.objects.get(pk=self.post.pk).views, 2)
+        self.assertEqual(SiteStats.objects.get().total_views, 2)
+
+    def test_buffer_flushed_at_exit(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, 'db.sqlite3')
+        connection.ensure_connection()
+        target = sqlite3.connect(path)
+        connection.connection.backup(target)
+        target.close()
+
+        subprocess.run(
+            [sys.executable, '-c', SHUTDOWN_SCRIPT, path, str(self.post.pk)],
+            cwd=settings.BASE_DIR, check=True, timeout=60,
+        )
+        with closing(sqlite3.connect(path)) as db:
+            views = db.execute('SELECT views FROM apartament_post WHERE id = ?', [self.post.pk]).fetchone()
+            total = db.execute('SELECT total_views FROM apartament_sitestats').fetchone()
+            owner_total = db.execute('SELECT total_views FROM apartament_ownerstats').fetchone()
+        self.assertEqual((views, total, owner_total), ((3,), (3,), (3,)))
+
+
+@override_settings(VIEW_COUNTER_BACKGROUND_FLUSH=False)
+class DetailQueryTests(MediaRootMixin, FixturesMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.commenter = User.objects.create_user('commenter', password='secret')
+        get_owner_stats(self.owner)
+
+    def tearDown(self):
+        # Просмотры из буфера пишутся в тестовую транзакцию, а не при выходе процесса
+        view_counter.flush()
+
+    def make_detail(self, comments, images):
+        post = make_post(self.owner, self.category)
+        for number in range(comments):
+            Comment.objects.create(post=post, owner=self.commenter, content=f'Комментарий {number}')
+        Comment.objects.create(post=post, owner=self.commenter, content='Скрытый', active=False)
+        for _ in range(images):
+            PostImage.objects.create(post=post, image=image_file())
+        return post
+
+    def test_query_count_does_not_grow(self):
+        for comments, images in ((1, 1), (8, 5)):
+            with self.subTest(comments=comments, images=images):
+                post = self.make_detail(comments, images)
+                # Объявление с владельцем, изображения, комментарии, счетчики владельца
+                with self.assertNumQueries(4):
+                    response = self.client.get(f'/{post.pk}/')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.context['comments']), comments)
+                self.assertEqual(len(response.context['images']), images)
+                self.assertEqual(response.context['owner_stats'].total_posts, Post.objects.count())
+
+    def test_owner_stats_created_on_first_view(self):
+        post = make_post(self.commenter, self.category)
+        response = self.client.get(f'/{post.pk}/')
+        self.assertEqual(response.context['owner_stats'].total_posts, 1)
+
+    def test_comment_form_errors(self):
+        post = self.make_detail(1, 0)
+        self.client.force_login(self.commenter)
+        response = self.client.post(f'/{post.pk}/', {'content': ''})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['comments']), 1)
+        self.assertEqual(post.comments.count(), 2)
+
+
+@override_settings(VIEW_COUNTER_BACKGROUND_FLUSH=False)
+class AsyncDetailTests(TransactionTestCase):
+    """Без тестовой транзакции запросы страницы идут в разных потоках"""
+
+    def setUp(self):
+        # Потоки gather_queries не держат соединений: с CONN_MAX_AGE > 0
+        # PostgreSQL не дал бы удалить тестовую базу
+        patcher = mock.patch.dict(connection.settings_dict, {'CONN_MAX_AGE': 0})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        view_counter.flush()
+        cache.clear()
+
+    async def test_detail_gathers_queries_in_threads(self):
+        self.assertTrue(PostinDetailView.view_is_async)
+        post = await sync_to_async(self.make_detail)()
+        threads = set()
+        real_gather = parallel.gather_queries
+
+        async def gather(*calls):
+            def track(call):
+                def run():
+                    threads.add(threading.get_ident())
+                    return call()
+                return run
+            return await real_gather(*map(track, calls))
+
+        with mock.patch('apartament.views.gather_queries', gather):
+            response = await self.async_client.get(f'/{post.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['comments']), 2)
+        self.assertEqual(len(response.context['images']), 0)
+        self.assertGreater(len(threads), 1)
+        response = await self.async_client.get(
+            f'/{post.pk}/', headers={'If-None-Match': response['ETag']}
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def make_detail(self):
+        owner = User.objects.create_user('owner', password='secret')
+        post = make_post(owner, Category.objects.create(name='Квартира'))
+        for number in range(2):
+            Comment.objects.create(post=post, owner=owner, content=f'Комментарий {number}')
+        return post
+
+
+@override_settings(VIEW_COUNTER_BACKGROUND_FLUSH=False)
+class ConditionalGetTests(FixturesMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        view_counter.flush()
+
+    def revalidate(self, post):
+        etag = self.client.get(f'/{post.pk}/')['ETag']
+        with mock.patch('apartament.views.record_view') as record:
+            response = self.client.get(f'/{post.pk}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        return record
+
+    def test_not_modified_counts_active_post_from_cache(self):
+        post = make_post(self.owner, self.category)
+        etag = self.client.get(f'/{post.pk}/')['ETag']
+        with mock.patch('apartament.views.record_view') as record, self.assertNumQueries(0):
+            self.client.get(f'/{post.pk}/', HTTP_IF_NONE_MATCH=etag)
+        record.assert_called_once()
+
+    def test_not_modified_skips_inactive_post(self):
+        post = make_post(self.owner, self.category, status='moderation')
+        self.revalidate(post).assert_not_called()
+
+    def test_not_modified_after_status_change(self):
+        post = make_post(self.owner, self.category)
+        self.client.get(f'/{post.pk}/')
+        post.status = 'archived'
+        post.save()
+        self.revalidate(post).assert_not_called()
+
+    def test_comment_invalidates_listing(self):
+        post = make_post(self.owner, self.category)
+        self.assertEqual(self.client.get('/')['X-Page-Cache'], 'miss')
+        self.assertEqual(self.client.get('/')['X-Page-Cache'], 'hit')
+        comment = Comment.objects.create(post=post, owner=self.owner, content='Хорошо')
+        self.assertEqual(self.client.get('/')['X-Page-Cache'], 'miss')
+        self.client.get('/')
+        comment.delete()
+        self.assertEqual(self.client.get('/')['X-Page-Cache'], 'miss')
+
+
+class StampedeTests(TestCase):
+    key = 'pagecache:test'
+
+    def setUp(self):
+        cache.clear()
+        self.renders = 0
+
+    def render(self, started=None, release=None):
+        def render():
+            self.renders += 1
+            if started:
+                started.set()
+                release.wait(5)
+            return HttpResponse(f'страница {self.renders}'), True
+        return render
+
+    def rebuild_in_thread(self):
+        """Поток берет блокировку и перестраивает страницу, пока тест его не отпустит"""
+        started, release = threading.Event(), threading.Event()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            cached_page(self.key, self.render(started, release))
+        ))
+        thread.start()
+        self.assertTrue(started.wait(5))
+        return release, thread, results
+
+    def test_stale_page_rebuilt_once(self):
+        cached_page(self.key, self.render())
+        entry = cache.get(self.key)
+        cache.set(self.key, {**entry, 'fresh_until': 0})
+
+        release, thread, results = self.rebuild_in_thread()
+        # Остальные запросы не ждут и не рендерят: отдается устаревшая копия
+        for _ in range(5):
+            response = cached_page(self.key, self.render())
+            self.assertEqual((response['X-Page-Cache'], response.content.decode()), ('stale', 'страница 1'))
+        release.set()
+        thread.join(5)
+        self.assertEqual(self.renders, 2)
+        self.assertEqual(results[0]['X-Page-Cache'], 'miss')
+        self.assertEqual(cached_page(self.key, self.render())['X-Page-Cache'], 'hit')
+
+    def test_missing_page_waits_for_first_render(self):
+        release, thread, _ = self.rebuild_in_thread()
+        threading.Timer(0.2, release.set).start()
+        response = cached_page(self.key, self.render())
+        thread.join(5)
+        self.assertEqual((response['X-Page-Cache'], response.content.decode()), ('hit', 'страница 1'))
+        self.assertEqual(self.renders, 1)
+
+
+class SharedCacheCheckTests(SimpleTestCase):
+    def check(self, workers):
+        with mock.patch.dict(os.environ, {'WEB_CONCURRENCY': workers}):
+            return [message.id for message in check_shared_cache(None)]
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_local_cache_with_several_workers(self):
+        self.assertEqual(self.check('4'), ['apartament.W001'])
+        self.assertEqual(self.check('1'), [])
+        self.assertEqual(self.check(''), [])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                                           'LOCATION': 'redis://localhost:6379'}})
+    def test_shared_cache(self):
+        self.assertEqual(self.check('4'), [])
+
+
+class MediaServeTests(MediaRootMixin, TestCase):
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        os.makedirs(os.path.join(self.media_root, 'posts'), exist_ok=True)
+        with open(os.path.join(self.media_root, 'posts', 'photo.jpg'), 'wb') as handle:
+            handle.write(self.content)
+
+    def get(self, path='/media/posts/photo.jpg', **headers):
+        return self.client.get(path, **headers)
+
+    def test_full_file_with_validators(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertTrue(response['ETag'])
+
+    def test_conditional_get(self):
+        etag = self.get()['ETag']
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_byte_ranges(self):
+        response = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(response['Content-Length'], '10')
+
+        response = self.get(HTTP_RANGE='bytes=-4')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-4:])
+
+        response = self.get(HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+
+    def test_stale_if_range_returns_whole_file(self):
+        response = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"old"')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(MEDIA_SERVE_MODE='x-accel')
+    def test_proxy_offload(self):
+        response = self.get()
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/posts/photo.jpg')
+        self.assertEqual(response.content, b'')
+
+    @override_settings(MEDIA_SERVE_MODE='x-accel')
+    def test_proxy_offload_leaves_ranges_to_proxy(self):
+        response = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Range', response)
+
+    def test_proxy_offload_encodes_cyrillic_names(self):
+        with open(os.path.join(self.media_root, 'posts', 'квартира 1.jpg'), 'wb') as handle:
+            handle.write(self.content)
+        with override_settings(MEDIA_SERVE_MODE='x-accel'):
+            response = self.get('/media/posts/квартира 1.jpg')
+        self.assertEqual(
+            response['X-Accel-Redirect'],
+            '/protected-media/posts/%D0%BA%D0%B2%D0%B0%D1%80%D1%82%D0%B8%D1%80%D0%B0%201.jpg',
+        )
+        with override_settings(MEDIA_SERVE_MODE='x-sendfile'):
+            response = self.get('/media/posts/квартира 1.jpg')
+        self.assertTrue(response['X-Sendfile'].endswith('/posts/%D0%BA%D0%B2%D0%B0%D1%80%D1%82%D0%B8%D1%80%D0%B0%201.jpg'))
+
+    def test_missing_and_outside_files(self):
+        self.assertEqual(self.get('/media/posts/missing.jpg').status_code, 404)
+        self.assertEqual(self.get('/media/../manage.py').status_code, 404)
+        self.assertEqual(self.get('/media/posts').status_code, 404)
+
+
+class ListApiTests(MediaRootMixin, FixturesMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for number in range(25):
+            post = make_post(cls.owner, cls.category, title=f'Квартира {number}')
+            Comment.objects.create(post=post, owner=cls.owner, content='Хорошо')
+        PostImage.objects.create(post=post, image=image_file())
+
+    def setUp(self):
+        cache.clear()
+
+    def test_post_list_matches_detail_serializer(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/posts/')
+        rows = response.json()['results']
+        self.assertEqual(len(rows), 20)
+        detail = self.client.get(f'/posts/{rows[0]["id"]}/').json()
+        for name in ('description', 'contact_phone'):
+            del detail[name]
+        self.assertEqual(rows[0], detail)
+        self.assertTrue(rows[0]['cover'])
+        self.assertEqual(rows[0]['comments_count'], 1)
+
+    def test_post_list_pages_through_values(self):
+        first = self.client.get('/posts/').json()
+        second = self.client.get(first['next']).json()
+        ids = [row['id'] for row in first['results'] + second['results']]
+        self.assertEqual(ids, list(Post.objects.order_by('-created').values_list('pk', flat=True)))
+        self.assertIsNone(second['next'])
+
+    def test_comment_list(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/comments/')
+        row = response.json()['results'][0]
+        self.assertEqual(set(row), {'id', 'content', 'name', 'post', 'created', 'updated', 'active'})
+        self.assertEqual(row['name'], 'owner')
+
+
+@override_settings(RENDITIONS_ASYNC=False)
+class ChunkedUploadTests(MediaRootMixin, FixturesMixin, TestCase):
+    def setUp(self):
+        self.temp_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_root, ignore_errors=True)
+        temp_override = override_settings(UPLOAD_TEMP_ROOT=self.temp_root)
+        temp_override.enable()
+        self.addCleanup(temp_override.disable)
+        self.client.force_login(self.owner)
+        self.post = make_post(self.owner, self.category)
+
+    def start_upload(self, content):
+        response = self.client.post(
+            f'/posts/{self.post.pk}/uploads/',
+            {'files': [{'filename': 'photo.png', 'size': len(content), 'is_main': True}]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json()[0]['id']
+
+    def put_chunk(self, upload_id, content, content_range=None, **extra):
+        if content_range:
+            extra['HTTP_CONTENT_RANGE'] = content_range
+        return self.client.put(
+            f'/uploads/{upload_id}/', content, content_type='application/octet-stream', **extra
+        )
+
+    def commit(self, data):
+        return self.client.post(
+            f'/posts/{self.post.pk}/uploads/commit/', data, content_type='application/json'
+        )
+
+    def test_upload_and_commit(self):
+        content = image_file().read()
+        upload_id = self.start_upload(content)
+        half = len(content) // 2
+        self.assertEqual(self.put_chunk(upload_id, content[:half]).json()['received'], half)
+        response = self.put_chunk(
+            upload_id, content[half:], f'bytes {half}-{len(content) - 1}/{len(content)}'
+        )
+        self.assertEqual(response.json()['received'], len(content))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.commit({'uploads': [upload_id]})
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.json()[0]['is_main'])
+        image = self.post.images.get()
+        with image.image.open('rb') as handle:
+            self.assertEqual(handle.read(), content)
+        self.assertEqual(os.listdir(self.temp_root), [])
+
+    def test_failed_commit_keeps_uploads(self):
+        content = image_file().read()
+        upload_id = self.start_upload(content)
+        self.put_chunk(upload_id, content)
+        with mock.patch('apartament.uploads.persist_images', side_effect=DatabaseError), \
+                self.captureOnCommitCallbacks(execute=True), self.assertRaises(DatabaseError), \
+                self.assertLogs('django.request', 'ERROR'):
+            self.commit({'uploads': [upload_id]})
+        self.assertFalse(self.post.images.exists())
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'posts')))
+        # Загрузка и ее файл на месте - фиксацию можно повторить
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.commit({'uploads': [upload_id]}).status_code, 201)
+        self.assertEqual(self.post.images.count(), 1)
+
+    def test_same_chunk_written_once(self):
+        content = image_file().read()
+        upload_id = self.start_upload(content)
+        # Два запроса прочитали строку до записи: второй не должен испортить файл
+        first, second = ImageUpload.objects.get(pk=upload_id), ImageUpload.objects.get(pk=upload_id)
+        write_chunk(first, 0, BytesIO(content), len(content))
+        with self.assertRaises(UploadError):
+            write_chunk(second, 0, BytesIO(content[:10]), 10)
+        self.assertEqual(ImageUpload.objects.get(pk=upload_id).received, len(content))
+        with open(temp_path(first), 'rb') as handle:
+            self.assertEqual(handle.read(), content)
+        self.assertEqual(os.listdir(self.temp_root), [str(upload_id)])
+
+    def test_invalid_content_length(self):
+        upload_id = self.start_upload(image_file().read())
+        response = self.put_chunk(upload_id, b'1234', CONTENT_LENGTH='abc')
+        self.assertEqual(response.status_code, 400)
+
+    def test_commit_rejects_invalid_body(self):
+        self.assertEqual(self.commit(['not-a-dict']).status_code, 400)
+        self.assertEqual(self.commit({'uploads': ['not-a-uuid']}).status_code, 400)
+        self.assertEqual(self.commit({'uploads': []}).status_code, 400)
+
+    def test_commit_rejects_non_image(self):
+        content = b'not an image at all'
+        upload_id = self.start_upload(content)
+        self.put_chunk(upload_id, content)
+        response = self.commit({'uploads': [upload_id]})
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('не является изображением', response.json()['detail'])
+        self.assertFalse(self.post.images.exists())
+
+    def test_empty_and_inverted_chunks(self):
+        content = image_file().read()
+        upload_id = self.start_upload(content)
+        self.assertEqual(self.put_chunk(upload_id, b'').status_code, 400)
+        response = self.put_chunk(upload_id, content[:10], f'bytes 10-0/{len(content)}')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(f'/uploads/{upload_id}/').json()['received'], 0)
+
+    def test_start_rejects_extension(self):
+        response = self.client.post(
+            f'/posts/{self.post.pk}/uploads/',
+            {'files': [{'filename': 'script.exe', 'size': 10}]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(MODERATION_CHUNK_SIZE=1)
+class ModerationJobTests(FixturesMixin, TestCase):
+    def setUp(self):
+        self.posts = [make_post(self.owner, self.category, status='moderation') for _ in range(2)]
+        reconcile_site_stats()
+
+    def make_job(self, **fields):
+        ids = [post.pk for post in self.posts]
+        return ModerationJob.objects.create(
+            action='approve_posts', object_ids=ids, total=len(ids), **fields
+        )
+
+    def test_site_stats_reconciled_after_failed_chunk(self):
+        job = self.make_job()
+        with mock.patch('apartament.moderation.reconcile_owner_stats', side_effect=[None, DatabaseError]), \
+                self.assertLogs('apartament.moderation', 'ERROR'):
+            self.assertFalse(moderation.run_job(job.pk))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed), ('failed', 1))
+        self.assertEqual(SiteStats.objects.get().active_posts, 1)
+        self.assertEqual(get_owner_stats(self.owner).active_posts, 1)
+
+    def test_admin_resumes_only_failed_and_abandoned_jobs(self):
+        now = timezone.now()
+        failed = self.make_job(status='failed', error='Ошибка')
+        stale = self.make_job(status='running', heartbeat=now - timedelta(hours=1))
+        running = self.make_job(status='running', heartbeat=now)
+        done = self.make_job(status='done')
+        admin = site._registry[ModerationJob]
+        with mock.patch('apartament.moderation.schedule') as schedule, \
+                mock.patch.object(admin, 'message_user'):
+            admin.resume_jobs(RequestFactory().post('/'), ModerationJob.objects.all())
+        self.assertEqual(
+            sorted(call.args[0] for call in schedule.call_args_list), sorted([failed.pk, stale.pk])
+        )
+        statuses = dict(ModerationJob.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses[failed.pk], 'pending')
+        self.assertEqual(statuses[running.pk], 'running')
+        self.assertEqual(statuses[done.pk], 'done')
+
+
+@override_settings(MODERATION_BATCH_SIZE=2, MODERATION_LEASE=600)
+class ModerationQueueTests(FixturesMixin, TestCase):
+    def setUp(self):
+        self.first = User.objects.create_user('first', password='secret', is_staff=True)
+        self.second = User.objects.create_user('second', password='secret', is_staff=True)
+        self.posts = [make_post(self.owner, self.category, status='moderation') for _ in range(5)]
+
+    def test_claim_batch_does_not_overlap(self):
+        first = list(moderation.claim_batch(self.first))
+        second = list(moderation.claim_batch(self.second))
+        self.assertEqual(first, self.posts[:2])
+        self.assertEqual(second, self.posts[2:4])
+        # Повторный запрос продлевает аренду и не добавляет лишнего
+        self.assertEqual(list(moderation.claim_batch(self.first)), self.posts[:2])
+
+    def test_expired_lease_returns_posts_to_queue(self):
+        moderation.claim_batch(self.first)
+        Post.objects.filter(claimed_by=self.first).update(claim_expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(list(moderation.claimed_posts(self.first)), [])
+        self.assertEqual(list(moderation.claim_batch(self.second)), self.posts[:2])
+        self.assertFalse(moderation.decide(self.first, self.posts[0].pk, 'active'))
+
+    def test_decide(self):
+        moderation.claim_batch(self.first)
+        self.assertFalse(moderation.decide(self.second, self.posts[0].pk, 'active'))
+        self.assertTrue(moderation.decide(self.first, self.posts[0].pk, 'active'))
+        self.assertFalse(moderation.decide(self.first, self.posts[0].pk, 'rejected'))
+        post = Post.objects.get(pk=self.posts[0].pk)
+        self.assertEqual((post.status, post.claimed_by, post.claim_expires), ('active', None, None))
+
+    def test_release(self):
+        moderation.claim_batch(self.first)
+        self.assertEqual(moderation.release(self.first), 2)
+        self.assertEqual(list(moderation.claim_batch(self.second)), self.posts[:2])
+
+    def test_list_does_not_claim(self):
+        self.client.force_login(self.first)
+        response = self.client.get('/moderation/')
+        self.assertEqual(list(response.context['posts']), [])
+        self.assertFalse(Post.objects.filter(claimed_by__isnull=False).exists())
+
+        self.assertRedirects(self.client.post('/moderation/claim/'), '/moderation/')
+        self.assertEqual(list(self.client.get('/moderation/').context['posts']), self.posts[:2])
+        self.assertEqual(self.client.get('/moderation/claim/').status_code, 405)
+
+    def test_staff_only(self):
+        moderation.claim_batch(self.first)
+        self.client.force_login(self.owner)
+        for path in ('/moderation/', '/moderation/claim/', '/moderation/release/',
+                     f'/moderation/{self.posts[0].pk}/approve/'):
+            self.assertRedirects(self.client.post(path), '/', fetch_redirect_response=False)
+        self.assertEqual(Post.objects.filter(claimed_by=self.first).count(), 2)
+        self.assertFalse(Post.objects.filter(claimed_by=self.owner).exists())
+
+
+class PostCardCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        now = timezone.now()
+        self.cover = PostImage(pk=1, image='posts/photo.jpg', renditions_ready=False)
+        self.post = Post(
+            pk=1, title='Квартира', description='Описание', address='Москва', price=30000,
+            rooms=2, area=40, status='active', owner=User(pk=1, username='owner'),
+            category=Category(pk=1, name='Квартира'), cover=self.cover, created=now, updated=now,
+        )
+        self.post.images_count = 1
+
+    def render(self):
+        # Без контекст-процессора срок кэша берется по умолчанию
+        return render_to_string('main/post_card.html', {'post': self.post, 'show_status': False})
+
+    def test_category_rename_changes_card(self):
+        self.assertIn('</i>Квартира', self.render())
+        self.post.category.name = 'Апартаменты'
+        self.assertIn('</i>Апартаменты', self.render())
+
+    def test_ready_renditions_change_card(self):
+        self.assertNotIn('<picture>', self.render())
+        self.cover.renditions_ready = True
+        self.assertIn('<picture>', self.render())
+
+    def test_owner_rename_changes_card(self):
+        self.assertIn('</i>owner', self.render())
+        self.post.owner.username = 'landlord'
+        self.assertIn('</i>landlord', self.render())
+
+    def test_nav_cached_per_staff_flag(self):
+        request = RequestFactory().get('/')
+        request.resolver_match = resolve('/')
+        user = User(pk=1, username='owner')
+        keys = set()
+        for is_staff in (False, True):
+            user.is_staff = is_staff
+            request.user = user
+            with mock.patch('django.templatetags.cache.make_template_fragment_key',
+                            wraps=make_template_fragment_key) as make_key:
+                render_to_string('main/layout.html', request=request)
+            keys.update(tuple(call.args[1]) for call in make_key.call_args_list if call.args[0] == 'layout_nav')
+        self.assertEqual(len(keys), 2)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+@skipUnless(connection.vendor == 'sqlite', 'Реплика - копия тестовой базы SQLite')
+class ReplicaRoutingTests(TransactionTestCase):
+    """Реплика - файл SQLite с копией базы до правки заголовка: она "отстает" """
+
+    def setUp(self):
+        cache.clear()
+        owner = User.objects.create_user('owner', password='secret')
+        User.objects.create_user('staff', password='secret', is_staff=True)
+        self.post = make_post(owner, Category.objects.create(name='Квартира'), title='Старый')
+        self.add_replica()
+        Post.objects.filter(pk=self.post.pk).update(title='Новый')
+
+    def add_replica(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, 'replica.sqlite3')
+        connection.ensure_connection()
+        target = sqlite3.connect(path)
+        connection.connection.backup(target)
+        target.close()
+        # Соединение без записи в DATABASES: тестовый раннер не создает и не очищает его базу
+        default = connections['default']
+        connections['replica'] = type(default)({**default.settings_dict, 'NAME': path}, 'replica')
+        self.addCleanup(self.remove_replica)
+
+    def remove_replica(self):
+        connections['replica'].close()
+        del connections['replica']
+
+    def title(self, **extra):
+        return self.client.get(f'/posts/{self.post.pk}/', **extra).json()['title']
+
+    def test_anonymous_reads_replica_without_primary_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.title(), 'Старый')
+        self.assertEqual(len(queries), 0)
+
+    def test_staff_session_reads_primary(self):
+        self.client.login(username='staff', password='secret')
+        self.client.cookies.pop(routers.STICKY_COOKIE, None)
+        self.assertEqual(self.title(), 'Новый')
+
+    def test_user_session_reads_replica(self):
+        self.client.login(username='owner', password='secret')
+        self.client.cookies.pop(routers.STICKY_COOKIE, None)
+        self.assertEqual(self.title(), 'Старый')
+
+    def test_basic_auth_staff_reads_primary(self):
+        credentials = base64.b64encode(b'staff:secret').decode()
+        self.assertEqual(self.title(HTTP_AUTHORIZATION=f'Basic {credentials}'), 'Новый')
+
+    def test_sticky_after_write(self):
+        response = self.client.post('/login', {'username': 'owner', 'password': 'wrong'})
+        self.assertGreater(float(response.cookies[routers.STICKY_COOKIE].value), time.time())
+        self.assertEqual(self.title(), 'Новый')
+        self.client.cookies[routers.STICKY_COOKIE] = str(time.time() - 1)
+        self.assertEqual(self.title(), 'Старый')
+
+    def test_transaction_reads_primary(self):
+        router = routers.PrimaryReplicaRouter()
+        token = routers._replica_reads.set(RequestFactory().get('/'))
+        try:
+            self.assertEqual(router.db_for_read(Post), 'replica')
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Post), 'default')
+            with routers.use_primary():
+                self.assertEqual(router.db_for_read(Post), 'default')
+        finally:
+            routers._replica_reads.reset(token)
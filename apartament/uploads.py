@@ -0,0 +1,166 @@
+# uploads.py
+"""Загрузка фотографий объявлений.
+
+``persist_images`` сохраняет пачку ``PostImage`` одним ``bulk_create``
+и выполняет то, что обычно делают сигналы ``post_save``: пересчет обложки,
+сброс кэша страниц и постановку копий изображений в фоновый пул.
+
+Для API загрузка идет по частям: файл создается через ``ImageUpload``,
+его части дописываются во временный файл (``UPLOAD_TEMP_ROOT``) по
+заголовку ``Content-Range`` без чтения всего тела в память, а после
+загрузки всех частей ``commit_uploads`` создает изображения одним
+запросом и переносит файлы в хранилище.
+
+Часть сначала читается из запроса в отдельный файл, а во временный файл
+загрузки переписывается под блокировкой строки ``ImageUpload``: из двух
+одновременных запросов с одной частью ее запишет только первый.
+Изображения создаются в транзакции, а файлы переносятся после фиксации:
+если транзакция откатилась, загрузки и их файлы остаются на месте, и
+фиксацию можно повторить.
+"""
+import os
+import shutil
+from functools import partial
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from PIL import Image
+
+from . import cache as page_cache
+from . import renditions
+from .models import ImageUpload, PostImage, refresh_post_covers
+
+CHUNK_SIZE = 64 * 1024
+
+# Форматы Pillow, которые принимаются как фотографии объявлений
+IMAGE_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+
+
+class UploadError(Exception):
+    pass
+
+
+def persist_images(post, images):
+    """Сохраняет новые изображения объявления одним INSERT"""
+    if not images:
+        return []
+    # Основным может быть только одно изображение - берем последнее отмеченное
+    main = [image for image in images if image.is_main]
+    for image in main[:-1]:
+        image.is_main = False
+    with transaction.atomic():
+        if main:
+            PostImage.objects.filter(post=post, is_main=True).update(is_main=False)
+        created = PostImage.objects.bulk_create(images)
+        refresh_post_covers([post.pk])
+    page_cache.invalidate_posts([post.pk])
+    for image in created:
+        renditions.schedule(renditions.build_post_image, image.pk)
+    return created
+
+
+def temp_path(upload):
+    root = getattr(settings, 'UPLOAD_TEMP_ROOT', os.path.join(settings.MEDIA_ROOT, 'uploads_tmp'))
+    os.makedirs(root, exist_ok=True)
+    return os.path.join(root, str(upload.pk))
+
+
+def write_chunk(upload, start, stream, length):
+    """Дописывает часть файла из потока запроса. Возвращает новое смещение"""
+    if start != upload.received:
+        raise UploadError(f'Ожидалась часть с байта {upload.received}')
+    if start + length > upload.size:
+        raise UploadError('Часть выходит за размер файла')
+
+    path = temp_path(upload)
+    # Чтение тела может быть долгим - оно идет без блокировок, в свой файл
+    part_path = f'{path}.{uuid4().hex}.part'
+    try:
+        written = 0
+        with open(part_path, 'wb') as handle:
+            while written < length:
+                chunk = stream.read(min(CHUNK_SIZE, length - written))
+                if not chunk:
+                    break
+                handle.write(chunk)
+                written += len(chunk)
+        if written != length:
+            raise UploadError('Часть получена не полностью')
+
+        with transaction.atomic():
+            received = ImageUpload.objects.select_for_update().filter(
+                pk=upload.pk
+            ).values_list('received', flat=True).first()
+            if received != start:
+                raise UploadError('Часть уже была записана другим запросом')
+            with open(path, 'ab') as target, open(part_path, 'rb') as source:
+                # Хвост прерванной прошлой попытки отбрасывается
+                target.truncate(start)
+                shutil.copyfileobj(source, target, CHUNK_SIZE)
+            ImageUpload.objects.filter(pk=upload.pk).update(received=F('received') + written)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    upload.received = start + written
+    return upload.received
+
+
+def verify_image(upload):
+    """Проверяет, что загруженный файл - целое изображение допустимого формата"""
+    try:
+        with Image.open(temp_path(upload)) as image:
+            image_format = image.format
+            image.verify()
+    except Exception:
+        raise UploadError(f'Файл {upload.filename} не является изображением')
+    if image_format not in IMAGE_FORMATS:
+        raise UploadError(f'Формат {image_format} не поддерживается')
+
+
+class _TemporaryFile(File):
+    # Наличие temporary_file_path позволяет хранилищу переместить файл, а не копировать
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def _move_upload(upload, image):
+    with open(temp_path(upload), 'rb') as handle:
+        name = default_storage.save(image.image.name, _TemporaryFile(handle, name=upload.filename))
+    if name != image.image.name:
+        # Имя успели занять после выбора - строка получает фактическое
+        PostImage.objects.filter(pk=image.pk).update(image=name)
+        image.image.name = name
+
+
+def commit_uploads(post, uploads):
+    """Создает изображения и после фиксации переносит файлы в хранилище"""
+    incomplete = [upload for upload in uploads if not upload.is_complete]
+    if incomplete:
+        raise UploadError('Не все файлы загружены полностью')
+    # Все файлы проверяются до переноса, чтобы не оставить в хранилище часть пачки
+    for upload in uploads:
+        verify_image(upload)
+
+    field = PostImage._meta.get_field('image')
+    images = []
+    with transaction.atomic():
+        for upload in uploads:
+            image = PostImage(post=post, is_main=upload.is_main)
+            image.image = default_storage.get_available_name(field.generate_filename(image, upload.filename))
+            images.append(image)
+            # Регистрируется раньше постановки копий в persist_images: они строятся по перенесенному файлу
+            transaction.on_commit(partial(_move_upload, upload, image))
+        created = persist_images(post, images)
+        ImageUpload.objects.filter(pk__in=[upload.pk for upload in uploads]).delete()
+    return created
+
+
+def discard_upload(upload):
+    path = temp_path(upload)
+    if os.path.exists(path):
+        os.remove(path)
+    upload.delete()
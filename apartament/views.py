@@ -1,6 +1,10 @@
+import re
+
+from asgiref.sync import sync_to_async
 from django.contrib.auth import authenticate, login
 from django.db.models import F
-from django.db.models import Q, Count, Sum
+from django.db.models import Q, Count, Sum, OuterRef, Subquery, Prefetch
+from django.db.models.functions import Coalesce, Substr
 from django.core.paginator import Paginator
 from django.http import HttpResponseRedirect, HttpResponse, HttpResponseNotFound, HttpResponseServerError, HttpResponseForbidden, HttpResponseBadRequest
 from django.shortcuts import render, get_object_or_404, redirect
@@ -16,14 +20,28 @@ from django.forms import modelformset_factory
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from .forms import AuthUserForm, RegUserForm, PostForm, CommentForm
-from .models import Post, Comment, Category
+from .models import Post, Comment, Category, ImageUpload, OwnerStats, set_main_images
+from .uploads import UploadError, commit_uploads, discard_upload, persist_images, write_chunk
 from .serializers import PostSerializer, UserSerializer
 from rest_framework.renderers import TemplateHTMLRenderer
 from rest_framework.response import Response
-from django.views.generic import DeleteView, CreateView, UpdateView, DetailView, ListView
+from django.views.generic import DeleteView, CreateView, UpdateView, DetailView, ListView, View
 from rest_framework.views import APIView
+from rest_framework.filters import OrderingFilter
 from django.views.generic.edit import FormMixin
-from .permissions import IsOwnerOrReadOnly
+from .permissions import IsOwnerOrReadOnly, IsStaffOrReadOnly
+from .search import search_posts
+from .filters import filter_posts, get_sort
+from .facets import facet_counts
+from .pagination import KeysetPagination, UserKeysetPagination, paginate_by_cursor
+from .stats import get_owner_stats, get_site_stats
+from .counters import record_view
+from .parallel import gather_queries
+from . import moderation
+from .cache import (
+    LISTING_GENERATION_KEY, AnonymousPageCacheMixin, ConditionalGetMixin, cached_post_status,
+    detail_cache_key, listing_cache_key, post_generation_key, remember_post_status,
+)
 from .models import Profile
 from .forms import UserUpdateForm, ProfileUpdateForm, AdminPostForm, PostImage, PostImageForm,PostImageUploadForm
 from django.views.static import serve
@@ -34,6 +52,13 @@ def serve_media_files(request, path):
     return serve(request, path, document_root=settings.MEDIA_ROOT)
 
 
+def owner_post_rows(user):
+    """Объявления владельца с колонками для таблиц и списков, без полного описания"""
+    return Post.objects.filter(owner=user).only(
+        'id', 'title', 'price', 'rooms', 'status', 'views', 'created'
+    ).annotate(excerpt=Substr('description', 1, 200))
+
+
 class ProfileDetailView(LoginRequiredMixin, DetailView):
     model = Profile
     template_name = 'main/profile.html'
@@ -46,17 +71,16 @@ class ProfileDetailView(LoginRequiredMixin, DetailView):
         context = super().get_context_data(**kwargs)
         user = self.request.user
         
-        # Получаем статистику
-        user_posts = Post.objects.filter(owner=user)
-        total_views = user_posts.aggregate(total_views=Sum('views'))['total_views'] or 0
-        recent_posts = user_posts.order_by('-created')[:5]
+        # Статистика из OwnerStats одним запросом, последние объявления - вторым
+        owner_stats = get_owner_stats(user)
         
         context.update({
             'user': user,
-            'total_views': total_views,
-            'recent_posts': recent_posts,
-            'post_count': user_posts.count(),
-            'comment_count': Comment.objects.filter(owner=user).count(),
+            'owner_stats': owner_stats,
+            'total_views': owner_stats.total_views,
+            'recent_posts': owner_post_rows(user).order_by('-created')[:5],
+            'post_count': owner_stats.total_posts,
+            'comment_count': owner_stats.comments_written,
         })
         return context
 
@@ -89,61 +113,54 @@ class ProfileUpdateView(LoginRequiredMixin, SuccessMessageMixin, UpdateView):
             return self.form_invalid(form)
 
 
-class PostinList(APIView):
+class PostinList(ConditionalGetMixin, AnonymousPageCacheMixin, APIView):
+    # APIView DRF не поддерживает асинхронные обработчики, поэтому список
+    # синхронный; его ответы почти всегда отдаются из кэша страниц
     renderer_classes = [TemplateHTMLRenderer]
     template_name = 'main/index.html'
 
+    def get_generation_key(self, request, *args, **kwargs):
+        return LISTING_GENERATION_KEY
+
+    def get_page_cache_key(self, request, *args, **kwargs):
+        return listing_cache_key(request.GET)
+
     def get(self, request):
-        # Базовый queryset - только активные объявления
-        queryset = Post.objects.filter(status='active')
+        # Только активные объявления с фильтрами и поиском из запроса
+        queryset = filter_posts(request.GET).select_related('cover', 'owner', 'category')
+        sort = get_sort(request.GET)
         
-        # Поиск по тексту
-        search_query = request.GET.get('q')
-        if search_query:
-            queryset = queryset.filter(
-                Q(title__icontains=search_query) |
-                Q(description__icontains=search_query) |
-                Q(address__icontains=search_query)
-            )
+        # Пагинация по курсору: 9 объявлений на страницу без COUNT и OFFSET
+        page_obj = paginate_by_cursor(
+            queryset, sort, request.GET.get('cursor'), per_page=9, params=request.GET
+        )
         
-        # Фильтр по цене
-        max_price = request.GET.get('max_price')
-        if max_price:
-            queryset = queryset.filter(price__lte=max_price)
+        # Фасеты одним сгруппированным запросом
+        facets = facet_counts(request.GET)
+        page_obj.total = facets['total']
         
-        # Фильтр по комнатам
-        rooms = request.GET.get('rooms')
-        if rooms:
-            queryset = queryset.filter(rooms=rooms)
-        
-        # Фильтр по площади
-        min_area = request.GET.get('min_area')
-        if min_area:
-            queryset = queryset.filter(area__gte=min_area)
-        
-        # Сортировка
-        sort = request.GET.get('sort', '-created')
-        queryset = queryset.order_by(sort)
-        
-        # Пагинация
-        paginator = Paginator(queryset, 9)  # 9 объявлений на страницу
-        page_number = request.GET.get('page')
-        page_obj = paginator.get_page(page_number)
-        
-        # Статистика для отображения
-        total_views = sum(post.views for post in Post.objects.filter(status='active'))
-        active_users = User.objects.filter(posts__status='active').distinct().count()
-        new_today = Post.objects.filter(
-            status='active',
-            created__date=timezone.now().date()
-        ).count()
+        # Статистика для отображения (поддерживается инкрементально)
+        site_stats = get_site_stats()
         
         return Response({
             'posts': page_obj,
-            'total_views': total_views,
-            'active_users': active_users,
-            'new_today': new_today,
+            'facets': facets,
+            'active_posts': site_stats.active_posts,
+            'total_views': site_stats.total_views,
+            'active_users': site_stats.active_users,
+            'new_today': site_stats.new_today,
         })
+
+class PostFacets(ConditionalGetMixin, APIView):
+    """Счетчики для боковой панели фильтров в формате JSON"""
+
+    def get_generation_key(self, request, *args, **kwargs):
+        return LISTING_GENERATION_KEY
+
+    def get(self, request):
+        return Response(facet_counts(request.GET))
+
+
 class PostDetailView(DetailView):
     model = Post
     template_name = 'main/changer.html'
@@ -179,25 +196,26 @@ class PostChangeView(LoginRequiredMixin, CreateView):
         kwargs['request'] = self.request
         return kwargs
 
+    posts_per_page = 20
+
     def get_context_data(self, **kwargs):
-        # Показываем все объявления пользователя
-        user_posts = Post.objects.filter(owner=self.request.user)
+        # Статистика владельца поддерживается инкрементально (см. stats.py)
+        owner_stats = get_owner_stats(self.request.user)
         
-        # Статистика - теперь используем реальные данные
-        total_views = sum(post.views for post in user_posts)
-        active_posts = user_posts.filter(status='active').count()
-        moderation_posts = user_posts.filter(status='moderation').count()
-        draft_posts = user_posts.filter(status='draft').count()
+        # Объявления пользователя страницами по курсору, только нужные таблице колонки
+        user_posts = paginate_by_cursor(
+            owner_post_rows(self.request.user), '-created', self.request.GET.get('cursor'),
+            per_page=self.posts_per_page, params=self.request.GET,
+        )
+        user_posts.total = owner_stats.total_posts
         
         kwargs['user_posts'] = user_posts
-        kwargs['total_views'] = total_views
-        kwargs['active_posts'] = active_posts
-        kwargs['moderation_posts'] = moderation_posts
-        kwargs['draft_posts'] = draft_posts
-        kwargs['total_comments'] = Comment.objects.filter(
-            post__in=user_posts, 
-            active=True
-        ).count()
+        kwargs['owner_stats'] = owner_stats
+        kwargs['total_views'] = owner_stats.total_views
+        kwargs['active_posts'] = owner_stats.active_posts
+        kwargs['moderation_posts'] = owner_stats.moderation_posts
+        kwargs['draft_posts'] = owner_stats.draft_posts
+        kwargs['total_comments'] = owner_stats.comments_received
         
         return super().get_context_data(**kwargs)
 
@@ -226,9 +244,6 @@ class PostCreateView(LoginRequiredMixin, CreateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['categories'] = Category.objects.all()
-        # Формсет для изображений
-        PostImageFormSet = modelformset_factory(PostImage, form=PostImageForm, extra=5)
-        context['image_formset'] = PostImageFormSet(queryset=PostImage.objects.none())
         return context
 
     def form_valid(self, form):
@@ -238,16 +253,14 @@ class PostCreateView(LoginRequiredMixin, CreateView):
         
         response = super().form_valid(form)
         
-        # Обработка изображений
-        PostImageFormSet = modelformset_factory(PostImage, form=PostImageForm, extra=5)
-        formset = PostImageFormSet(self.request.POST, self.request.FILES, queryset=PostImage.objects.none())
-        
-        if formset.is_valid():
-            for image_form in formset:
-                if image_form.cleaned_data.get('image'):
-                    image = image_form.save(commit=False)
-                    image.post = self.object
-                    image.save()
+        # Обработка изображений: все файлы сохраняются одним INSERT, первое - основное
+        image_form = PostImageUploadForm(self.request.POST, self.request.FILES)
+        if image_form.is_valid():
+            images = [
+                PostImage(post=self.object, image=image_file, is_main=not index)
+                for index, image_file in enumerate(self.request.FILES.getlist('images'))
+            ]
+            persist_images(self.object, images)
         
         messages.success(self.request, 'Объявление успешно создано!')
         return response
@@ -278,46 +291,112 @@ class PostUpdateView(LoginRequiredMixin, UpdateView):
         return context
 
     def form_valid(self, form):
+        # Основное изображение - одна из уже загруженных фотографий этого объявления
+        main_image_id = self.request.POST.get('main_image')
+        if main_image_id and not (
+            main_image_id.isdigit() and self.object.images.filter(pk=int(main_image_id)).exists()
+        ):
+            form.add_error(None, 'Выберите основное изображение среди фотографий объявления')
+            return self.form_invalid(form)
+
         response = super().form_valid(form)
         
         # Обработка новых изображений
         image_form = PostImageUploadForm(self.request.POST, self.request.FILES)
         if image_form.is_valid():
-            images = self.request.FILES.getlist('images')
-            for image_file in images:
-                PostImage.objects.create(
-                    Post=self.object,  # Исправлено: post вместо Post
-                    image=image_file
-                )
+            persist_images(self.object, [
+                PostImage(post=self.object, image=image_file)
+                for image_file in self.request.FILES.getlist('images')
+            ])
         
         # Обработка основного изображения
-        main_image_id = self.request.POST.get('main_image')
         if main_image_id:
-            PostImage.objects.filter(post=self.object).update(is_main=False)  # Исправлено
-            PostImage.objects.filter(id=main_image_id, post=self.object).update(is_main=True)  # Исправлено
+            set_main_images({self.object.pk: int(main_image_id)})
         
         messages.success(self.request, 'Объявление успешно обновлено!')
         return response
 
-class PostinDetailView(FormMixin, DetailView):
+class PostinDetailView(ConditionalGetMixin, AnonymousPageCacheMixin, FormMixin, DetailView):
+    """Страница объявления - асинхронное представление.
+
+    Объявление, изображения, комментарии и счетчики владельца читаются
+    одновременно (``gather_queries``). Формы, сессия и сообщения остаются
+    синхронным кодом и выполняются через ``sync_to_async``.
+    """
     model = Post
     template_name = 'main/post_detail.html'
     context_object_name = 'post'
     form_class = CommentForm
     success_msg = 'Комментарий успешно создан, ожидайте модерации'
 
-    def get(self, request, *args, **kwargs):
+    def get_generation_key(self, request, *args, **kwargs):
+        return post_generation_key(kwargs['pk'])
+
+    def not_modified(self, request, *args, **kwargs):
+        # Страница из кэша браузера - просмотр засчитывается, если объявление активно.
+        # Статус берется из кэша, запрос к БД нужен только после смены поколения
+        pk = kwargs['pk']
+        status = cached_post_status(pk)
+        if status is None:
+            status = Post.objects.filter(pk=pk).values_list('status', flat=True).first()
+        if status == 'active':
+            record_view(request, Post(pk=pk))
+
+    def get_page_cache_key(self, request, *args, **kwargs):
+        return detail_cache_key(kwargs['pk'])
+
+    def page_cache_hit(self, request, *args, **kwargs):
+        # Страница из кэша - просмотр все равно засчитывается
+        record_view(request, Post(pk=kwargs['pk']))
+
+    def is_response_cacheable(self, response):
+        # В кэш попадают только активные объявления: их просмотры считаются при попадании
+        post = getattr(self, 'object', None)
+        return post is not None and post.status == 'active'
+
+    async def get(self, request, *args, **kwargs):
+        related = await gather_queries(*self.get_loaders())
+        await sync_to_async(self.set_related)(*related)
+        context = await sync_to_async(self.get_context_data)(object=self.object)
+        response = self.render_to_response(context)
         # Увеличиваем счетчик просмотров
-        response = super().get(request, *args, **kwargs)
-        if self.object.status == 'active':
-            Post.objects.filter(pk=self.object.pk).update(views=F('views')+ 1)
-            # Обновляем объект в контексте
-            self.object.views += 1
+        await sync_to_async(self.count_view)(request)
         return response
 
+    def count_view(self, request):
+        remember_post_status(self.object)
+        if self.object.status == 'active':
+            # Просмотр копится в буфере и пишется в БД пакетом
+            if record_view(request, self.object):
+                # Обновляем объект в контексте
+                self.object.views += 1
+
+    def get_loaders(self):
+        # Все, что нужно шаблону, - четыре независимых запроса: объявление
+        # с владельцем и категорией, изображения, комментарии и счетчики владельца
+        pk = self.kwargs['pk']
+        return (
+            self.get_object,
+            lambda: list(PostImage.objects.filter(post_id=pk)),
+            lambda: list(
+                Comment.objects.filter(post_id=pk, active=True).select_related('owner').order_by('created')
+            ),
+            lambda: OwnerStats.objects.filter(user__posts=pk).first(),
+        )
+
+    def set_related(self, post, images, comments, owner_stats):
+        self.object, self.images, self.comments = post, images, comments
+        # Счетчиков еще нет, если владелец не открывал панель после обновления
+        self.owner_stats = owner_stats or get_owner_stats(post.owner)
+
+    def get_queryset(self):
+        return Post.objects.select_related('owner__profile', 'category')
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['comments'] = Comment.objects.filter(post=self.object, active=True)
+        context['images'] = self.images
+        context['comments'] = self.comments
+        context['owner_stats'] = self.owner_stats
         context['form'] = self.form_class()
         
         # Добавляем профиль пользователя, если он аутентифицирован
@@ -334,10 +413,13 @@ class PostinDetailView(FormMixin, DetailView):
         return context
 
     def get_success_url(self):
-        return reverse_lazy('post-detail', kwargs={'pk': self.get_object().id})
+        return reverse_lazy('post-detail', kwargs={'pk': self.object.pk})
 
-    def post(self, request, *args, **kwargs):
-        self.object = self.get_object()
+    async def post(self, request, *args, **kwargs):
+        return await sync_to_async(self.post_comment)(request, *args, **kwargs)
+
+    def post_comment(self, request, *args, **kwargs):
+        self.set_related(*(load() for load in self.get_loaders()))
         form = self.get_form()
         if form.is_valid():
             return self.form_valid(form)
@@ -346,7 +428,7 @@ class PostinDetailView(FormMixin, DetailView):
 
     def form_valid(self, form):
         comment = form.save(commit=False)
-        comment.post = self.get_object()
+        comment.post = self.object
         comment.owner = self.request.user
         comment.save()
         messages.success(self.request, self.success_msg)
@@ -434,35 +516,119 @@ class ProjectUserLogOutView(LogoutView):
     next_page = '/'
 
 
-class UserList(generics.ListAPIView):
-    queryset = User.objects.all()
+class ValuesListMixin:
+    """Быстрый список API: строки читаются через ``values()`` и сериализуются
+    облегченным ``list_serializer_class`` без создания моделей.
+
+    Курсорная пагинация DRF умеет работать со словарями, нужно только,
+    чтобы поля сортировки входили в ``list_serializer_class.VALUES``.
+    """
+    list_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        serializer_class = self.list_serializer_class
+        queryset = self.filter_queryset(self.get_queryset()).values(*serializer_class.VALUES)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serializer_class(page, many=True).data)
+        return Response(serializer_class(queryset, many=True).data)
+
+
+def count_of(queryset, field):
+    """Подзапрос с числом строк queryset, ссылающихся на текущую запись через field"""
+    related = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field)
+    return Coalesce(Subquery(related.annotate(total=Count('pk')).values('total')), 0)
+
+
+# Счетчики, которые отдаются вместо списков id: поле -> (записи, ссылка на объект)
+USER_COUNTS = {
+    'post_count': (Post.objects.all(), 'owner'),
+    'active_post_count': (Post.objects.filter(status='active'), 'owner'),
+    'comment_count': (Comment.objects.all(), 'owner'),
+}
+CATEGORY_COUNTS = {
+    'post_count': (Post.objects.all(), 'category'),
+    'active_post_count': (Post.objects.filter(status='active'), 'category'),
+}
+
+
+def annotate_api_queryset(queryset, fields, counts, expandable=()):
+    """Счетчики и списки id загружаются, только если войдут в ответ"""
+    queryset = queryset.annotate(**{
+        name: count_of(related, field)
+        for name, (related, field) in counts.items() if name in fields
+    })
+    prefetches = [
+        Prefetch(name, queryset=model.objects.only('id', field))
+        for name, model, field in expandable if name in fields
+    ]
+    return queryset.prefetch_related(*prefetches)
+
+
+class UserApiMixin:
     serializer_class = serializers.UserSerializer
 
+    def get_queryset(self):
+        return annotate_api_queryset(
+            User.objects.all(), self.get_serializer().fields, USER_COUNTS,
+            expandable=[('posts', Post, 'owner_id'), ('comments', Comment, 'owner_id')],
+        )
 
-class UserDetail(generics.RetrieveAPIView):
-    queryset = User.objects.all()
-    serializer_class = serializers.UserSerializer
+
+class UserList(UserApiMixin, generics.ListAPIView):
+    pagination_class = UserKeysetPagination
 
 
-class PostList(generics.ListCreateAPIView):
-    queryset = Post.objects.all()
+class UserDetail(UserApiMixin, generics.RetrieveAPIView):
+    pass
+
+
+def post_api_queryset():
+    return Post.objects.select_related('owner', 'category', 'cover').annotate(
+        comments_count=count_of(Comment.objects.filter(active=True), 'post'),
+    )
+
+
+class PostList(ConditionalGetMixin, ValuesListMixin, generics.ListCreateAPIView):
     serializer_class = PostSerializer
+    list_serializer_class = serializers.PostListSerializer
+    pagination_class = KeysetPagination
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    filter_backends = [OrderingFilter]
+    ordering_fields = ['created', 'price', 'views']
+
+    def get_queryset(self):
+        queryset = post_api_queryset()
+        search_query = self.request.query_params.get('q')
+        if search_query:
+            # Порядок страниц задает KeysetPagination, ранг по релевантности не нужен
+            queryset = search_posts(queryset, search_query, ranked=False)
+        return queryset
+
+    def get_generation_key(self, request, *args, **kwargs):
+        return LISTING_GENERATION_KEY
 
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
 
-class PostDetail(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Post.objects.all()
+class PostDetail(ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
     serializer_class = PostSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly,
                           IsOwnerOrReadOnly]
 
+    def get_generation_key(self, request, *args, **kwargs):
+        return post_generation_key(kwargs['pk'])
+
+    def get_queryset(self):
+        return post_api_queryset()
+
 
-class CommentList(generics.ListCreateAPIView):
-    queryset = Comment.objects.all()
+class CommentList(ValuesListMixin, generics.ListCreateAPIView):
+    queryset = Comment.objects.select_related('owner')
     serializer_class = serializers.CommentSerializer
+    list_serializer_class = serializers.CommentListSerializer
+    pagination_class = KeysetPagination
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
 
     def perform_create(self, serializer):
@@ -470,41 +636,163 @@ class CommentList(generics.ListCreateAPIView):
 
 
 class CommentDetail(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Comment.objects.all()
+    queryset = Comment.objects.select_related('owner')
     serializer_class = serializers.CommentSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly,
                           IsOwnerOrReadOnly]
 
 
-class CategoryList(generics.ListCreateAPIView):
-    queryset = Category.objects.all()
+class CategoryApiMixin:
     serializer_class = serializers.CategorySerializer
-    permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    permission_classes = [IsStaffOrReadOnly]
 
-    def perform_create(self, serializer):
-        serializer.save(owner=self.request.user)
+    def get_queryset(self):
+        return annotate_api_queryset(
+            Category.objects.all(), self.get_serializer().fields, CATEGORY_COUNTS,
+            expandable=[('posts', Post, 'category_id')],
+        )
 
 
-class CategoryDetail(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Category.objects.all()
-    serializer_class = serializers.PostSerializer
-    permission_classes = [permissions.IsAuthenticatedOrReadOnly,
-                          IsOwnerOrReadOnly]
-    
-class ModerationListView(LoginRequiredMixin, ListView):
+class CategoryList(CategoryApiMixin, generics.ListCreateAPIView):
+    pass
+
+
+class CategoryDetail(CategoryApiMixin, generics.RetrieveUpdateDestroyAPIView):
+    pass
+
+class StaffRequiredMixin(LoginRequiredMixin):
+    """Страницы модерации: остальных пользователей отправляет к списку объявлений"""
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.user.is_authenticated and not request.user.is_staff:
+            return redirect('post-list')
+        return super().dispatch(request, *args, **kwargs)
+
+
+class ModerationListView(StaffRequiredMixin, ListView):
     model = Post
     template_name = 'main/moderation_list.html'
     context_object_name = 'posts'
     
     def get_queryset(self):
-        if self.request.user.is_staff:
-            return Post.objects.filter(status='moderation')
-        return Post.objects.none()
-    
-    def dispatch(self, request, *args, **kwargs):
-        if not request.user.is_staff:
-            return redirect('post-list')
-        return super().dispatch(request, *args, **kwargs)
+        # Только просмотр: партию модератор берет кнопкой (ModerationClaimView)
+        return moderation.claimed_posts(self.request.user)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['queue_total'] = Post.objects.filter(status='moderation').count()
+        context['lease_minutes'] = getattr(settings, 'MODERATION_LEASE', 600) // 60
+        return context
+
+
+class ModerationClaimView(StaffRequiredMixin, View):
+    """Продлевает аренду и добирает партию самых старых объявлений очереди"""
+    http_method_names = ['post']
+
+    def post(self, request):
+        # Другие модераторы в это время получают следующие объявления
+        moderation.claim_batch(request.user)
+        return redirect('moderation-list')
+
+
+class ModerationDecisionView(StaffRequiredMixin, View):
+    """Одобрение или отклонение объявления, взятого модератором"""
+    http_method_names = ['post']
+    decision = None
+    statuses = {'approve': 'active', 'reject': 'rejected'}
+
+    def post(self, request, pk):
+        if moderation.decide(request.user, pk, self.statuses[self.decision]):
+            messages.success(request, 'Объявление одобрено' if self.decision == 'approve' else 'Объявление отклонено')
+        else:
+            messages.warning(request, 'Аренда объявления истекла или его уже проверили')
+        return redirect('moderation-list')
+
+
+class ModerationReleaseView(StaffRequiredMixin, View):
+    """Возвращает взятые объявления в очередь"""
+    http_method_names = ['post']
+
+    def post(self, request):
+        moderation.release(request.user)
+        return redirect('post-list')
+
+class PostUploadList(APIView):
+    """Начало загрузки фотографий объявления по частям"""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, pk):
+        post = get_object_or_404(Post, pk=pk, owner=request.user)
+        serializer = serializers.ImageUploadSerializer(data=request.data.get('files', []), many=True)
+        serializer.is_valid(raise_exception=True)
+        uploads = ImageUpload.objects.bulk_create([
+            ImageUpload(post=post, owner=request.user, **item) for item in serializer.validated_data
+        ])
+        return Response(serializers.ImageUploadSerializer(uploads, many=True).data, status=201)
+
+
+class PostUploadCommit(APIView):
+    """Создает изображения из полностью загруженных файлов"""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, pk):
+        post = get_object_or_404(Post, pk=pk, owner=request.user)
+        serializer = serializers.UploadCommitSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        upload_ids = set(serializer.validated_data['uploads'])
+        uploads = list(ImageUpload.objects.filter(pk__in=upload_ids, post=post, owner=request.user))
+        if not uploads or len(uploads) != len(upload_ids):
+            return Response({'detail': 'Загрузки не найдены'}, status=400)
+        try:
+            images = commit_uploads(post, uploads)
+        except UploadError as error:
+            return Response({'detail': str(error)}, status=409)
+        return Response([
+            {'id': image.pk, 'url': image.image.url, 'is_main': image.is_main} for image in images
+        ], status=201)
+
+
+class ImageUploadDetail(APIView):
+    """Состояние загрузки (для возобновления), запись очередной части и отмена"""
+    permission_classes = [permissions.IsAuthenticated]
+    content_range_re = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+    def get_upload(self, pk):
+        return get_object_or_404(ImageUpload, pk=pk, owner=self.request.user)
+
+    def get(self, request, pk):
+        return Response(serializers.ImageUploadSerializer(self.get_upload(pk)).data)
+
+    def put(self, request, pk):
+        upload = self.get_upload(pk)
+        content_range = request.META.get('HTTP_CONTENT_RANGE')
+        if content_range:
+            match = self.content_range_re.match(content_range)
+            if not match or int(match.group(3)) != upload.size:
+                return Response({'detail': 'Неверный заголовок Content-Range'}, status=400)
+            start, end = int(match.group(1)), int(match.group(2))
+            if end < start:
+                return Response({'detail': 'Неверный заголовок Content-Range'}, status=400)
+            length = end - start + 1
+        else:
+            start = upload.received
+            try:
+                length = int(request.META.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                return Response({'detail': 'Неверный заголовок Content-Length'}, status=400)
+        # Без тела запроса DRF не создает поток
+        if length <= 0 or request.stream is None:
+            return Response({'detail': 'Пустая часть файла'}, status=400)
+        try:
+            write_chunk(upload, start, request.stream, length)
+        except UploadError as error:
+            return Response({'detail': str(error), 'received': upload.received}, status=409)
+        return Response(serializers.ImageUploadSerializer(upload).data)
+
+    def delete(self, request, pk):
+        discard_upload(self.get_upload(pk))
+        return Response(status=204)
+
 
 class ImageDeleteView(LoginRequiredMixin, DeleteView):
     model = PostImage
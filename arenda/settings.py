@@ -18,10 +18,21 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Отдача медиафайлов (см. apartament/media.py): 'python', 'x-accel' (nginx) или 'x-sendfile'
+MEDIA_SERVE_MODE = os.environ.get('MEDIA_SERVE_MODE', 'python')
+MEDIA_ACCEL_PREFIX = '/protected-media/'  # internal location в nginx, указывающий на MEDIA_ROOT
+# Загрузки никогда не перезаписываются, поэтому их можно кэшировать навсегда
+MEDIA_IMMUTABLE_PREFIXES = ('posts/', 'avatars/')
+MEDIA_MAX_AGE = 86400  # для остальных файлов, например копий изображений
+
 # Настройки для загрузки изображений
 FILE_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB
 
+# Загрузка фотографий по частям через API (см. apartament/uploads.py)
+UPLOAD_TEMP_ROOT = os.path.join(BASE_DIR, 'uploads_tmp')
+UPLOAD_MAX_FILE_SIZE = 20971520  # 20MB
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
@@ -177,6 +188,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'apartament.routers.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -187,13 +199,23 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
+        # APP_DIRS нельзя совмещать с явным списком loaders: app_directories указан в нем
+        'APP_DIRS': False,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'apartament.context_processors.fragment_cache',
+            ],
+            # Шаблоны компилируются один раз на процесс. Кэш сбрасывается автоперезагрузкой
+            # runserver при изменении шаблона, поэтому загрузчик одинаков для разработки и продакшена
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
             ],
         },
     },
@@ -205,12 +227,105 @@ WSGI_APPLICATION = 'arenda.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE=postgres - PostgreSQL (нужен psycopg[pool] из requirements.txt), иначе SQLite в файле db.sqlite3.
+# Профиль PostgreSQL проверен тестами на PostgreSQL 16 и psycopg 3.3 с пулом. Кластер
+# должен быть в UTF8, иначе поиск с конфигурацией 'russian' ничего не находит. У
+# приложения нет миграций, а без них таблицы apartament создаются раньше auth_user
+# и внешние ключи на PostgreSQL не создаются - перед первым migrate нужен
+# makemigrations apartament.
+
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgres':
+    # Пул соединений psycopg 3; без пула (DB_POOL=0) соединения живут DB_CONN_MAX_AGE секунд
+    DB_POOL = os.environ.get('DB_POOL', '1') == '1'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'arenda'),
+            'USER': os.environ.get('DB_USER', 'arenda'),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', 'localhost'),
+            'PORT': os.environ.get('DB_PORT', '5432'),
+            # С пулом CONN_MAX_AGE должен быть 0: соединения держит сам пул
+            'CONN_MAX_AGE': 0 if DB_POOL else int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', 2)),
+                    'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+                    'timeout': 10,
+                },
+            } if DB_POOL else {},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # WAL: читатели не ждут писателя; NORMAL в WAL не теряет целостность при сбое
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    'PRAGMA mmap_size=134217728;'
+                    'PRAGMA cache_size=-64000;'
+                    'PRAGMA busy_timeout=5000;'
+                    'PRAGMA temp_store=MEMORY;'
+                ),
+                # Запись берет блокировку в начале транзакции, а не при первом
+                # UPDATE - иначе параллельные транзакции падают с "database is locked"
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,
+            },
+        }
     }
-}
+
+# Реплики только для чтения (см. apartament/routers.py): DB_REPLICAS - список
+# через запятую хостов PostgreSQL или путей к файлам SQLite
+DATABASE_REPLICAS = []
+for index, target in enumerate(filter(None, os.environ.get('DB_REPLICAS', '').split(',')), 1):
+    alias = f'replica{index}'
+    DATABASES[alias] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+    DATABASES[alias]['HOST' if DB_ENGINE == 'postgres' else 'NAME'] = target.strip()
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['apartament.routers.PrimaryReplicaRouter']
+
+# Сколько секунд после POST запросы пользователя читают из основной базы
+REPLICA_STICKY_SECONDS = 5
+
+
+# Cache
+# В продакшене нужен Redis (REDIS_URL): кэш страниц, блокировки от лавины запросов
+# и поколения страниц должны быть общими для всех воркеров. Без REDIS_URL
+# используется кэш в памяти процесса - только для разработки и одного воркера;
+# при WEB_CONCURRENCY > 1 manage.py check предупреждает (apartament.W001).
+
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'arenda',
+        }
+    }
+
+# Кэш страниц для анонимных посетителей (см. apartament/cache.py)
+PAGE_CACHE_ENABLED = True
+PAGE_CACHE_TIMEOUT = 60  # секунд, пока страница считается свежей
+PAGE_CACHE_STALE = 600  # секунд, пока устаревшая копия может отдаваться во время перестройки
+
+# Фрагменты шаблонов {% cache %}: карточки объявлений и навигация (см. post_card.html, layout.html).
+# Ключи карточек меняются при изменении объявления, срок ограничивает устаревание бейджа "Новое"
+FRAGMENT_CACHE_TIMEOUT = 600
 
 
 # Password validation
@@ -273,6 +388,23 @@ STATIC_URL = 'staticfiles/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
+# Буферизованный счетчик просмотров (см. apartament/counters.py)
+VIEW_COUNTER_FLUSH_INTERVAL = 10  # секунд между записями в БД
+VIEW_COUNTER_FLUSH_THRESHOLD = 100  # просмотров в буфере до записи
+VIEW_COUNTER_DEDUPE_SESSION = True  # не считать повторные просмотры в одной сессии
+VIEW_COUNTER_BACKGROUND_FLUSH = True  # сбрасывать буфер по времени из фонового потока
+
+# Уменьшенные копии изображений (см. apartament/renditions.py)
+RENDITIONS_ASYNC = True  # строить копии в пуле потоков, а не в запросе
+RENDITION_WORKERS = 2
+
+# Массовые действия модерации (см. apartament/moderation.py)
+MODERATION_ASYNC = True  # выполнять в фоновом потоке, а не в запросе админки
+MODERATION_CHUNK_SIZE = 500  # строк в одной транзакции
+MODERATION_STALE_AFTER = 300  # секунд без прогресса, после которых задачу можно продолжить
+MODERATION_BATCH_SIZE = 20  # объявлений, которые модератор берет из очереди за раз
+MODERATION_LEASE = 600  # секунд, на которые объявления закрепляются за модератором
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -5,7 +5,7 @@ from apartament import views
 from django.conf import settings
 from django.conf.urls.static import static
 from django.urls import re_path
-from django.views.static import serve  # Добавьте этот импорт
+from apartament.media import serve_media
 
 urlpatterns = [
     path('', views.PostinList.as_view(), name='post-list'),
@@ -24,20 +24,28 @@ urlpatterns = [
     path('users', views.UserList.as_view()),
     path('users/<int:pk>/', views.UserDetail.as_view()),
     path('posts/', views.PostList.as_view()),
+    path('posts/facets/', views.PostFacets.as_view(), name='post-facets'),
     path('posts/<int:pk>/', views.PostDetail.as_view()),
+    path('posts/<int:pk>/uploads/', views.PostUploadList.as_view(), name='post-uploads'),
+    path('posts/<int:pk>/uploads/commit/', views.PostUploadCommit.as_view(), name='post-uploads-commit'),
+    path('uploads/<uuid:pk>/', views.ImageUploadDetail.as_view(), name='upload-detail'),
     path('comments/', views.CommentList.as_view()),
     path('comments/<int:pk>/', views.CommentDetail.as_view()),
     path('categories/', views.CategoryList.as_view()),
     path('categories/<int:pk>/', views.CategoryDetail.as_view()),
     path('moderation/', views.ModerationListView.as_view(), name='moderation-list'),
+    path('moderation/claim/', views.ModerationClaimView.as_view(), name='moderation-claim'),
+    path('moderation/<int:pk>/approve/', views.ModerationDecisionView.as_view(decision='approve'), name='moderation-approve'),
+    path('moderation/<int:pk>/reject/', views.ModerationDecisionView.as_view(decision='reject'), name='moderation-reject'),
+    path('moderation/release/', views.ModerationReleaseView.as_view(), name='moderation-release'),
     path('admin/', admin.site.urls),
 ]
 
-# ВСЕГДА обслуживаем медиафайлы, независимо от DEBUG
+# ВСЕГДА обслуживаем медиафайлы, независимо от DEBUG.
+# В продакшене файл отдает прокси (MEDIA_SERVE_MODE = 'x-accel' / 'x-sendfile'),
+# иначе Django с ETag, условными запросами и диапазонами байтов
 urlpatterns += [
-    re_path(r'^media/(?P<path>.*)$', serve, {
-        'document_root': settings.MEDIA_ROOT,
-    }),
+    re_path(r'^media/(?P<path>.*)$', serve_media),
 ]
 
 # Только в разработке - статические файлы через Django